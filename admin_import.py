@@ -0,0 +1,86 @@
+# admin_import.py
+"""Массовый импорт NFT, пользователей и кодов передачи из JSONL/CSV.
+
+Файл читается потоково и пишется в базу пачками фиксированного размера,
+так что память не зависит от размера файла:
+
+    python admin_import.py nfts collection.jsonl
+    python admin_import.py users users.csv --chunk-size 5000
+    python admin_import.py transfers codes.jsonl --db nft_market.db
+"""
+import argparse
+import csv
+import json
+import logging
+import sys
+from itertools import islice
+
+from database import Database
+
+logging.basicConfig(level=logging.INFO)
+
+CHUNK_SIZE = 1000
+
+# Колонки CSV, которые нужно привести к int
+INT_FIELDS = {'telegram_id', 'user_id', 'file_size', 'price', 'nft_id', 'from_user_id'}
+
+def read_rows(path, file_format=None):
+    """Построчное чтение JSONL или CSV"""
+    file_format = file_format or ('csv' if path.endswith('.csv') else 'jsonl')
+    with open(path, encoding='utf-8', newline='') as f:
+        if file_format == 'csv':
+            for row in csv.DictReader(f):
+                yield {
+                    key: int(value) if key in INT_FIELDS and value else (value or None)
+                    for key, value in row.items()
+                }
+        else:
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+
+def chunked(rows, size):
+    """Разбиение потока строк на пачки"""
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
+def import_file(db, kind, path, chunk_size=CHUNK_SIZE, file_format=None):
+    """Импорт файла в базу, возвращает число записей"""
+    insert = {
+        'nfts': db.add_nfts,
+        'users': db.add_users,
+        'transfers': db.create_transfer_requests,
+    }[kind]
+
+    total = 0
+    for chunk in chunked(read_rows(path, file_format), chunk_size):
+        insert(chunk)
+        total += len(chunk)
+        logging.info(f"Imported {total} {kind}")
+    return total
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Массовый импорт в NFT маркет')
+    parser.add_argument('kind', choices=['nfts', 'users', 'transfers'])
+    parser.add_argument('path', help='Файл JSONL или CSV')
+    parser.add_argument('--format', choices=['jsonl', 'csv'], help='По умолчанию - по расширению файла')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+    parser.add_argument('--db', default='nft_market.db')
+    args = parser.parse_args(argv)
+
+    db = Database(args.db)
+    try:
+        total = import_file(db, args.kind, args.path, args.chunk_size, args.format)
+    finally:
+        db.close()
+
+    print(f"✅ Импортировано: {total}")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,123 @@
+# aggregates.py
+"""Агрегаты платформы (таблица counters) и пользователей (user_stats).
+
+Значения поддерживаются триггерами (см. migrations.py) при каждой
+регистрации, листинге, продаже, передаче и записи просмотров. Здесь -
+эталонный полный пересчет: для начального заполнения, восстановления и
+проверки.
+
+    python aggregates.py check --db nft_market.db
+    python aggregates.py rebuild --db nft_market.db
+"""
+import argparse
+import sqlite3
+import sys
+
+# Имя счетчика -> полный пересчет
+AGGREGATE_QUERIES = {
+    'active_listings': "SELECT COUNT(*) FROM nfts WHERE status = 'for_sale'",
+    'total_users': 'SELECT COUNT(*) FROM users',
+    'total_nfts': 'SELECT COUNT(*) FROM nfts',
+    'total_sales': "SELECT COUNT(*) FROM transactions WHERE status = 'completed'",
+    'total_volume': "SELECT IFNULL(SUM(amount_stars), 0) FROM transactions WHERE status = 'completed'",
+    'total_views': 'SELECT IFNULL(SUM(views), 0) FROM nfts',
+}
+
+# Статистика пользователя полным пересчетом (как в старом /api/stats)
+USER_STATS_QUERY = '''
+    SELECT u.id AS user_id,
+           (SELECT COUNT(*) FROM nfts WHERE user_id = u.id) AS total_nfts,
+           (SELECT COUNT(*) FROM nfts WHERE user_id = u.id AND status = 'sold') AS sold_nfts,
+           (SELECT IFNULL(SUM(amount_stars), 0) FROM transactions WHERE seller_id = u.id) AS earned,
+           (SELECT IFNULL(SUM(amount_stars), 0) FROM transactions WHERE buyer_id = u.id) AS spent
+    FROM users u
+'''
+
+def recompute(conn):
+    """Значения агрегатов полным пересчетом"""
+    return {name: conn.execute(query).fetchone()[0] for name, query in AGGREGATE_QUERIES.items()}
+
+def read_aggregates(conn):
+    """Текущие (поддерживаемые) значения агрегатов"""
+    names = list(AGGREGATE_QUERIES)
+    rows = conn.execute(
+        f"SELECT name, value FROM counters WHERE name IN ({', '.join('?' * len(names))})", names
+    ).fetchall()
+    return dict(rows)
+
+def rebuild_aggregates(conn):
+    """Перезапись агрегатов полным пересчетом (шаг миграции и восстановление)"""
+    conn.executemany(
+        'INSERT OR REPLACE INTO counters (name, value) VALUES (?, ?)',
+        recompute(conn).items()
+    )
+    # Число лотов входит в закэшированные страницы маркета
+    conn.execute("UPDATE counters SET value = value + 1 WHERE name = 'listing_version'")
+
+def rebuild_user_stats(conn):
+    """Перезапись user_stats полным пересчетом.
+
+    Версия не сбрасывается, а увеличивается - иначе старые ETag клиентов
+    могли бы совпасть с новыми.
+    """
+    conn.execute(f'''
+        INSERT INTO user_stats (user_id, total_nfts, sold_nfts, earned, spent)
+        {USER_STATS_QUERY} WHERE true
+        ON CONFLICT (user_id) DO UPDATE SET
+            total_nfts = excluded.total_nfts, sold_nfts = excluded.sold_nfts,
+            earned = excluded.earned, spent = excluded.spent, version = version + 1
+    ''')
+
+def check_user_stats(conn):
+    """Пользователи, у которых user_stats расходится с пересчетом"""
+    return [row[0] for row in conn.execute(f'''
+        SELECT e.user_id FROM ({USER_STATS_QUERY}) AS e
+        LEFT JOIN user_stats s ON s.user_id = e.user_id
+        WHERE IFNULL(s.total_nfts, 0) != e.total_nfts OR IFNULL(s.sold_nfts, 0) != e.sold_nfts
+           OR IFNULL(s.earned, 0) != e.earned OR IFNULL(s.spent, 0) != e.spent
+        ORDER BY e.user_id
+    ''')]
+
+def check_aggregates(conn):
+    """Расхождения поддерживаемых значений с пересчетом: {имя: (было, надо)}"""
+    conn.execute('BEGIN')  # один снимок для обоих чтений
+    try:
+        maintained = read_aggregates(conn)
+        expected = recompute(conn)
+    finally:
+        conn.rollback()
+    return {
+        name: (maintained.get(name), value)
+        for name, value in expected.items() if maintained.get(name) != value
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Агрегаты платформы')
+    parser.add_argument('command', choices=['check', 'rebuild'])
+    parser.add_argument('--db', default='nft_market.db', help='Путь к базе')
+    args = parser.parse_args(argv)
+
+    conn = sqlite3.connect(args.db, isolation_level=None)
+    try:
+        if args.command == 'rebuild':
+            conn.execute('BEGIN IMMEDIATE')
+            rebuild_aggregates(conn)
+            rebuild_user_stats(conn)
+            conn.execute('COMMIT')
+            print(', '.join(f"{name}={value}" for name, value in read_aggregates(conn).items()))
+            return 0
+
+        mismatches = check_aggregates(conn)
+        for name, (maintained, expected) in mismatches.items():
+            print(f"❌ {name}: {maintained} != {expected}")
+        users = check_user_stats(conn)
+        if users:
+            print(f"❌ user_stats differs for {len(users)} users: {users[:20]}")
+        if not mismatches and not users:
+            print(f"✅ {len(AGGREGATE_QUERIES)} aggregates and user_stats match a full recompute")
+        return 1 if mismatches or users else 0
+    finally:
+        conn.close()
+
+if __name__ == '__main__':
+    sys.exit(main())
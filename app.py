@@ -1,19 +1,32 @@
 # app.py
-from flask import Flask, render_template, request, jsonify, session, redirect, url_for
+from flask import Flask, render_template, request, jsonify, session, redirect, url_for, send_file, abort
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager, UserMixin, login_user, login_required, current_user, logout_user
-import requests
-from datetime import datetime
-import uuid
+from datetime import datetime, timedelta
 import hashlib
 import hmac
+import atexit
+import re
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError
 
-from config import BOT_MAIN_TOKEN, BOT_RECEIVER_TOKEN, WEBHOOK_URL
-from models import db, User, NFT, Transaction, TransferRequest
+from config import SECRET_KEY, DATABASE_URL, BOT_MAIN_TOKEN, BOT_RECEIVER_TOKEN, TRANSFER_CODE_TTL, PREVIEW_SIZES, PREVIEW_WAIT, PREVIEW_PLACEHOLDER, SEARCH_PER_PAGE, EVENTS_BACKEND, EVENTS_URL, EVENTS_FLASK_ROUTE
+from pagination import decode_cursor, build_page
+from view_counter import ViewCounter
+from purchase import purchase_nft
+from cache import create_cache, LISTING_VERSION_QUERY
+from previews import PreviewCache, MIMETYPES
+from outbox import OutboxDispatcher, OUTBOX_INSERT, event_params
+from transfers import generate_code
+from export import EXPORT_FORMATS, export_stream
+from events import create_hub, event_stream, publish_sale
+from search import SEARCH_QUERY, TERM_SAMPLE_QUERY, match_query, sample_params, search_params, build_search_page, register_functions
+import records
+from models import db, User, NFT, TransferRequest, Counter, init_schema
 
 app = Flask(__name__)
-app.config['SECRET_KEY'] = 'your-secret-key-here'
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///nft_market.db'
+app.config['SECRET_KEY'] = SECRET_KEY
+app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URL
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
 db.init_app(app)
@@ -21,6 +34,68 @@ login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
 
+# Поиск вызывает функции из search.py, они нужны на каждом соединении
+with app.app_context():
+    event.listen(db.engine, 'connect', lambda conn, record: register_functions(conn))
+
+def write_views(deltas):
+    """Пакетная запись накопленных просмотров"""
+    with app.app_context():
+        db.session.execute(
+            db.text('UPDATE nfts SET views = views + :delta WHERE id = :nft_id'),
+            [{'nft_id': nft_id, 'delta': delta} for nft_id, delta in deltas.items()]
+        )
+        db.session.commit()
+
+def listing_version():
+    """Версия листингов из базы (общая с ботами, см. cache.py)"""
+    return db.session.execute(db.text(LISTING_VERSION_QUERY)).scalar() or 0
+
+# Read-through кэш листингов
+listing_cache = create_cache(version=listing_version)
+
+# Просмотры копятся в памяти и пишутся в базу пачками в фоне
+view_counter = ViewCounter(write_views)
+view_counter.start()
+atexit.register(view_counter.stop)
+
+# Live-события маркета для /api/events (см. events.py)
+event_hub = create_hub()
+
+# Миниатюры файлов NFT считаются в пуле процессов и кэшируются на диске
+preview_cache = PreviewCache()
+atexit.register(preview_cache.close)
+
+CONTENT_HASH_RE = re.compile(r'[0-9a-f]{64}')
+
+# Уведомления о продажах и передачах доставляются из outbox в фоне
+with app.app_context():
+    outbox_dispatcher = OutboxDispatcher(db.engine.url.database)
+outbox_dispatcher.start()
+atexit.register(outbox_dispatcher.stop)
+
+@app.template_global()
+def nft_views(nft, mark=None):
+    """Просмотры NFT с учетом еще не записанных в базу; для записи из кэша
+    mark - views_mark ее страницы (см. ViewCounter.since)"""
+    return (nft.views or 0) + view_counter.since(nft.id, mark)
+
+@app.template_global()
+def live_events_url():
+    """URL потока событий для страниц или None, если live-обновления выключены.
+
+    С бэкендом memory события из ботов и других воркеров до вкладки не
+    дойдут, поэтому страницы остаются на опросе.
+    """
+    return EVENTS_URL if EVENTS_BACKEND == 'redis' else None
+
+@app.template_global()
+def nft_preview_url(nft, size='thumb'):
+    """URL миниатюры NFT или None, если файл еще не скачан"""
+    if not nft.content_hash:
+        return None
+    return url_for('nft_preview', content_hash=nft.content_hash, size=size)
+
 @login_manager.user_loader
 def load_user(user_id):
     return User.query.get(int(user_id))
@@ -80,14 +155,64 @@ def auth():
 @login_required
 def market():
     """Страница маркета"""
-    page = request.args.get('page', 1, type=int)
     per_page = 12
+    cursor = request.args.get('cursor', '')
+    page = listing_cache.get_or_load(
+        f'web_market:{per_page}:{cursor}',
+        lambda: load_market_page(cursor, per_page)
+    )
     
-    nfts = NFT.query.filter_by(status='for_sale').order_by(NFT.created_at.desc()).paginate(
-        page=page, per_page=per_page, error_out=False
+    return render_template(
+        'market.html',
+        nfts=page['items'],
+        next_cursor=page['next_cursor'],
+        prev_cursor=page['prev_cursor'],
+        total=page['total'],
+        views_mark=page['views_mark']
     )
+
+def load_market_page(cursor, per_page):
+    """Загрузка страницы маркета из базы"""
+    decoded = decode_cursor(cursor)
+    direction = decoded[0] if decoded else 'next'
+    
+    # Keyset-пагинация по (created_at, id) вместо OFFSET; продавец и общее
+    # число лотов (из счетчика) приходят тем же запросом
+    total = db.session.query(Counter.value).filter_by(name='active_listings').scalar_subquery()
+    mark = view_counter.snapshot()
+    # created_at сравнивается как хранимый текст, как в Database._load_active_sales:
+    # боты пишут CURRENT_TIMESTAMP без долей секунды, а сайт - с микросекундами
+    created_at = db.type_coerce(NFT.created_at, db.String)
+    query = NFT.query.options(db.joinedload(NFT.owner)).add_columns(total, created_at) \
+        .filter_by(status='for_sale')
+    if decoded:
+        key = db.tuple_(created_at, NFT.id)
+        boundary = (decoded[1], decoded[2])
+        if direction == 'next':
+            query = query.filter(key < boundary).order_by(NFT.created_at.desc(), NFT.id.desc())
+        else:
+            query = query.filter(key > boundary).order_by(NFT.created_at.asc(), NFT.id.asc())
+    else:
+        query = query.order_by(NFT.created_at.desc(), NFT.id.desc())
+    
+    rows = query.limit(per_page + 1).all()
+    total_listings = rows[0][1] if rows else Counter.query.get('active_listings').value
     
-    return render_template('market.html', nfts=nfts)
+    # В кэш кладем компактные записи, а не ORM-объекты, привязанные к сессии;
+    # created_at в них - хранимый текст, из него строится курсор
+    items = []
+    for nft, _, created_at_text in rows:
+        item = records.NFT(*[getattr(nft, column) for column in records.NFT_COLUMNS],
+                           nft.owner.username if nft.owner else None)
+        item.created_at = created_at_text
+        items.append(item)
+    
+    # NULL в created_at не бывает (миграция 11), но курсор не должен падать
+    page = build_page(items, per_page, direction, decoded is not None,
+                      key=lambda nft: (nft.created_at or '', nft.id))
+    page['total'] = total_listings
+    page['views_mark'] = mark
+    return page
 
 @app.route('/nft/<int:nft_id>')
 @login_required
@@ -95,13 +220,42 @@ def view_nft(nft_id):
     """Просмотр NFT"""
     nft = NFT.query.get_or_404(nft_id)
     
-    # Увеличиваем просмотры
-    nft.views += 1
-    db.session.commit()
+    # Увеличиваем просмотры (запись в базу отложена)
+    view_counter.increment(nft.id)
     
     seller = User.query.get(nft.user_id)
     
-    return render_template('nft_detail.html', nft=nft, seller=seller)
+    return render_template('nft_detail.html', nft=nft, seller=seller, views=nft_views(nft))
+
+@app.route('/media/<content_hash>/<size>')
+def nft_preview(content_hash, size):
+    """Миниатюра файла NFT (WebP, если браузер поддерживает, иначе JPEG)"""
+    if not CONTENT_HASH_RE.fullmatch(content_hash) or size not in PREVIEW_SIZES:
+        abort(404)
+    fmt = 'webp' if 'image/webp' in request.headers.get('Accept', '') else 'jpeg'
+    
+    path = preview_cache.get(content_hash, size, fmt)
+    if path is None and not preview_cache.failed(content_hash, size, fmt):
+        # Ждем генерацию недолго, остальное досчитается в фоне. Упавшая
+        # генерация (ее пишет в лог PreviewCache) - та же заглушка, а не 500
+        try:
+            preview_cache.submit(content_hash, size, fmt).result(timeout=PREVIEW_WAIT)
+        except Exception:
+            pass
+        path = preview_cache.get(content_hash, size, fmt)
+    
+    if path is None:
+        response = redirect(PREVIEW_PLACEHOLDER)
+        response.headers['Cache-Control'] = 'no-store'
+        return response
+    
+    # Превью по хэшу никогда не меняется
+    response = send_file(path, mimetype=MIMETYPES[fmt], etag=f'{content_hash}-{size}-{fmt}',
+                         max_age=365 * 24 * 60 * 60, conditional=True)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    response.vary.add('Accept')
+    return response
 
 @app.route('/inventory')
 @login_required
@@ -120,55 +274,25 @@ def profile():
 @login_required
 def buy_nft(nft_id):
     """API для покупки NFT"""
-    nft = NFT.query.get_or_404(nft_id)
-    
-    if nft.status != 'for_sale':
-        return jsonify({
-            'success': False,
-            'error': 'NFT not for sale'
-        }), 400
-    
-    if nft.user_id == current_user.id:
-        return jsonify({
-            'success': False,
-            'error': 'Cannot buy your own NFT'
-        }), 400
-    
-    if current_user.balance_stars < nft.price:
-        return jsonify({
-            'success': False,
-            'error': 'Insufficient balance'
-        }), 400
-    
-    # Создаем транзакцию
-    transaction = Transaction(
-        nft_id=nft.id,
-        buyer_id=current_user.id,
-        seller_id=nft.user_id,
-        amount_stars=nft.price,
-        amount_rub=nft.price * 10  # Конвертация в рубли
-    )
-    
-    # Обновляем балансы
-    current_user.balance_stars -= nft.price
-    seller = User.query.get(nft.user_id)
-    seller.balance_stars += nft.price
-    
-    # Обновляем статус NFT
-    nft.status = 'sold'
-    nft.user_id = current_user.id
-    nft.sold_at = datetime.utcnow()
+    # Проверки, списание, зачисление и смена владельца - одной транзакцией
+    raw_conn = db.engine.raw_connection()
+    try:
+        result = purchase_nft(raw_conn.dbapi_connection, nft_id, current_user.id)
+    finally:
+        raw_conn.close()
     
-    db.session.add(transaction)
-    db.session.commit()
+    if not result['success']:
+        status_code = 404 if result['error'] == 'NFT not found' else 400
+        return jsonify(result), status_code
     
-    # Уведомляем бота о продаже
-    notify_bot_about_sale(transaction)
+    # Балансы изменены в обход сессии
+    db.session.expire_all()
+    publish_sale(event_hub, result)
     
     return jsonify({
         'success': True,
         'message': 'Purchase successful',
-        'nft_id': nft.id
+        'nft_id': nft_id
     })
 
 @app.route('/api/transfer', methods=['POST'])
@@ -196,28 +320,50 @@ def transfer_nft():
         }), 404
     
     # Создаем код передачи
-    transfer_code = str(uuid.uuid4())[:8].upper()
-    
-    transfer = TransferRequest(
-        nft_id=nft.id,
-        from_user_id=current_user.id,
-        to_user_id=recipient.id,
-        transfer_code=transfer_code,
-        expires_at=datetime.utcnow().replace(hour=24, minute=0, second=0)
-    )
+    transfer = create_transfer_request(nft.id, current_user.id, recipient.id)
+    transfer_code = transfer.transfer_code
     
-    db.session.add(transfer)
+    # Уведомление боту - в той же транзакции
+    db.session.execute(db.text(OUTBOX_INSERT), event_params('transfer', {
+        'transfer_id': transfer.id,
+        'nft_id': transfer.nft_id,
+        'from_user': transfer.from_user_id,
+        'to_user': transfer.to_user_id,
+        'code': transfer.transfer_code
+    }))
     db.session.commit()
     
-    # Уведомляем бота
-    notify_bot_about_transfer(transfer)
-    
     return jsonify({
         'success': True,
         'transfer_code': transfer_code,
         'message': f'Transfer code created. Share it with @{to_username}'
     })
 
+def create_transfer_request(nft_id, from_user_id, to_user_id, attempts=5):
+    """Запрос на передачу с новым кодом в текущей транзакции сессии.
+
+    Как в Database.issue_transfer_code, код не проверяется заранее: при
+    совпадении UNIQUE-ограничение отклоняет вставку, и она повторяется
+    с другим кодом. До вставки в транзакции нет изменений, поэтому
+    откатывается она целиком.
+    """
+    for attempt in range(attempts):
+        transfer = TransferRequest(
+            nft_id=nft_id,
+            from_user_id=from_user_id,
+            to_user_id=to_user_id,
+            transfer_code=generate_code(),
+            expires_at=datetime.utcnow() + timedelta(seconds=TRANSFER_CODE_TTL)
+        )
+        db.session.add(transfer)
+        try:
+            db.session.flush()
+            return transfer
+        except IntegrityError:
+            db.session.rollback()
+            if attempt == attempts - 1:
+                raise
+
 @app.route('/api/deposit', methods=['POST'])
 @login_required
 def deposit():
@@ -240,53 +386,206 @@ def deposit():
     })
 
 @app.route('/api/stats')
+@app.route('/api/profile/stats')
 @login_required
 def get_stats():
-    """API для получения статистики"""
+    """API для получения статистики (профиль опрашивает его по таймеру).
+
+    Статистика берется из user_stats одним запросом по ключу; ETag - ее
+    версия, которую триггеры меняют при любой записи, кто бы ее ни сделал
+    (сайт или боты). Неизменившийся опрос получает 304.
+    """
+    stats = load_user_stats(current_user.id)
+    
+    response = jsonify({
+        'success': True,
+        'stats': {key: value for key, value in stats.items() if key != 'version'}
+    })
+    response.set_etag(f"stats-{current_user.id}-{stats['version']}")
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response.make_conditional(request)
+
+def load_user_stats(user_id):
+    """Статистика пользователя одним запросом (см. user_stats в migrations.py)"""
+    row = db.session.execute(db.text('''
+        SELECT IFNULL(s.total_nfts, 0), IFNULL(s.sold_nfts, 0), IFNULL(s.earned, 0),
+               IFNULL(s.spent, 0), u.balance_stars, IFNULL(s.version, 0)
+        FROM users u
+        LEFT JOIN user_stats s ON s.user_id = u.id
+        WHERE u.id = :user_id
+    '''), {'user_id': user_id}).fetchone()
+    if row is None:
+        return None
+    
+    total_nfts, sold_nfts, total_earned, total_spent, balance, version = row
+    return {
+        'total_nfts': total_nfts,
+        'sold_nfts': sold_nfts,
+        'total_earned': total_earned,
+        'total_spent': total_spent,
+        'balance': balance or 0,
+        'version': version
+    }
+
+def market_events():
+    """Server-Sent Events: новые лоты, продажи, изменения баланса.
+
+    Соединение держит поток сервера, пока клиент подключен; события о
+    балансе приходят только их владельцу. В рабочей конфигурации этот
+    путь обслуживает sse_server.py, а маршрут во Flask включается
+    EVENTS_FLASK_ROUTE для разработки.
+    """
+    user_id = session.get('_user_id')
+    stream = event_stream(
+        event_hub,
+        int(user_id) if user_id is not None else None,
+        request.headers.get('Last-Event-ID')
+    )
+    response = app.response_class(stream, mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # Отключает буферизацию ответа в nginx
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+if EVENTS_FLASK_ROUTE:
+    app.add_url_rule('/api/events', view_func=market_events)
+
+@app.route('/api/profile/export')
+@login_required
+def export_profile():
+    """Потоковая выгрузка NFT и сделок пользователя (NDJSON или CSV).
+
+    Ответ формируется генератором по мере чтения из базы; если браузер
+    принимает gzip, поток сжимается на лету.
+    """
+    fmt = request.args.get('format', 'ndjson')
+    if fmt not in EXPORT_FORMATS:
+        return jsonify({
+            'success': False,
+            'error': 'Unsupported format'
+        }), 400
+    
+    mimetype, extension = EXPORT_FORMATS[fmt]
+    compress = request.accept_encodings['gzip'] > 0
     user_id = current_user.id
+    engine = db.engine
+    
+    def generate():
+        # Отдельное соединение живет, пока клиент читает ответ
+        raw_conn = engine.raw_connection()
+        try:
+            yield from export_stream(raw_conn.dbapi_connection, user_id, fmt, compress)
+        finally:
+            raw_conn.close()
     
-    total_nfts = NFT.query.filter_by(user_id=user_id).count()
-    sold_nfts = NFT.query.filter_by(user_id=user_id, status='sold').count()
-    total_earned = db.session.query(db.func.sum(Transaction.amount_stars)).filter_by(seller_id=user_id).scalar() or 0
-    total_spent = db.session.query(db.func.sum(Transaction.amount_stars)).filter_by(buyer_id=user_id).scalar() or 0
+    response = app.response_class(generate(), mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename=nft_market_export_{user_id}.{extension}'
+    response.headers['Cache-Control'] = 'no-store'
+    response.headers['Vary'] = 'Accept-Encoding'
+    if compress:
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+@app.route('/api/platform/stats')
+def get_platform_stats():
+    """API для общей статистики платформы (из поддерживаемых агрегатов)"""
+    names = ['total_users', 'total_nfts', 'total_sales', 'total_volume', 'active_listings']
+    values = dict(db.session.query(Counter.name, Counter.value).filter(Counter.name.in_(names)))
     
     return jsonify({
         'success': True,
-        'stats': {
-            'total_nfts': total_nfts,
-            'sold_nfts': sold_nfts,
-            'total_earned': total_earned,
-            'total_spent': total_spent,
-            'balance': current_user.balance_stars
-        }
+        'total_users': values.get('total_users', 0),
+        'total_nfts': values.get('total_nfts', 0),
+        'total_sales': values.get('total_sales', 0),
+        'total_stars': values.get('total_volume', 0),
+        'active_listings': values.get('active_listings', 0)
     })
 
-def notify_bot_about_sale(transaction):
-    """Уведомление бота о продаже"""
-    try:
-        # Отправляем запрос к боту
-        requests.post(f"{WEBHOOK_URL}/api/sale_notification", json={
-            'transaction_id': transaction.id,
-            'nft_id': transaction.nft_id,
-            'buyer_id': transaction.buyer_id,
-            'seller_id': transaction.seller_id,
-            'amount': transaction.amount_stars
-        })
-    except:
-        pass
+@app.route('/api/nfts/popular')
+def get_popular_nfts():
+    """API для самых просматриваемых лотов маркета"""
+    limit = max(1, min(request.args.get('limit', 4, type=int), 12))
+    page = listing_cache.get_or_load(f'popular:{limit}', lambda: load_popular_nfts(limit))
+    
+    return jsonify({
+        'success': True,
+        'nfts': [{
+            'id': nft.id,
+            'title': nft.title,
+            'file_name': nft.file_name,
+            'price': nft.price,
+            'views': nft_views(nft, page['views_mark']),
+            'image_url': nft_preview_url(nft)
+        } for nft in page['items']]
+    })
 
-def notify_bot_about_transfer(transfer):
-    """Уведомление бота о передаче"""
-    try:
-        requests.post(f"{WEBHOOK_URL}/api/transfer_notification", json={
-            'transfer_id': transfer.id,
-            'nft_id': transfer.nft_id,
-            'from_user': transfer.from_user_id,
-            'to_user': transfer.to_user_id,
-            'code': transfer.transfer_code
-        })
-    except:
-        pass
+def load_popular_nfts(limit):
+    """Загрузка популярных лотов (по индексу status, views)"""
+    mark = view_counter.snapshot()
+    nfts = NFT.query.filter_by(status='for_sale').order_by(NFT.views.desc(), NFT.id.desc()).limit(limit)
+    return {
+        'items': [records.NFT(*[getattr(nft, column) for column in records.NFT_COLUMNS]) for nft in nfts],
+        'views_mark': mark
+    }
+
+@app.route('/api/nfts/search')
+def search_nfts():
+    """API поиска лотов по названию, описанию и имени файла (см. search.py).
+
+    Результаты идут от новых к старым окнами по SEARCH_CANDIDATES; по
+    качеству совпадения они переставляются только внутри окна, так что
+    точное совпадение со старым лотом окажется ниже частичного с новым.
+    """
+    per_page = max(1, min(request.args.get('limit', SEARCH_PER_PAGE, type=int), 50))
+    offset = max(0, request.args.get('offset', 0, type=int))
+    query = match_query(request.args.get('q', ''))
+    if query is None:
+        page = {'items': [], 'next_offset': None}
+    else:
+        page = listing_cache.get_or_load(
+            f'web_search:{per_page}:{offset}:{query}',
+            lambda: load_search_page(query, per_page, offset)
+        )
+    
+    return jsonify({
+        'success': True,
+        'nfts': [{
+            'id': nft.id,
+            'title': nft.title,
+            'file_name': nft.file_name,
+            'description': nft.description,
+            'price': nft.price,
+            'views': nft_views(nft, page.get('views_mark')),
+            'seller_username': nft.seller_username,
+            'image_url': nft_preview_url(nft)
+        } for nft in page['items']],
+        'next_offset': page['next_offset']
+    })
+
+def load_search_page(query, per_page, offset):
+    """Загрузка страницы поиска из FTS-индекса"""
+    mark = view_counter.snapshot()
+    params = sample_params(query)
+    densities = params and db.session.execute(db.text(TERM_SAMPLE_QUERY), params).scalars().all()
+    rows = db.session.execute(db.text(SEARCH_QUERY), search_params(query, per_page, offset, densities)).all()
+    page = build_search_page([records.NFT(*row) for row in rows], per_page, offset)
+    page['views_mark'] = mark
+    return page
+
+@app.route('/api/cache/stats')
+@login_required
+def get_cache_stats():
+    """API для счетчиков кэша (только для администраторов)"""
+    if not current_user.is_admin:
+        return jsonify({
+            'success': False,
+            'error': 'Forbidden'
+        }), 403
+    
+    return jsonify({
+        'success': True,
+        'cache': listing_cache.stats()
+    })
 
 def create_stars_payment_link(user_id: int, amount: int) -> str:
     """Создание ссылки на оплату Stars"""
@@ -295,5 +594,5 @@ def create_stars_payment_link(user_id: int, amount: int) -> str:
 
 if __name__ == '__main__':
     with app.app_context():
-        db.create_all()
+        init_schema()
     app.run(debug=True, host='0.0.0.0', port=5002)
\ No newline at end of file
@@ -0,0 +1,114 @@
+# async_bench.py
+"""Конкурентный прогон AsyncDatabase: 1000 апдейтов одновременно.
+
+Каждый симулированный апдейт читает пользователя и его NFT, часть
+апдейтов пишет состояние пользователя. Пока они выполняются, другое
+соединение держит блокировку записи (как долгая транзакция сайта).
+Сравниваются синхронные вызовы Database прямо в корутинах (event loop
+стоит на каждом запросе) и await AsyncDatabase; задержка апдейта - от
+общего старта до его завершения:
+
+    python async_bench.py
+    python async_bench.py --updates 1000 --writes 0.01 --lock-ms 300
+"""
+import argparse
+import asyncio
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+from async_database import AsyncDatabase
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+def _fill(path, users, nfts_per_user):
+    conn = sqlite3.connect(path)
+    conn.executemany('INSERT INTO users (telegram_id, username) VALUES (?, ?)',
+                     [(1000 + i, f'user{i}') for i in range(users)])
+    conn.executemany(
+        "INSERT INTO nfts (user_id, file_id, file_name, price, status) VALUES (?, ?, 'file.png', 10, 'owned')",
+        [(user_id, f'f{user_id}_{i}') for user_id in range(1, users + 1) for i in range(nfts_per_user)]
+    )
+    conn.commit()
+    conn.close()
+
+def hold_write_lock(path, seconds, started):
+    """Долгая транзакция записи в другом соединении"""
+    conn = sqlite3.connect(path, isolation_level=None)
+    conn.execute('BEGIN IMMEDIATE')
+    started.set()
+    time.sleep(seconds)
+    conn.execute('COMMIT')
+    conn.close()
+
+async def handle_update(db, user_id, write, call):
+    """Симулированный апдейт: чтения и иногда запись состояния"""
+    user = await call(db, 'get_user_by_telegram_id', 1000 + user_id)
+    await call(db, 'get_user_nfts', user['id'])
+    if write:
+        await call(db, 'set_user_state', user['id'], 'waiting_for_price', {'nft_id': 1})
+
+async def call_sync(db, name, *args):
+    # Так хендлеры работали до AsyncDatabase: запрос блокирует event loop
+    return getattr(db.sync, name)(*args)
+
+async def call_async(db, name, *args):
+    return await getattr(db, name)(*args)
+
+async def run(db, path, updates, users, writes, lock_seconds, call, seed=1):
+    rng = random.Random(seed)
+    plan = [(rng.randrange(users), rng.random() < writes) for _ in range(updates)]
+    latencies = []
+
+    async def timed(user_id, write, started):
+        await handle_update(db, user_id, write, call)
+        latencies.append(time.perf_counter() - started)
+
+    locked = threading.Event()
+    locker = threading.Thread(target=hold_write_lock, args=(path, lock_seconds, locked))
+    locker.start()
+    locked.wait()
+    started = time.perf_counter()
+    await asyncio.gather(*(timed(user_id, write, started) for user_id, write in plan))
+    elapsed = time.perf_counter() - started
+    locker.join()
+    return latencies, elapsed
+
+def bench(updates, writes, lock_ms, users=500, nfts_per_user=5):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'async.db')
+        db = AsyncDatabase(path)
+        _fill(path, users, nfts_per_user)
+        results = {}
+        try:
+            for name, call in (('sync calls in coroutines', call_sync), ('AsyncDatabase', call_async)):
+                results[name] = asyncio.run(run(db, path, updates, users, writes, lock_ms / 1000, call))
+        finally:
+            db.close()
+
+    print(f"{updates} concurrent updates ({writes:.0%} writes), write lock held {lock_ms} ms")
+    for name, (latencies, elapsed) in results.items():
+        print(f"{name:25} p50 {percentile(latencies, 0.5) * 1e3:6.1f} ms, "
+              f"p99 {percentile(latencies, 0.99) * 1e3:6.1f} ms, all done in {elapsed * 1e3:.0f} ms")
+    before = percentile(results['sync calls in coroutines'][0], 0.5)
+    after = percentile(results['AsyncDatabase'][0], 0.5)
+    ok = after < before
+    print(f"{'✅' if ok else '❌'} reads do not wait behind the write lock with AsyncDatabase")
+    return ok
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Конкурентный прогон AsyncDatabase')
+    parser.add_argument('--updates', type=int, default=1000)
+    parser.add_argument('--writes', type=float, default=0.01, help='Доля апдейтов с записью')
+    parser.add_argument('--lock-ms', type=int, default=300, help='Сколько другое соединение держит запись')
+    args = parser.parse_args(argv)
+    return 0 if bench(args.updates, args.writes, args.lock_ms) else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
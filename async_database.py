@@ -0,0 +1,50 @@
+# async_database.py
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from database import Database
+
+# Число потоков для чтения (у каждого свое соединение из пула).
+# Запись идет через один отдельный поток: SQLite все равно допускает
+# только одного писателя, а ожидание блокировки не занимает читателей.
+DB_WORKERS = 4
+READ_PREFIXES = ('get_', 'check_', 'can_', 'search_')
+
+class AsyncDatabase:
+    """Асинхронная обертка над Database для хендлеров aiogram.
+
+    Те же методы, что у Database, но каждый вызов выполняется в отдельном
+    потоке и не блокирует event loop:
+
+        user = await db.get_user_by_telegram_id(telegram_id)
+
+    Синхронный Database доступен как db.sync (для Flask-маршрутов).
+    """
+
+    def __init__(self, db_path='nft_market.db', workers=DB_WORKERS):
+        self.sync = Database(db_path)
+        self._readers = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='db-read')
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-write')
+
+    def __getattr__(self, name):
+        attr = getattr(self.sync, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+
+        executor = self._readers if name.startswith(READ_PREFIXES) else self._writer
+
+        @functools.wraps(attr)
+        async def method(*args, **kwargs):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(executor, functools.partial(attr, *args, **kwargs))
+
+        # Кэшируем обертку, чтобы не создавать ее на каждый вызов
+        setattr(self, name, method)
+        return method
+
+    def close(self):
+        """Завершение потоков и закрытие соединений"""
+        self._readers.shutdown(wait=True)
+        self._writer.shutdown(wait=True)
+        self.sync.close()
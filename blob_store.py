@@ -0,0 +1,212 @@
+# blob_store.py
+"""Хранилище файлов NFT по содержимому (SHA-256).
+
+Файл лежит один раз по пути BLOB_FOLDER/ab/cd/<sha256>, сколько бы NFT
+на него ни ссылалось. Загрузка пишется во временный файл и атомарно
+переименовывается на место, так что недокачанный файл никогда не виден
+под своим хэшем. Ссылки считаются триггерами на nfts в таблице blobs;
+файлы без ссылок старше BLOB_GC_GRACE удаляются сборкой мусора вместе
+с их миниатюрами. Проверка сборки на временной базе - гонка с повторной
+загрузкой того же файла и удаление миниатюр:
+
+    python blob_store.py gc --db nft_market.db
+    python blob_store.py check
+"""
+import argparse
+import hashlib
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+from config import BLOB_FOLDER, BLOB_GC_GRACE
+
+logging.basicConfig(level=logging.INFO)
+
+class BlobStore:
+    """Файлы по SHA-256 с шардированием каталогов"""
+
+    def __init__(self, root=BLOB_FOLDER):
+        self.root = root
+        self.tmp_dir = os.path.join(root, 'tmp')
+
+    def path_for(self, content_hash):
+        """Путь файла по хэшу: два уровня каталогов, чтобы не было
+        сотен тысяч файлов в одной папке"""
+        return os.path.join(self.root, content_hash[:2], content_hash[2:4], content_hash)
+
+    def exists(self, content_hash):
+        return os.path.exists(self.path_for(content_hash))
+
+    def temp_path(self):
+        """Временный файл для записи (на том же разделе, что и хранилище)"""
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        return os.path.join(self.tmp_dir, f"{uuid.uuid4().hex}.part")
+
+    def commit(self, temp_path, content_hash):
+        """Перенос дописанного файла на место, возвращает итоговый путь.
+
+        Если такой файл уже есть, временный просто удаляется.
+        """
+        path = self.path_for(content_hash)
+        if os.path.exists(path):
+            self._remove(temp_path)
+            return path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(temp_path, path)
+        return path
+
+    def delete(self, content_hash):
+        self._remove(self.path_for(content_hash))
+
+    def collect_garbage(self, db, grace=BLOB_GC_GRACE, batch_size=500, previews=None):
+        """Удаление файлов без ссылок из nfts, возвращает их число.
+
+        Свежие файлы (моложе grace секунд) не трогаем: NFT для только что
+        скачанного файла может быть еще не создан. Повторная загрузка
+        учитывает файл (register_blob) до того, как кладет его на место,
+        поэтому удаление не может пройти между ними. С previews
+        (PreviewCache) удаляются и миниатюры файла.
+        """
+        def remove_file(content_hash):
+            self.delete(content_hash)
+            if previews is not None:
+                previews.delete(content_hash)
+
+        removed = 0
+        while True:
+            hashes = db.get_unreferenced_blobs(grace, batch_size)
+            if not hashes:
+                break
+            for content_hash in hashes:
+                # Строка удаляется, только если ссылок так и не появилось
+                if db.delete_unreferenced_blob(content_hash, grace, remove_file):
+                    removed += 1
+            if len(hashes) < batch_size:
+                break
+
+        self._sweep_temp(grace)
+        return removed
+
+    def _sweep_temp(self, grace):
+        """Удаление временных файлов оборванных загрузок"""
+        if not os.path.isdir(self.tmp_dir):
+            return
+        deadline = time.time() - grace
+        for entry in os.scandir(self.tmp_dir):
+            if entry.is_file() and entry.stat().st_mtime < deadline:
+                self._remove(entry.path)
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def _write(store, content):
+    """Загрузка content в хранилище, как у DownloadQueue; возвращает хэш"""
+    content_hash = hashlib.sha256(content).hexdigest()
+    path = store.temp_path()
+    with open(path, 'wb') as f:
+        f.write(content)
+    store.commit(path, content_hash)
+    return content_hash
+
+def check(grace=60):
+    """Проблемы сборки мусора (пустой список - все в порядке)"""
+    from database import Database
+    from previews import PreviewCache
+
+    def age(db):
+        # Файлы "загружены" раньше grace
+        with db.get_connection() as conn:
+            conn.execute("UPDATE blobs SET created_at = datetime('now', '-1 day')")
+
+    def has_row(db, content_hash):
+        with db.get_connection() as conn:
+            return conn.execute('SELECT 1 FROM blobs WHERE content_hash = ?', (content_hash,)).fetchone()
+
+    problems = []
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, 'blobs.db'))
+        store = BlobStore(os.path.join(tmp, 'blobs'))
+        previews = PreviewCache(os.path.join(tmp, 'previews'), store)
+        try:
+            content = b'nft file'
+            content_hash = _write(store, content)
+            db.register_blob(content_hash, len(content))
+            age(db)
+            preview = previews.path_for(content_hash, 'thumb', 'webp')
+            os.makedirs(os.path.dirname(preview), exist_ok=True)
+            with open(preview, 'wb') as f:
+                f.write(b'preview')
+
+            # Файл без ссылок удаляется медленно; та же загрузка приходит,
+            # пока сборка держит транзакцию
+            def slow_delete(content_hash):
+                time.sleep(0.5)
+                store.delete(content_hash)
+                previews.delete(content_hash)
+
+            def upload_again():
+                time.sleep(0.2)
+                db.register_blob(content_hash, len(content))
+                _write(store, content)
+
+            uploader = threading.Thread(target=upload_again)
+            uploader.start()
+            deleted = db.delete_unreferenced_blob(content_hash, grace, slow_delete)
+            uploader.join()
+            if not deleted:
+                problems.append('unreferenced blob was not collected')
+            if not store.exists(content_hash) or not has_row(db, content_hash):
+                problems.append('re-uploaded blob lost its file or its row')
+            if os.path.exists(preview):
+                problems.append('preview outlived its blob')
+
+            # Без новой загрузки файл и его миниатюры уходят
+            with open(preview, 'wb') as f:
+                f.write(b'preview')
+            age(db)
+            if store.collect_garbage(db, grace, previews=previews) != 1 or store.exists(content_hash) \
+                    or os.path.exists(preview):
+                problems.append('collect_garbage left the file or its preview')
+        finally:
+            previews.close()
+            db.close()
+    return problems
+
+def main(argv=None):
+    from database import Database
+    from previews import PreviewCache
+
+    parser = argparse.ArgumentParser(description='Хранилище файлов NFT')
+    parser.add_argument('command', choices=['gc', 'check'])
+    parser.add_argument('--grace', type=int, default=BLOB_GC_GRACE, help='Секунды, в течение которых файл без ссылок не удаляется')
+    parser.add_argument('--db', default='nft_market.db')
+    args = parser.parse_args(argv)
+
+    if args.command == 'check':
+        problems = check()
+        for problem in problems:
+            print(f"❌ {problem}")
+        if not problems:
+            print("✅ re-upload during collection keeps its file, previews go with their blob")
+        return 0 if not problems else 1
+
+    db = Database(args.db)
+    store = BlobStore()
+    try:
+        removed = store.collect_garbage(db, args.grace, previews=PreviewCache(store=store))
+    finally:
+        db.close()
+
+    print(f"✅ Удалено файлов: {removed}")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
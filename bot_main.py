@@ -1,17 +1,22 @@
 # bot_main.py
 import asyncio
+import functools
 import logging
 from aiogram import Bot, Dispatcher, types
 from aiogram.contrib.middlewares.logging import LoggingMiddleware
 from aiogram.types import ParseMode, InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.utils import executor
-from flask import Flask, request, jsonify
+from aiohttp import web
 import requests
 from datetime import datetime
 import json
 
-from config import BOT_MAIN_TOKEN, WEBHOOK_URL, ADMIN_IDS
-from database import Database
+from config import BOT_MAIN_TOKEN, WEBHOOK_URL, WEBHOOK_PATH, ADMIN_IDS
+from async_database import AsyncDatabase
+from media import NFTMedia, MEDIA_GROUP_LIMIT
+from outbound import OutboundQueue
+from outbox import SIGNATURE_HEADER, verify_signature
+from webhook import RecentIds, run_webhook
 
 logging.basicConfig(level=logging.INFO)
 
@@ -19,7 +24,19 @@ bot = Bot(token=BOT_MAIN_TOKEN, parse_mode=ParseMode.HTML)
 dp = Dispatcher(bot)
 dp.middleware.setup(LoggingMiddleware())
 
-db = Database()
+db = AsyncDatabase()
+
+# Все исходящие уведомления идут через очередь с лимитами Telegram
+outbound = OutboundQueue(bot)
+
+# Файлы NFT отправляются по file_id этого бота (кэш в bot_file_ids)
+media = NFTMedia(bot, db, outbound)
+
+# HTTP-маршруты рядом с вебхуком
+routes = web.RouteTableDef()
+
+# Уже обработанные события outbox (доставка идет как минимум один раз)
+seen_events = RecentIds()
 
 # Клавиатуры
 def get_main_keyboard():
@@ -41,7 +58,13 @@ async def start_command(message: types.Message):
     username = message.from_user.username
     
     # Регистрация пользователя
-    db.add_user(user_id, username)
+    await db.add_user(user_id, username)
+    
+    # Переход из результата inline-поиска: /start nft_<id>
+    args = message.get_args()
+    if args.startswith('nft_') and args[4:].isdigit():
+        await send_nft_card(message.chat.id, int(args[4:]))
+        return
     
     welcome_text = f"""
 🎨 <b>Добро пожаловать в NFT Маркет!</b>
@@ -61,24 +84,39 @@ async def start_command(message: types.Message):
     
     await message.answer(welcome_text, reply_markup=get_main_keyboard())
 
+@dp.message_handler(commands=['broadcast'])
+async def broadcast_command(message: types.Message):
+    """Рассылка всем пользователям (только для администраторов)"""
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    
+    text = message.get_args()
+    if not text:
+        await message.answer("❌ Укажите текст: /broadcast Текст рассылки")
+        return
+    
+    chat_ids = await db.get_user_telegram_ids()
+    count = outbound.broadcast(chat_ids, text)
+    await message.answer(f"📣 Рассылка поставлена в очередь: {count} сообщений")
+
 @dp.message_handler()
 async def handle_message(message: types.Message):
     """Обработка текстовых сообщений"""
     user_id = message.from_user.id
     
     # Проверяем, ожидает ли пользователь ввод кода передачи
-    state = db.get_user_state(user_id)
+    state = await db.get_user_state(user_id)
     
     if state and state['action'] == 'waiting_transfer_code':
         transfer_code = message.text.strip()
         
         # Проверяем код в базе
-        transfer = db.get_transfer_by_code(transfer_code)
+        transfer = await db.get_transfer_by_code(transfer_code)
         
         if transfer and transfer['status'] == 'pending':
             # Привязываем NFT к пользователю
             nft_id = transfer['nft_id']
-            success = db.complete_transfer(nft_id, user_id)
+            success = await db.complete_transfer(nft_id, user_id, transfer_code)
             
             if success:
                 await message.answer(
@@ -88,7 +126,7 @@ async def handle_message(message: types.Message):
                 )
                 
                 # Уведомляем отправителя
-                await bot.send_message(
+                outbound.send_message(
                     transfer['from_user_id'],
                     f"✅ Пользователь @{message.from_user.username} получил ваш NFT!"
                 )
@@ -97,7 +135,7 @@ async def handle_message(message: types.Message):
         else:
             await message.answer("❌ Недействительный код передачи")
         
-        db.clear_user_state(user_id)
+        await db.clear_user_state(user_id)
         return
     
     # Обработка других команд
@@ -106,13 +144,18 @@ async def handle_message(message: types.Message):
 @dp.callback_query_handler(lambda c: c.data == 'market')
 async def show_market(callback_query: types.CallbackQuery):
     """Показывает маркет NFT"""
-    page = 1
-    await show_market_page(callback_query, page)
+    await show_market_page(callback_query)
+
+@dp.callback_query_handler(lambda c: c.data.startswith('market_page_'))
+async def show_market_next_page(callback_query: types.CallbackQuery):
+    """Переход между страницами маркета"""
+    cursor = callback_query.data[len('market_page_'):]
+    await show_market_page(callback_query, cursor)
 
-async def show_market_page(callback_query: types.CallbackQuery, page: int):
+async def show_market_page(callback_query: types.CallbackQuery, cursor: str = None):
     """Показывает страницу маркета"""
-    nfts = db.get_active_sales(page=page, per_page=6)
-    total_pages = db.get_total_pages()
+    page = await db.get_active_sales(per_page=6, cursor=cursor)
+    nfts = page['items']
     
     if not nfts:
         await callback_query.message.edit_text(
@@ -124,14 +167,13 @@ async def show_market_page(callback_query: types.CallbackQuery, page: int):
         )
         return
     
-    text = f"🛍 <b>Маркет NFT</b> (Страница {page}/{total_pages})\n\n"
+    text = f"🛍 <b>Маркет NFT</b> (лотов: {page['total']})\n\n"
     keyboard = InlineKeyboardMarkup(row_width=2)
     
     for nft in nfts:
-        user = db.get_user_by_id(nft['user_id'])
         text += f"🖼 <b>{nft['title'] or nft['file_name']}</b>\n"
         text += f"💰 Цена: {nft['price']} ⭐️\n"
-        text += f"👤 Продавец: @{user['username'] or 'Аноним'}\n"
+        text += f"👤 Продавец: @{nft['seller_username'] or 'Аноним'}\n"
         text += f"👀 Просмотров: {nft['views']}\n"
         text += f"🆔 ID: {nft['id']}\n"
         text += "➖➖➖➖➖➖➖\n"
@@ -143,29 +185,71 @@ async def show_market_page(callback_query: types.CallbackQuery, page: int):
     
     # Пагинация
     nav_buttons = []
-    if page > 1:
-        nav_buttons.append(InlineKeyboardButton("⬅️", callback_data=f"market_page_{page-1}"))
-    if page < total_pages:
-        nav_buttons.append(InlineKeyboardButton("➡️", callback_data=f"market_page_{page+1}"))
+    if page['prev_cursor']:
+        nav_buttons.append(InlineKeyboardButton("⬅️", callback_data=f"market_page_{page['prev_cursor']}"))
+    if page['next_cursor']:
+        nav_buttons.append(InlineKeyboardButton("➡️", callback_data=f"market_page_{page['next_cursor']}"))
     
     if nav_buttons:
         keyboard.row(*nav_buttons)
     
+    keyboard.add(InlineKeyboardButton("🖼 Галерея", callback_data=f"market_gallery_{cursor or ''}"))
     keyboard.add(InlineKeyboardButton("🏠 Главное меню", callback_data="back_to_main"))
     
     await callback_query.message.edit_text(text, reply_markup=keyboard)
 
+@dp.callback_query_handler(lambda c: c.data.startswith('market_gallery_'))
+async def show_market_gallery(callback_query: types.CallbackQuery):
+    """Галерея маркета: до 10 лотов одним альбомом"""
+    cursor = callback_query.data[len('market_gallery_'):] or None
+    page = await db.get_active_sales(per_page=MEDIA_GROUP_LIMIT, cursor=cursor)
+    nfts = page['items']
+    chat_id = callback_query.message.chat.id
+    
+    if not nfts:
+        await callback_query.answer("📭 Маркет пуст")
+        return
+    
+    await callback_query.answer()
+    shown = await media.send_gallery(chat_id, nfts)
+    
+    # Документы в альбом не попадают - перечисляем их текстом
+    text = "🖼 <b>Галерея маркета</b>\n\n"
+    for nft in nfts:
+        if nft not in shown:
+            text += f"📄 <b>{nft['title'] or nft['file_name']}</b> — {nft['price']} ⭐️ (#{nft['id']})\n"
+    text += "Выберите лот:"
+    
+    keyboard = InlineKeyboardMarkup(row_width=2)
+    for nft in nfts:
+        keyboard.add(
+            InlineKeyboardButton(f"👀 Смотреть #{nft['id']}", callback_data=f"view_{nft['id']}"),
+            InlineKeyboardButton(f"💰 Купить", callback_data=f"buy_{nft['id']}")
+        )
+    if page['next_cursor']:
+        keyboard.add(InlineKeyboardButton("➡️ Дальше", callback_data=f"market_gallery_{page['next_cursor']}"))
+    keyboard.add(InlineKeyboardButton("🏠 Главное меню", callback_data="back_to_main"))
+    
+    await outbound.send('send_message', chat_id, text=text, reply_markup=keyboard)
+
 @dp.callback_query_handler(lambda c: c.data.startswith('view_'))
 async def view_nft(callback_query: types.CallbackQuery):
     """Просмотр NFT"""
     nft_id = int(callback_query.data.split('_')[1])
-    user_id = callback_query.from_user.id
     
+    await send_nft_card(callback_query.message.chat.id, nft_id)
+    
+    await callback_query.answer()
+
+async def send_nft_card(chat_id, nft_id):
+    """Карточка NFT с файлом и кнопкой покупки"""
     # Увеличиваем счетчик просмотров
-    db.increment_views(nft_id)
+    db.sync.increment_views(nft_id)  # только буфер в памяти, без запроса к базе
     
-    nft = db.get_nft_by_id(nft_id)
-    seller = db.get_user_by_id(nft['user_id'])
+    nft = await db.get_nft_by_id(nft_id)
+    if not nft:
+        await outbound.send('send_message', chat_id, text="❌ NFT не найден")
+        return
     
     text = f"""
 🖼 <b>{nft['title'] or nft['file_name']}</b>
@@ -174,9 +258,9 @@ async def view_nft(callback_query: types.CallbackQuery):
 {nft['description'] or 'Нет описания'}
 
 💰 <b>Цена:</b> {nft['price']} ⭐️
-👤 <b>Продавец:</b> @{seller['username'] or 'Аноним'}
+👤 <b>Продавец:</b> @{nft['seller_username'] or 'Аноним'}
 📅 <b>Дата:</b> {nft['created_at']}
-👀 <b>Просмотров:</b> {nft['views'] + 1}
+👀 <b>Просмотров:</b> {nft['views']}
     """
     
     keyboard = InlineKeyboardMarkup(row_width=2)
@@ -186,29 +270,40 @@ async def view_nft(callback_query: types.CallbackQuery):
     )
     
     # Отправляем медиа
-    if nft['file_type'] in ['photo', 'image']:
-        await bot.send_photo(
-            callback_query.message.chat.id,
-            nft['file_id'],
-            caption=text,
-            reply_markup=keyboard
-        )
-    elif nft['file_type'] == 'video':
-        await bot.send_video(
-            callback_query.message.chat.id,
-            nft['file_id'],
-            caption=text,
-            reply_markup=keyboard
-        )
-    else:
-        await bot.send_document(
-            callback_query.message.chat.id,
-            nft['file_id'],
-            caption=text,
-            reply_markup=keyboard
+    await media.send(chat_id, nft, caption=text, reply_markup=keyboard)
+
+@dp.inline_handler()
+async def inline_search(inline_query: types.InlineQuery):
+    """Поиск лотов в inline-режиме: @бот <запрос> в любом чате"""
+    offset = int(inline_query.offset) if inline_query.offset.isdigit() else 0
+    page = await db.search_nfts(inline_query.query, offset=offset)
+    me = await bot.me
+    
+    results = []
+    for nft in page['items']:
+        title = nft['title'] or nft['file_name']
+        text = (
+            f"🖼 <b>{title}</b>\n"
+            f"💰 Цена: {nft['price']} ⭐️\n"
+            f"👤 Продавец: @{nft['seller_username'] or 'Аноним'}"
         )
+        results.append(types.InlineQueryResultArticle(
+            id=str(nft['id']),
+            title=f"{title} — {nft['price']} ⭐️",
+            description=nft['description'] or f"Продавец: @{nft['seller_username'] or 'Аноним'}",
+            thumb_url=f"{WEBHOOK_URL}/media/{nft['content_hash']}/thumb" if nft['content_hash'] else None,
+            input_message_content=types.InputTextMessageContent(text),
+            reply_markup=InlineKeyboardMarkup().add(
+                InlineKeyboardButton("👀 Смотреть в маркете", url=f"https://t.me/{me.username}?start=nft_{nft['id']}")
+            )
+        ))
     
-    await callback_query.answer()
+    # Выдача одинакова для всех пользователей - Telegram может кэшировать ее
+    await inline_query.answer(
+        results,
+        cache_time=30,
+        next_offset=str(page['next_offset']) if page['next_offset'] is not None else ''
+    )
 
 @dp.callback_query_handler(lambda c: c.data == 'transfer_menu')
 async def transfer_menu(callback_query: types.CallbackQuery):
@@ -243,7 +338,7 @@ async def transfer_menu(callback_query: types.CallbackQuery):
 async def initiate_transfer(callback_query: types.CallbackQuery):
     """Инициирование передачи NFT"""
     user_id = callback_query.from_user.id
-    nfts = db.get_user_nfts(user_id, status='owned')
+    nfts = await db.get_user_nfts(user_id, status='owned')
     
     if not nfts:
         await callback_query.answer("У вас нет NFT для передачи", show_alert=True)
@@ -264,36 +359,68 @@ async def initiate_transfer(callback_query: types.CallbackQuery):
     
     await callback_query.message.edit_text(text, reply_markup=keyboard)
 
-# Webhook для связи с сайтом
-@app.route('/webhook', methods=['POST'])
-def webhook():
-    """Получение обновлений от Telegram"""
-    update = types.Update.de_json(request.get_json(), bot)
-    dp.process_update(update)
-    return 'ok', 200
+def signed(handler):
+    """Пропускает только запросы, подписанные общим с сайтом секретом"""
+    @functools.wraps(handler)
+    async def wrapper(request):
+        body = await request.read()  # aiohttp кэширует тело, хендлер прочитает его снова
+        if not verify_signature(body, request.headers.get(SIGNATURE_HEADER)):
+            return web.Response(status=403)
+        return await handler(request)
+    return wrapper
 
-@app.route('/api/transfer_nft', methods=['POST'])
-def api_transfer_nft():
+# События с сайта (outbox.OutboxDispatcher)
+@routes.post('/api/notifications')
+@signed
+async def api_notifications(request):
+    """Уведомления о продажах и передачах"""
+    data = json.loads(await request.read())
+    
+    for event in data.get('events', []):
+        if event['id'] in seen_events:
+            continue
+        payload = event['payload']
+        
+        if event['topic'] == 'sale':
+            seller = await db.get_user_by_id(payload['seller_id'])
+            if seller:
+                outbound.send_message(
+                    seller['telegram_id'],
+                    f"💰 Ваш NFT #{payload['nft_id']} продан за {payload['amount']} ⭐️"
+                )
+        elif event['topic'] == 'transfer':
+            recipient = await db.get_user_by_id(payload['to_user'])
+            if recipient:
+                outbound.send_message(
+                    recipient['telegram_id'],
+                    f"🎁 Вам передают NFT!\n\nКод получения: <code>{payload['code']}</code>"
+                )
+        
+        seen_events.add(event['id'])
+    
+    return web.json_response({'success': True})
+
+@routes.post('/api/transfer_nft')
+@signed
+async def api_transfer_nft(request):
     """API для передачи NFT через сайт"""
-    data = request.json
+    data = await request.json()
     nft_id = data.get('nft_id')
     to_user_id = data.get('to_user_id')
     
     # Создаем запрос на передачу
-    transfer_code = db.create_transfer_request(nft_id, to_user_id)
+    transfer_code = await db.issue_transfer_code(nft_id, to_user_id)
     
-    return jsonify({
+    return web.json_response({
         'success': True,
         'transfer_code': transfer_code,
         'message': 'Код передачи создан'
     })
 
+async def close_services(app):
+    await outbound.close()
+    db.close()
+
 if __name__ == '__main__':
-    from flask import Flask
-    app = Flask(__name__)
-    
-    # Устанавливаем webhook
-    bot.set_webhook(f"{WEBHOOK_URL}{WEBHOOK_PATH}")
-    
-    # Запускаем Flask приложение
-    app.run(host='0.0.0.0', port=5000)
\ No newline at end of file
+    # Вебхук и API на aiohttp, апдейты обрабатываются пулом воркеров
+    run_webhook(dp, WEBHOOK_PATH, 5000, routes, on_cleanup=[close_services])
\ No newline at end of file
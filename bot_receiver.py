@@ -3,15 +3,17 @@ import logging
 from aiogram import Bot, Dispatcher, types
 from aiogram.contrib.middlewares.logging import LoggingMiddleware
 from aiogram.types import ParseMode, InlineKeyboardMarkup, InlineKeyboardButton
-from aiogram.utils import executor
-from flask import Flask, request, jsonify
-import uuid
-from datetime import datetime, timedelta
-import os
-import aiohttp
+from aiohttp import web
+from datetime import datetime
 
-from config import BOT_RECEIVER_TOKEN, WEBHOOK_URL, UPLOAD_FOLDER
-from database import Database
+from config import BOT_RECEIVER_TOKEN, WEBHOOK_RECEIVER_PATH
+from async_database import AsyncDatabase
+from sessions import PersistentSessionStore
+from downloads import DownloadQueue
+from previews import PreviewCache
+from transfers import TransferReaper
+from outbound import OutboundQueue
+from webhook import run_webhook
 
 logging.basicConfig(level=logging.INFO)
 
@@ -19,10 +21,45 @@ bot = Bot(token=BOT_RECEIVER_TOKEN, parse_mode=ParseMode.HTML)
 dp = Dispatcher(bot)
 dp.middleware.setup(LoggingMiddleware())
 
-db = Database()
+db = AsyncDatabase()
 
-# Хранилище временных данных пользователей
-user_sessions = {}
+# Исходящие сообщения с учетом лимитов Telegram
+outbound = OutboundQueue(bot)
+
+# HTTP-маршруты рядом с вебхуком
+routes = web.RouteTableDef()
+
+# Просроченные коды передачи помечаются и архивируются в фоне
+transfer_reaper = TransferReaper(db.sync)
+transfer_reaper.start()
+
+# Сессии мастера загрузки (хранятся в upload_sessions, переживают перезапуск)
+user_sessions = PersistentSessionStore(db)
+
+async def get_telegram_file_path(file_id: str) -> str:
+    """Путь файла в Bot API"""
+    file = await bot.get_file(file_id)
+    return file.file_path
+
+async def on_download_complete(job):
+    """Файл скачан (и учтен в хранилище): проставляем путь NFT, если он уже создан"""
+    # Миниатюры для маркета готовим заранее, в фоне
+    previews.warm(job.sha256)
+    if await db.set_nft_file_path(job.file_id, job.file_path, job.sha256):
+        downloads.forget(job.id)
+
+# Файлы скачиваются в фоне, не задерживая ответ пользователю
+downloads = DownloadQueue(BOT_RECEIVER_TOKEN, get_telegram_file_path, on_download_complete,
+                          register=db.register_blob)
+previews = PreviewCache()
+
+async def is_waiting_for_input(message: types.Message) -> bool:
+    """Проверка, ожидает ли пользователь ввод"""
+    return await user_sessions.find_by_user(message.from_user.id) is not None
+
+async def find_user_session(user_id: int) -> str:
+    """Поиск сессии пользователя"""
+    return await user_sessions.find_by_user(user_id)
 
 @dp.message_handler(commands=['start'])
 async def start_command(message: types.Message):
@@ -62,54 +99,59 @@ async def get_nft_command(message: types.Message):
     transfer_code = args.strip().upper()
     
     # Ищем код в базе
-    transfer = db.get_transfer_by_code(transfer_code)
+    transfer = await db.get_transfer_by_code(transfer_code)
     
     if not transfer:
         await message.answer("❌ Код не найден")
         return
     
-    if transfer['status'] != 'pending':
-        await message.answer("❌ Код уже использован или истек")
+    # Просроченный код приходит из базы уже со статусом expired
+    if transfer['status'] == 'expired':
+        await message.answer("❌ Срок действия кода истек")
         return
     
-    if datetime.now() > transfer['expires_at']:
-        await message.answer("❌ Срок действия кода истек")
-        db.update_transfer_status(transfer_code, 'expired')
+    if transfer['status'] != 'pending':
+        await message.answer("❌ Код уже использован или истек")
         return
     
     # Получаем NFT
-    nft = db.get_nft_by_id(transfer['nft_id'])
+    nft = await db.get_nft_by_id(transfer['nft_id'])
     
     if not nft:
         await message.answer("❌ NFT не найден")
         return
     
+    # Сначала занимаем код: из одновременных /get пройдет только один
+    if not await db.complete_transfer(transfer['nft_id'], message.from_user.id, transfer_code):
+        await message.answer("❌ Код уже использован или истек")
+        return
+    
     # Отправляем файл
     try:
         if nft['file_type'] in ['photo', 'image']:
-            await bot.send_photo(
+            await outbound.send(
+                'send_photo',
                 message.chat.id,
-                nft['file_id'],
+                photo=nft['file_id'],
                 caption=f"🎨 <b>NFT получен!</b>\n\n{nft['title'] or ''}\n{nft['description'] or ''}"
             )
         elif nft['file_type'] == 'video':
-            await bot.send_video(
+            await outbound.send(
+                'send_video',
                 message.chat.id,
-                nft['file_id'],
+                video=nft['file_id'],
                 caption=f"🎨 <b>NFT получен!</b>\n\n{nft['title'] or ''}\n{nft['description'] or ''}"
             )
         else:
-            await bot.send_document(
+            await outbound.send(
+                'send_document',
                 message.chat.id,
-                nft['file_id'],
+                document=nft['file_id'],
                 caption=f"🎨 <b>NFT получен!</b>\n\n{nft['title'] or ''}\n{nft['description'] or ''}"
             )
         
-        # Обновляем статус передачи
-        db.complete_transfer(transfer['nft_id'], message.from_user.id, transfer_code)
-        
         # Уведомляем отправителя
-        await bot.send_message(
+        outbound.send_message(
             transfer['from_user_id'],
             f"✅ Ваш NFT был получен пользователем @{message.from_user.username}"
         )
@@ -131,12 +173,10 @@ async def handle_nft_upload(message: types.Message):
         return
     
     # Сохраняем сессию
-    session_id = str(uuid.uuid4())[:8]
-    user_sessions[session_id] = {
-        'user_id': user_id,
+    session_id = user_sessions.create(user_id, {
         'file_info': file_info,
         'step': 'waiting_title'
-    }
+    })
     
     # Запрашиваем название
     text = f"""
@@ -156,25 +196,28 @@ async def handle_nft_upload(message: types.Message):
     await message.answer(text, reply_markup=keyboard)
     
     # Сохраняем ID сообщения для редактирования
-    user_sessions[session_id]['message_id'] = message.message_id + 1
+    user_sessions.get(session_id)['message_id'] = message.message_id + 1
+    user_sessions.save(session_id)
+    await user_sessions.flush()
 
-@dp.message_handler(lambda message: is_waiting_for_input(message.from_user.id))
+@dp.message_handler(is_waiting_for_input)
 async def handle_text_input(message: types.Message):
     """Обработка текстового ввода"""
     user_id = message.from_user.id
     
     # Находим сессию пользователя
-    session_id = find_user_session(user_id)
+    session_id = await find_user_session(user_id)
     
     if not session_id:
         return
     
-    session = user_sessions[session_id]
+    session = user_sessions.get(session_id)
     
     if session['step'] == 'waiting_title':
         # Сохраняем название
         session['title'] = message.text
         session['step'] = 'waiting_description'
+        user_sessions.save(session_id)
         
         await message.answer(
             "📝 Теперь укажите <b>описание</b> NFT:\n"
@@ -185,6 +228,7 @@ async def handle_text_input(message: types.Message):
         # Сохраняем описание
         session['description'] = message.text
         session['step'] = 'waiting_price'
+        user_sessions.save(session_id)
         
         await message.answer(
             "💰 Укажите <b>цену</b> в Stars:\n"
@@ -199,12 +243,14 @@ async def handle_text_input(message: types.Message):
             
             session['price'] = price
             
-            # Создаем NFT в базе
+            # Создаем NFT в базе (файл может быть еще не скачан)
+            download = downloads.result(session['file_info']['file_id'])
             nft_data = {
                 'user_id': user_id,
                 'file_id': session['file_info']['file_id'],
                 'file_name': session['file_info']['file_name'],
-                'file_path': session['file_info']['file_path'],
+                'file_path': download.file_path if download else None,
+                'content_hash': download.sha256 if download else None,
                 'file_size': session['file_info']['file_size'],
                 'file_type': session['file_info']['file_type'],
                 'title': session.get('title', ''),
@@ -213,14 +259,12 @@ async def handle_text_input(message: types.Message):
                 'status': 'pending'
             }
             
-            nft_id = db.add_nft(nft_data)
-            
-            # Генерируем код передачи
-            transfer_code = generate_transfer_code()
-            expires_at = datetime.now() + timedelta(hours=24)
+            nft_id = await db.add_nft(nft_data)
+            if download:
+                downloads.forget(download.id)
             
-            # Создаем запрос на передачу
-            db.create_transfer_request(nft_id, user_id, transfer_code, expires_at)
+            # Создаем запрос на передачу с новым кодом
+            transfer_code = await db.issue_transfer_code(nft_id, user_id)
             
             # Отправляем код пользователю
             text = f"""
@@ -245,18 +289,23 @@ async def handle_text_input(message: types.Message):
             await message.answer(text, reply_markup=keyboard)
             
             # Очищаем сессию
-            del user_sessions[session_id]
+            await user_sessions.delete(session_id, user_id)
             
         except ValueError:
             await message.answer("❌ Укажите корректное число (например: 100)")
+    
+    # Все изменения сессии за хендлер - одной записью
+    await user_sessions.flush()
 
 @dp.callback_query_handler(lambda c: c.data.startswith('cancel_'))
 async def cancel_session(callback_query: types.CallbackQuery):
     """Отмена сессии"""
     session_id = callback_query.data.split('_')[1]
     
-    if session_id in user_sessions:
-        del user_sessions[session_id]
+    session = user_sessions.get(session_id)
+    if session:
+        downloads.forget(session['file_info'].get('download_id'))
+    await user_sessions.delete(session_id, callback_query.from_user.id)
     
     await callback_query.message.edit_text(
         "❌ Операция отменена",
@@ -295,93 +344,46 @@ async def extract_file_info(message: types.Message):
         else:
             return None
         
-        # Скачиваем файл
-        file_path = await download_file(file_id, file_name)
+        # Ставим файл в очередь загрузки, путь появится по ее окончании
+        download_id = downloads.submit(message.from_user.id, file_id, file_name, file_size)
         
         return {
             'file_id': file_id,
             'file_name': file_name,
             'file_type': file_type,
             'file_size': file_size,
-            'file_path': file_path
+            'file_path': None,
+            'download_id': download_id
         }
     except Exception as e:
         logging.error(f"Error extracting file info: {e}")
         return None
 
-async def download_file(file_id: str, file_name: str) -> str:
-    """Скачивание файла с Telegram"""
-    file = await bot.get_file(file_id)
-    file_path = file.file_path
-    
-    # Создаем папку если её нет
-    os.makedirs(UPLOAD_FOLDER, exist_ok=True)
-    
-    # Генерируем уникальное имя
-    unique_name = f"{uuid.uuid4()}_{file_name}"
-    local_path = os.path.join(UPLOAD_FOLDER, unique_name)
-    
-    # Скачиваем файл
-    await bot.download_file(file_path, local_path)
-    
-    return local_path
-
-def generate_transfer_code() -> str:
-    """Генерация уникального кода передачи"""
-    import random
-    import string
-    
-    while True:
-        code = ''.join(random.choices(string.ascii_uppercase + string.digits, k=8))
-        if not db.check_transfer_code_exists(code):
-            return code
-
-def is_waiting_for_input(user_id: int) -> bool:
-    """Проверка, ожидает ли пользователь ввод"""
-    for session in user_sessions.values():
-        if session['user_id'] == user_id:
-            return True
-    return False
-
-def find_user_session(user_id: int) -> str:
-    """Поиск сессии пользователя"""
-    for session_id, session in user_sessions.items():
-        if session['user_id'] == user_id:
-            return session_id
-    return None
-
-# Webhook для связи с основным ботом
-@app.route('/webhook_receiver', methods=['POST'])
-def webhook_receiver():
-    """Получение обновлений от Telegram"""
-    update = types.Update.de_json(request.get_json(), bot)
-    dp.process_update(update)
-    return 'ok', 200
-
-@app.route('/api/transfer_status/<code>', methods=['GET'])
-def get_transfer_status(code):
+@routes.get('/api/transfer_status/{code}')
+async def get_transfer_status(request):
     """API для проверки статуса передачи"""
-    transfer = db.get_transfer_by_code(code)
+    transfer = await db.get_transfer_by_code(request.match_info['code'])
     
     if transfer:
-        return jsonify({
+        return web.json_response({
             'success': True,
             'status': transfer['status'],
             'nft_id': transfer['nft_id'],
-            'expires_at': transfer['expires_at'].isoformat()
+            'expires_at': transfer['expires_at']
         })
     else:
-        return jsonify({
+        return web.json_response({
             'success': False,
             'message': 'Transfer code not found'
-        }), 404
+        }, status=404)
+
+async def close_services(app):
+    transfer_reaper.stop()
+    await downloads.close()
+    await outbound.close()
+    previews.close()
+    db.close()
 
 if __name__ == '__main__':
-    from flask import Flask
-    app = Flask(__name__)
-    
-    # Устанавливаем webhook
-    bot.set_webhook(f"{WEBHOOK_URL}{WEBHOOK_RECEIVER_PATH}")
-    
-    # Запускаем Flask приложение
-    app.run(host='0.0.0.0', port=5001)
\ No newline at end of file
+    # Вебхук и API на aiohttp, апдейты обрабатываются пулом воркеров
+    run_webhook(dp, WEBHOOK_RECEIVER_PATH, 5001, routes, on_cleanup=[close_services])
\ No newline at end of file
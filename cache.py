@@ -0,0 +1,298 @@
+# cache.py
+"""Read-through кэш листингов с версией (память процесса или Redis).
+
+Версия листингов хранится в базе (counters.listing_version) и меняется
+триггерами в транзакции каждой записи лота, поэтому изменения из ботов
+и из сайта видят кэши всех процессов. Проверка обоих бэкендов (Redis -
+на локальном фейке с тем же протоколом get/set(ex)/incr, что у
+redis-py) и кэшей двух процессов над одной базой:
+
+    python cache.py check
+"""
+import argparse
+import pickle
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+from config import CACHE_BACKEND, REDIS_URL, CACHE_TTL, CACHE_MAX_SIZE
+
+VERSION_KEY = 'nft_market:listing_version'
+KEY_PREFIX = 'nft_market:'
+
+# Общая версия листингов (триггеры миграции 12 в migrations.py)
+LISTING_VERSION_QUERY = "SELECT value FROM counters WHERE name = 'listing_version'"
+
+class MemoryBackend:
+    """LRU-кэш в памяти процесса с TTL"""
+
+    def __init__(self, max_size=CACHE_MAX_SIZE):
+        self.max_size = max_size
+        self._data = OrderedDict()
+        # Счетчики (версия) хранятся отдельно и не вытесняются
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            value, expires_at = item
+            if expires_at is not None and expires_at < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.monotonic() + ttl if ttl else None
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def get_counter(self, key):
+        return self._counters.get(key, 0)
+
+    def incr(self, key):
+        with self._lock:
+            value = self._counters.get(key, 0) + 1
+            self._counters[key] = value
+            return value
+
+class RedisBackend:
+    """Кэш в Redis (общий для всех процессов)"""
+
+    def __init__(self, client=None, url=REDIS_URL):
+        if client is None:
+            import redis
+            client = redis.Redis.from_url(url)
+        self.client = client
+
+    def get(self, key):
+        raw = self.client.get(key)
+        return pickle.loads(raw) if raw is not None else None
+
+    def set(self, key, value, ttl=None):
+        self.client.set(key, pickle.dumps(value), ex=ttl)
+
+    def get_counter(self, key):
+        return int(self.client.get(key) or 0)
+
+    def incr(self, key):
+        return self.client.incr(key)
+
+class ListingCache:
+    """Read-through кэш маркета с версией листингов.
+
+    Версия входит в каждый ключ. Любое изменение листингов (новый NFT,
+    передача, покупка) увеличивает версию, и старые страницы больше
+    не читаются - они просто вытесняются по LRU/TTL.
+
+    version - функция, читающая общую версию (см. LISTING_VERSION_QUERY);
+    она вызывается до загрузки страницы, так что страница не бывает
+    старше своей версии. Без нее версия - счетчик в бэкенде, который
+    меняет только bump(): с MemoryBackend это годится лишь для одного
+    процесса.
+    """
+
+    def __init__(self, backend=None, ttl=CACHE_TTL, version=None):
+        self.backend = backend or MemoryBackend()
+        self.ttl = ttl
+        self._version = version
+        self.hits = 0
+        self.misses = 0
+
+    def version(self):
+        """Текущая версия листингов"""
+        if self._version is not None:
+            return self._version()
+        return self.backend.get_counter(VERSION_KEY)
+
+    def bump(self):
+        """Инвалидация всех листингов, если версия - счетчик бэкенда"""
+        return self.backend.incr(VERSION_KEY)
+
+    def get_or_load(self, key, loader):
+        """Значение из кэша или результат loader() с сохранением"""
+        versioned_key = f"{KEY_PREFIX}v{self.version()}:{key}"
+        value = self.backend.get(versioned_key)
+        if value is not None:
+            self.hits += 1
+            return value
+
+        self.misses += 1
+        value = loader()
+        if value is not None:
+            self.backend.set(versioned_key, value, self.ttl)
+        return value
+
+    def stats(self):
+        """Счетчики попаданий и промахов"""
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / total, 3) if total else 0.0,
+            'version': self.version()
+        }
+
+def create_cache(backend=CACHE_BACKEND, version=None):
+    """Кэш по настройкам из config.py с общей версией из version()"""
+    if backend == 'redis':
+        return ListingCache(RedisBackend(), version=version)
+    return ListingCache(MemoryBackend(), version=version)
+
+class FakeRedis:
+    """Локальный фейк redis.Redis: байтовые значения, ex и incr, как у сервера"""
+
+    def __init__(self):
+        self._data = {}  # key -> (bytes, истекает в)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            value, expires_at = item
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._data[key]
+                return None
+            return value
+
+    def set(self, key, value, ex=None):
+        if ex is not None and (not isinstance(ex, int) or ex <= 0):
+            raise ValueError('ex must be a positive integer')  # как redis.DataError
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + ex if ex else None)
+        return True
+
+    def incr(self, key):
+        with self._lock:
+            value, expires_at = self._data.get(key, (b'0', None))
+            value = int(value) + 1
+            self._data[key] = (str(value).encode(), expires_at)
+            return value
+
+def _check_backend(make_cache):
+    """Проблемы кэша из make_cache() (пустой список - все в порядке)"""
+    from records import NFT
+
+    problems = []
+    cache = make_cache()
+    loads = []
+
+    def loader(value):
+        def load():
+            loads.append(value)
+            return value
+        return load
+
+    nft = NFT(id=1, title='Кот', price=10, views=3)
+    first = cache.get_or_load('nft:1', loader({'items': [nft], 'views_mark': 0.0}))
+    again = cache.get_or_load('nft:1', loader(None))
+    if len(loads) != 1 or again['items'][0].title != 'Кот' or again['items'][0].views != 3:
+        problems.append('value is not served from cache after the first load')
+    if first['items'][0] is nft and again['items'][0] is nft and not isinstance(cache.backend, MemoryBackend):
+        problems.append('redis backend returned the same object instead of a copy')
+
+    cache.bump()
+    cache.get_or_load('nft:1', loader({'items': [], 'views_mark': 0.0}))
+    if len(loads) != 2:
+        problems.append('bump() did not invalidate cached listings')
+
+    # Второй процесс с тем же Redis видит инвалидацию первого
+    other = make_cache()
+    if other.backend is not cache.backend and hasattr(cache.backend, 'client'):
+        other.backend.client = cache.backend.client
+        version = other.version()
+        cache.bump()
+        if other.version() != version + 1:
+            problems.append('bump() is not visible to another process')
+
+    cache.get_or_load('ttl', loader('value'))
+    time.sleep(cache.ttl + 0.1)
+    cache.get_or_load('ttl', loader('value'))
+    if loads.count('value') != 2:
+        problems.append('entries do not expire after ttl')
+
+    stats = cache.stats()
+    if stats['hits'] != 1 or stats['misses'] != len(loads):
+        problems.append(f"counters {stats['hits']} hits / {stats['misses']} misses are off")
+    return problems
+
+def _check_processes():
+    """Проблемы кэшей двух процессов над одной базой.
+
+    Процессы - два Database со своими кэшами по умолчанию (в памяти) и
+    своими соединениями: общего у них только файл базы, как у ботов и сайта.
+    """
+    import os
+    import tempfile
+    from database import Database
+
+    problems = []
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'cache.db')
+        writer, reader = Database(path), Database(path)
+        try:
+            seller = writer.add_user(1, 'seller')
+            buyer = writer.add_user(2, 'buyer')
+            nft = {'user_id': seller, 'file_id': 'f1', 'file_name': 'cat.png',
+                   'title': 'Кот', 'price': 10, 'status': 'for_sale'}
+            first_id = writer.add_nft(nft)
+            if [item.id for item in reader.get_active_sales()['items']] != [first_id]:
+                problems.append('market page does not show the first listing')
+
+            second_id = writer.add_nft(dict(nft, file_id='f2', title='Пес'))
+            if [item.id for item in reader.get_active_sales()['items']] != [second_id, first_id]:
+                problems.append('new listing from another process is not visible')
+
+            reader.get_nft_by_id(first_id)
+            writer.complete_transfer(first_id, buyer)
+            if reader.get_nft_by_id(first_id).user_id != buyer:
+                problems.append('transfer from another process is not visible')
+            if [item.id for item in reader.get_active_sales()['items']] != [second_id]:
+                problems.append('market page keeps a transferred listing')
+
+            # Просмотры версию не меняют: страница остается в кэше
+            hits = reader.cache.hits
+            writer._write_views({second_id: 5})
+            reader.get_active_sales()
+            if reader.cache.hits != hits + 1:
+                problems.append('view flush invalidated cached pages')
+        finally:
+            writer.close()
+            reader.close()
+    return problems
+
+def check():
+    """Проверка ListingCache на MemoryBackend, на RedisBackend с FakeRedis
+    и общей версии листингов для двух процессов"""
+    backends = {
+        'memory': lambda: ListingCache(MemoryBackend(), ttl=1),
+        'redis (fake)': lambda: ListingCache(RedisBackend(FakeRedis()), ttl=1),
+    }
+    ok = True
+    for name, make_cache in backends.items():
+        problems = _check_backend(make_cache)
+        ok = ok and not problems
+        print(f"{'✅' if not problems else '❌'} {name}: {'; '.join(problems) or 'hit/miss, bump, ttl'}")
+    problems = _check_processes()
+    ok = ok and not problems
+    print(f"{'✅' if not problems else '❌'} two processes, one database: "
+          f"{'; '.join(problems) or 'listing, transfer and owner changes are visible, view flushes are not'}")
+    return ok
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Кэш листингов')
+    parser.add_argument('command', choices=['check'])
+    parser.parse_args(argv)
+    return 0 if check() else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -4,11 +4,21 @@ import os
 # Telegram Bot Tokens
 BOT_MAIN_TOKEN = "YOUR_MAIN_BOT_TOKEN"  # Основной бот маркета
 BOT_RECEIVER_TOKEN = "YOUR_RECEIVER_BOT_TOKEN"  # Бот для приема NFT
+TELEGRAM_API_URL = "https://api.telegram.org"
+
+# Подпись сессий сайта (проверяется и в sse_server.py)
+SECRET_KEY = "your-secret-key-here"
 
 # Webhook settings
 WEBHOOK_URL = "https://your-domain.com"  # Ваш домен
 WEBHOOK_PATH = "/webhook"
 WEBHOOK_RECEIVER_PATH = "/webhook_receiver"
+WEBHOOK_HOST = "0.0.0.0"
+WEBHOOK_SECRET = None  # секрет для заголовка X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_WORKERS = 32  # одновременно обрабатываемых апдейтов
+WEBHOOK_MAX_PENDING = 10000  # апдейтов в очереди, дальше - 503 и повтор от Telegram
+WEBHOOK_DEDUP_SIZE = 100000  # сколько последних update_id помнить
+WEBHOOK_DRAIN_TIMEOUT = 30  # секунды на доработку принятых апдейтов при остановке
 
 # Database
 DATABASE_URL = "sqlite:///nft_market.db"
@@ -19,7 +29,76 @@ ADMIN_IDS = [123456789]  # ID администраторов
 # Upload settings
 UPLOAD_FOLDER = "uploads"
 MAX_FILE_SIZE = 50 * 1024 * 1024  # 50 MB
+DOWNLOAD_WORKERS = 4  # одновременных загрузок файлов из Telegram
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+DOWNLOAD_JOB_TTL = 60 * 60  # сколько помнить завершенную загрузку, пока мастер не создал NFT
+BLOB_FOLDER = os.path.join(UPLOAD_FOLDER, "blobs")  # файлы по SHA-256
+BLOB_GC_GRACE = 24 * 60 * 60  # файл без ссылок удаляется не раньше чем через сутки
+PREVIEW_FOLDER = os.path.join(UPLOAD_FOLDER, "previews")
+PREVIEW_SIZES = {'thumb': 320, 'preview': 800}  # максимальная сторона в пикселях
+PREVIEW_WORKERS = 2  # процессов для генерации превью
+PREVIEW_QUALITY = 80
+PREVIEW_WAIT = 2  # сколько секунд запрос ждет генерации, прежде чем отдать заглушку
+PREVIEW_PLACEHOLDER = "https://via.placeholder.com/300"
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'mp4', 'webm', 'json'}
+SESSION_TTL = 30 * 60  # сессия загрузки живет 30 минут без активности
+MAX_SESSIONS = 100000
+SESSION_CACHE_TTL = 2  # сколько секунд сессия из кэша считается актуальной без чтения из базы
+
+# Transfer codes
+TRANSFER_CODE_LENGTH = 8
+TRANSFER_CODE_TTL = 24 * 60 * 60  # код действителен сутки
+TRANSFER_REAP_INTERVAL = 60  # секунды между проходами уборки кодов
+TRANSFER_ARCHIVE_AFTER = 7 * 24 * 60 * 60  # использованные и просроченные коды уходят в архив через неделю
+TRANSFER_REAP_BATCH = 1000
+
+# Outbound messages (лимиты Telegram Bot API)
+OUTBOUND_GLOBAL_RATE = 30  # сообщений в секунду на бота
+OUTBOUND_CHAT_RATE = 1  # сообщений в секунду в один чат
+OUTBOUND_GROUP_RATE = 20 / 60  # в группу - 20 в минуту
+OUTBOUND_RETRIES = 3  # повторов при сетевых ошибках
+OUTBOUND_MAX_BUCKETS = 10000
+
+# Outbox (уведомления о продажах и передачах)
+OUTBOX_BATCH_SIZE = 100
+OUTBOX_SECRET = None  # общий секрет сайта и бота для подписи запросов к API бота; без него запросы отклоняются
+OUTBOX_INTERVAL = 1  # секунды между проверками outbox
+OUTBOX_MAX_ATTEMPTS = 10  # после этого событие помечается как dead
+OUTBOX_LEASE = 60  # через сколько секунд забранное, но не подтвержденное событие отправится снова
+OUTBOX_RETRY_BASE = 5  # задержка первого повтора, дальше удваивается
+OUTBOX_RETRY_MAX = 15 * 60
+OUTBOX_KEEP_SENT = 7 * 24 * 60 * 60  # доставленные события хранятся неделю
+
+# Выгрузка истории профиля (/api/profile/export)
+EXPORT_CHUNK_SIZE = 1000  # строк за один fetchmany
+EXPORT_BLOCK_SIZE = 64 * 1024  # байт в одном куске ответа
+EXPORT_GZIP_LEVEL = 6
+
+# Поиск лотов (FTS5, см. search.py)
+SEARCH_CANDIDATES = 200  # размер окна ранжирования (окна идут от новых совпадений к старым)
+SEARCH_MAX_TERMS = 8  # слов запроса, остальные отбрасываются
+SEARCH_SAMPLE = 20  # новейших совпадений, по которым оценивается частота слова
+SEARCH_TEXT_CHECK = 100  # во сколько раз проверка слова по тексту лота дороже шага FTS5 по списку документов
+SEARCH_PER_PAGE = 12
 
 # Stars rate (сколько рублей за 1 звезду)
-STARS_TO_RUB = 10  # 1 звезда = 10 рублей (пример)
\ No newline at end of file
+STARS_TO_RUB = 10  # 1 звезда = 10 рублей (пример)
+
+# Cache settings
+CACHE_BACKEND = "memory"  # memory или redis (общие значения); версия листингов всегда общая - в базе
+REDIS_URL = "redis://localhost:6379/0"
+CACHE_TTL = 60  # секунды
+CACHE_MAX_SIZE = 10000  # записей в памяти процесса
+
+# Live-события маркета (Server-Sent Events, /api/events)
+EVENTS_BACKEND = "memory"  # memory или redis (события из ботов и других воркеров сайта)
+EVENTS_CHANNEL = "nft_market:events"
+EVENTS_BUFFER_SIZE = 1000  # последних событий в памяти; отставший сильнее клиент получает reset
+SSE_KEEPALIVE = 15  # секунды между пингами в простаивающем соединении
+SSE_RETRY = 3000  # через сколько миллисекунд браузер переподключается
+SSE_HOST = "0.0.0.0"  # отдельный сервер событий (sse_server.py) для тысяч соединений
+SSE_PORT = 5003
+# Браузер подключается к потоку, только если события приходят из всех
+# процессов (EVENTS_BACKEND = "redis"); иначе страницы опрашивают сервер
+EVENTS_URL = "/api/events"  # nginx проксирует на sse_server.py
+EVENTS_FLASK_ROUTE = False  # /api/events во Flask держит поток WSGI на каждую вкладку - только для разработки
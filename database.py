@@ -2,14 +2,105 @@
 import sqlite3
 from datetime import datetime
 import json
+import threading
+import atexit
+
+from migrations import apply_migrations
+from pagination import decode_cursor, build_page
+from view_counter import ViewCounter
+from purchase import purchase_nft
+from cache import create_cache, LISTING_VERSION_QUERY
+from events import create_hub, publish_sale, LISTING_CREATED, LISTING_REMOVED
+from config import TRANSFER_CODE_TTL, SEARCH_PER_PAGE
+from search import SEARCH_QUERY, TERM_SAMPLE_QUERY, match_query, sample_params, search_params, build_search_page, register_functions
+from transfers import generate_code
+from records import User, NFT, Transfer, USER_COLUMNS, NFT_COLUMNS, TRANSFER_COLUMNS, select_list
+
+USER_SELECT = select_list(USER_COLUMNS)
+NFT_SELECT = select_list(NFT_COLUMNS)
+NFT_SELECT_N = select_list(NFT_COLUMNS, 'n')
+TRANSFER_SELECT = select_list(TRANSFER_COLUMNS)
+
+NFT_INSERT = '''
+    INSERT INTO nfts 
+    (user_id, file_id, file_name, file_path, file_size, file_type, title, description, price, status, content_hash)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+# Статус с учетом срока: pending-код после expires_at считается expired,
+# даже если уборка еще не успела его пометить
+TRANSFER_SELECT_LIVE = '''
+    id, nft_id, from_user_id, to_user_id, transfer_code,
+    CASE WHEN status = 'pending' AND expires_at <= datetime('now') THEN 'expired' ELSE status END,
+    created_at, expires_at
+'''
+TRANSFER_INSERT = '''
+    INSERT INTO transfer_requests (nft_id, from_user_id, transfer_code, expires_at)
+    VALUES (?, ?, ?, ?)
+'''
+
+# PRAGMA, применяемые один раз к каждому новому соединению
+CONNECTION_PRAGMAS = (
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA cache_size=-16000',  # ~16 MB страничного кэша
+    'PRAGMA mmap_size=268435456',  # 256 MB
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA busy_timeout=5000',
+)
 
 class Database:
-    def __init__(self, db_path='nft_market.db'):
+    def __init__(self, db_path='nft_market.db', cache=None, events=None):
         self.db_path = db_path
+        # Read-through кэш листингов с общей для всех процессов версией (см. cache.py)
+        self.cache = cache or create_cache(version=self.listing_version)
+        # Live-события для сайта (см. events.py)
+        self.events = events or create_hub()
+        # Пул соединений: по одному долгоживущему соединению на поток
+        self._local = threading.local()
+        self._connections = []
+        self._pool_lock = threading.Lock()
+        self._closed = False
+        atexit.register(self.close)
         self.init_db()
+        # Просмотры пишутся в базу пачками в фоне
+        self.view_counter = ViewCounter(self._write_views)
+        self.view_counter.start()
     
     def get_connection(self):
-        return sqlite3.connect(self.db_path)
+        """Соединение текущего потока (создается при первом обращении)"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            if self._closed:
+                raise sqlite3.ProgrammingError('Database is closed')
+            conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            for pragma in CONNECTION_PRAGMAS:
+                conn.execute(pragma)
+            register_functions(conn)
+            self._local.conn = conn
+            with self._pool_lock:
+                self._connections.append(conn)
+        return conn
+    
+    def listing_version(self):
+        """Версия листингов (меняется триггерами при любой записи лота)"""
+        row = self.get_connection().execute(LISTING_VERSION_QUERY).fetchone()
+        return row[0] if row else 0
+    
+    def close(self):
+        """Закрытие всех соединений пула"""
+        if self._closed:
+            return
+        # Сбрасываем накопленные просмотры до закрытия соединений
+        self.view_counter.stop()
+        with self._pool_lock:
+            self._closed = True
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+        self._local = threading.local()
     
     def init_db(self):
         """Инициализация базы данных"""
@@ -95,6 +186,9 @@ class Database:
             ''')
             
             conn.commit()
+            
+            # Индексы и прочие изменения схемы
+            apply_migrations(conn)
     
     def add_user(self, telegram_id, username):
         """Добавление нового пользователя"""
@@ -106,41 +200,52 @@ class Database:
             ''', (telegram_id, username))
             conn.commit()
     
+    def add_users(self, users):
+        """Пакетное добавление пользователей одной транзакцией.
+
+        users - список dict с telegram_id и username. Возвращает id
+        пользователей в том же порядке (в том числе уже существовавших).
+        """
+        users = list(users)
+        if not users:
+            return []
+        telegram_ids = [user['telegram_id'] for user in users]
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.executemany('''
+                INSERT OR IGNORE INTO users (telegram_id, username)
+                VALUES (?, ?)
+            ''', [(user['telegram_id'], user.get('username')) for user in users])
+            cursor.execute('''
+                SELECT telegram_id, id FROM users
+                WHERE telegram_id IN (SELECT value FROM json_each(?))
+            ''', (json.dumps(telegram_ids),))
+            ids = dict(cursor.fetchall())
+            conn.commit()
+            return [ids.get(telegram_id) for telegram_id in telegram_ids]
+    
     def get_user_by_id(self, user_id):
         """Получение пользователя по ID"""
         with self.get_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute('SELECT * FROM users WHERE id = ?', (user_id,))
-            row = cursor.fetchone()
-            if row:
-                return {
-                    'id': row[0],
-                    'telegram_id': row[1],
-                    'username': row[2],
-                    'balance_stars': row[3],
-                    'balance_rub': row[4],
-                    'is_admin': row[5],
-                    'created_at': row[6]
-                }
-            return None
+            cursor.row_factory = User.from_row
+            cursor.execute(f'SELECT {USER_SELECT} FROM users WHERE id = ?', (user_id,))
+            return cursor.fetchone()
     
     def get_user_by_telegram_id(self, telegram_id):
         """Получение пользователя по Telegram ID"""
         with self.get_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute('SELECT * FROM users WHERE telegram_id = ?', (telegram_id,))
-            row = cursor.fetchone()
-            if row:
-                return {
-                    'id': row[0],
-                    'telegram_id': row[1],
-                    'username': row[2],
-                    'balance_stars': row[3],
-                    'balance_rub': row[4],
-                    'is_admin': row[5],
-                    'created_at': row[6]
-                }
-            return None
+            cursor.row_factory = User.from_row
+            cursor.execute(f'SELECT {USER_SELECT} FROM users WHERE telegram_id = ?', (telegram_id,))
+            return cursor.fetchone()
+    
+    def get_user_telegram_ids(self):
+        """Telegram ID всех пользователей (для рассылок)"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT telegram_id FROM users WHERE telegram_id IS NOT NULL')
+            return [row[0] for row in cursor.fetchall()]
     
     def get_user_balance(self, user_id):
         """Получение баланса пользователя"""
@@ -152,142 +257,316 @@ class Database:
     
     def add_nft(self, nft_data):
         """Добавление NFT"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(NFT_INSERT, self._nft_params(nft_data))
+            conn.commit()
+        self._publish_listings([(cursor.lastrowid, nft_data)])
+        return cursor.lastrowid
+    
+    def add_nfts(self, nfts_data):
+        """Пакетное добавление NFT одной транзакцией, возвращает их id"""
+        params = [self._nft_params(nft_data) for nft_data in nfts_data]
+        ids = self._insert_many(NFT_INSERT, params)
+        self._publish_listings(zip(ids, nfts_data))
+        return ids
+    
+    def _publish_listings(self, nfts):
+        for nft_id, nft_data in nfts:
+            if nft_data.get('status') == 'for_sale':
+                self.events.publish(LISTING_CREATED, {
+                    'nft_id': nft_id,
+                    'title': nft_data.get('title') or nft_data['file_name'],
+                    'price': nft_data.get('price')
+                })
+    
+    def _nft_params(self, nft_data):
+        return (
+            nft_data['user_id'],
+            nft_data['file_id'],
+            nft_data['file_name'],
+            nft_data.get('file_path'),
+            nft_data.get('file_size'),
+            nft_data.get('file_type'),
+            nft_data.get('title'),
+            nft_data.get('description'),
+            nft_data.get('price'),
+            nft_data.get('status', 'pending'),
+            nft_data.get('content_hash')
+        )
+    
+    def _insert_many(self, query, params):
+        """executemany одной транзакцией с возвратом id вставленных строк.
+
+        Пока транзакция держит блокировку записи, AUTOINCREMENT выдает id
+        подряд, поэтому они восстанавливаются по last_insert_rowid().
+        """
+        if not params:
+            return []
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.executemany(query, params)
+            cursor.execute('SELECT last_insert_rowid()')
+            last_id = cursor.fetchone()[0]
+            conn.commit()
+            return list(range(last_id - len(params) + 1, last_id + 1))
+    
+    def set_nft_file_path(self, file_id, file_path, content_hash=None):
+        """Путь к скачанному файлу для NFT, созданных до окончания загрузки"""
         with self.get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute('''
-                INSERT INTO nfts 
-                (user_id, file_id, file_name, file_path, file_size, file_type, title, description, price, status)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                nft_data['user_id'],
-                nft_data['file_id'],
-                nft_data['file_name'],
-                nft_data.get('file_path'),
-                nft_data.get('file_size'),
-                nft_data.get('file_type'),
-                nft_data.get('title'),
-                nft_data.get('description'),
-                nft_data.get('price'),
-                nft_data.get('status', 'pending')
-            ))
+                UPDATE nfts 
+                SET file_path = ?, content_hash = ? 
+                WHERE file_id = ? AND file_path IS NULL
+            ''', (file_path, content_hash, file_id))
+            conn.commit()
+        return cursor.rowcount
+    
+    def find_nfts_by_hash(self, content_hash):
+        """NFT с тем же файлом (поиск по индексу content_hash)"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.row_factory = NFT.from_row
+            cursor.execute(f'''
+                SELECT {NFT_SELECT} FROM nfts 
+                WHERE content_hash = ?
+                ORDER BY id
+            ''', (content_hash,))
+            return cursor.fetchall()
+    
+    def register_blob(self, content_hash, size):
+        """Учет файла в хранилище (ссылки добавят триггеры на nfts).
+
+        Повторная загрузка того же файла обновляет created_at, чтобы сборка
+        мусора не удалила его, пока создается NFT.
+        """
+        with self.get_connection() as conn:
+            conn.execute('''
+                INSERT INTO blobs (content_hash, size) VALUES (?, ?)
+                ON CONFLICT (content_hash) DO UPDATE 
+                SET size = excluded.size, created_at = CURRENT_TIMESTAMP
+            ''', (content_hash, size))
+            conn.commit()
+    
+    def get_unreferenced_blobs(self, grace, limit=500):
+        """Хэши файлов без ссылок старше grace секунд"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT content_hash FROM blobs 
+                WHERE ref_count <= 0 AND created_at < datetime('now', ?)
+                LIMIT ?
+            ''', (f'-{int(grace)} seconds', limit))
+            return [row[0] for row in cursor.fetchall()]
+    
+    def delete_unreferenced_blob(self, content_hash, grace, remove_file):
+        """Удаление файла, если на него по-прежнему нет ссылок.
+
+        remove_file(content_hash) удаляет сам файл внутри той же транзакции:
+        пока она держит блокировку записи, register_blob повторной загрузки
+        того же файла ждет, а после нее загрузка кладет файл заново.
+        """
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            try:
+                cursor.execute('''
+                    DELETE FROM blobs 
+                    WHERE content_hash = ? AND ref_count <= 0 AND created_at < datetime('now', ?)
+                ''', (content_hash, f'-{int(grace)} seconds'))
+                deleted = cursor.rowcount == 1
+                if deleted:
+                    remove_file(content_hash)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            return deleted
+    
+    def get_bot_file_ids(self, bot_id, source_file_ids):
+        """file_id бота bot_id для исходных file_id: {исходный: свой}"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT source_file_id, file_id FROM bot_file_ids
+                WHERE bot_id = ? AND source_file_id IN (SELECT value FROM json_each(?))
+            ''', (bot_id, json.dumps(list(source_file_ids))))
+            return dict(cursor.fetchall())
+    
+    def set_bot_file_ids(self, bot_id, pairs):
+        """Сохранение file_id бота: pairs - (исходный file_id, file_id бота)"""
+        with self.get_connection() as conn:
+            conn.executemany('''
+                INSERT INTO bot_file_ids (bot_id, source_file_id, file_id) VALUES (?, ?, ?)
+                ON CONFLICT (bot_id, source_file_id) DO UPDATE
+                SET file_id = excluded.file_id, created_at = CURRENT_TIMESTAMP
+            ''', [(bot_id, source, file_id) for source, file_id in pairs])
+            conn.commit()
+    
+    def delete_bot_file_ids(self, bot_id, source_file_ids):
+        """Удаление устаревших file_id бота"""
+        with self.get_connection() as conn:
+            conn.execute('''
+                DELETE FROM bot_file_ids
+                WHERE bot_id = ? AND source_file_id IN (SELECT value FROM json_each(?))
+            ''', (bot_id, json.dumps(list(source_file_ids))))
             conn.commit()
-            return cursor.lastrowid
     
     def get_nft_by_id(self, nft_id):
         """Получение NFT по ID"""
+        page = self.cache.get_or_load(f'nft:{nft_id}', lambda: self._load_nft(nft_id))
+        return self._with_views(page)['items'][0] if page else None
+    
+    def _with_views(self, page):
+        """Копия страницы из кэша с актуальными просмотрами.
+
+        Объекты из кэша общие - просмотры добавляем в копии. В кэше
+        просмотры на момент чтения из базы (views_mark), поэтому запись
+        просмотров кэш не сбрасывает (см. ViewCounter.since).
+        """
+        since = self.view_counter.since
+        items = []
+        for nft in page['items']:
+            nft = nft.copy()
+            nft.views = (nft.views or 0) + since(nft.id, page.get('views_mark'))
+            items.append(nft)
+        return dict(page, items=items)
+    
+    def _load_nft(self, nft_id):
+        mark = self.view_counter.snapshot()
         with self.get_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute('''
-                SELECT n.*, u.username as seller_username 
+            cursor.row_factory = NFT.from_row
+            cursor.execute(f'''
+                SELECT {NFT_SELECT_N}, u.username as seller_username 
                 FROM nfts n
                 LEFT JOIN users u ON n.user_id = u.id
                 WHERE n.id = ?
             ''', (nft_id,))
-            row = cursor.fetchone()
-            if row:
-                return {
-                    'id': row[0],
-                    'user_id': row[1],
-                    'file_id': row[2],
-                    'file_name': row[3],
-                    'file_path': row[4],
-                    'file_size': row[5],
-                    'file_type': row[6],
-                    'title': row[7],
-                    'description': row[8],
-                    'price': row[9],
-                    'status': row[10],
-                    'views': row[11],
-                    'created_at': row[12],
-                    'sold_at': row[13],
-                    'seller_username': row[14]
-                }
-            return None
+            nft = cursor.fetchone()
+        return {'items': [nft], 'views_mark': mark} if nft else None
     
-    def get_active_sales(self, page=1, per_page=12):
-        """Получение активных продаж"""
-        offset = (page - 1) * per_page
+    def get_active_sales(self, per_page=12, cursor=None):
+        """Получение страницы активных продаж с продавцами и общим числом лотов"""
+        page = self.cache.get_or_load(
+            f'market:{per_page}:{cursor or ""}',
+            lambda: self._load_active_sales(per_page, cursor)
+        )
+        return self._with_views(page)
+    
+    def _load_active_sales(self, per_page, cursor):
+        decoded = decode_cursor(cursor)
+        direction = decoded[0] if decoded else 'next'
+        
+        # Общее число лотов берется из поддерживаемого счетчика тем же запросом
+        query = f'''
+            SELECT {NFT_SELECT_N}, u.username as seller_username,
+                   (SELECT value FROM counters WHERE name = 'active_listings') as total
+            FROM nfts n
+            LEFT JOIN users u ON n.user_id = u.id
+            WHERE n.status = 'for_sale'
+        '''
+        params = []
+        if decoded and direction == 'next':
+            query += ' AND (n.created_at, n.id) < (?, ?) ORDER BY n.created_at DESC, n.id DESC'
+            params += [decoded[1], decoded[2]]
+        elif decoded:
+            query += ' AND (n.created_at, n.id) > (?, ?) ORDER BY n.created_at ASC, n.id ASC'
+            params += [decoded[1], decoded[2]]
+        else:
+            query += ' ORDER BY n.created_at DESC, n.id DESC'
+        query += ' LIMIT ?'
+        params.append(per_page + 1)
+        
+        mark = self.view_counter.snapshot()
         with self.get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT n.*, u.username as seller_username 
-                FROM nfts n
-                LEFT JOIN users u ON n.user_id = u.id
-                WHERE n.status = 'for_sale'
-                ORDER BY n.created_at DESC
-                LIMIT ? OFFSET ?
-            ''', (per_page, offset))
-            rows = cursor.fetchall()
+            cursor_ = conn.cursor()
+            # Последняя колонка - общее число лотов
+            cursor_.row_factory = lambda c, row: (NFT(*row[:-1]), row[-1])
+            cursor_.execute(query, params)
+            rows = cursor_.fetchall()
             
-            nfts = []
-            for row in rows:
-                nfts.append({
-                    'id': row[0],
-                    'user_id': row[1],
-                    'file_id': row[2],
-                    'file_name': row[3],
-                    'file_path': row[4],
-                    'file_size': row[5],
-                    'file_type': row[6],
-                    'title': row[7],
-                    'description': row[8],
-                    'price': row[9],
-                    'status': row[10],
-                    'views': row[11],
-                    'created_at': row[12],
-                    'sold_at': row[13],
-                    'seller_username': row[14]
-                })
-            return nfts
+            nfts = [nft for nft, _ in rows]
+            
+            if rows:
+                total = rows[0][1]
+            else:
+                cursor_ = conn.cursor()
+                cursor_.execute("SELECT value FROM counters WHERE name = 'active_listings'")
+                total = cursor_.fetchone()[0]
+            
+            # Возвращает {'items', 'next_cursor', 'prev_cursor', 'total'}
+            page = build_page(nfts, per_page, direction, decoded is not None,
+                              key=lambda nft: (nft.created_at, nft.id))
+            page['total'] = total
+            page['views_mark'] = mark
+            return page
+    
+    def search_nfts(self, text, per_page=SEARCH_PER_PAGE, offset=0):
+        """Поиск лотов по названию, описанию и имени файла (см. search.py).
+
+        Возвращает {'items', 'next_offset'}. Порядок - по новизне: совпадения
+        переставляются по качеству только внутри окна из SEARCH_CANDIDATES
+        соседних по времени.
+        """
+        query = match_query(text)
+        if query is None or offset < 0:
+            return {'items': [], 'next_offset': None}
+        page = self.cache.get_or_load(
+            f'search:{per_page}:{offset}:{query}',
+            lambda: self._load_search(query, per_page, offset)
+        )
+        return self._with_views(page)
+    
+    def _load_search(self, query, per_page, offset):
+        mark = self.view_counter.snapshot()
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            params = sample_params(query)
+            densities = params and [row[0] for row in conn.execute(TERM_SAMPLE_QUERY, params)]
+            cursor.row_factory = NFT.from_row
+            cursor.execute(SEARCH_QUERY, search_params(query, per_page, offset, densities))
+            page = build_search_page(cursor.fetchall(), per_page, offset)
+        page['views_mark'] = mark
+        return page
     
     def get_user_nfts(self, user_id, status=None):
         """Получение NFT пользователя"""
         with self.get_connection() as conn:
             cursor = conn.cursor()
+            cursor.row_factory = NFT.from_row
             if status:
-                cursor.execute('''
-                    SELECT * FROM nfts 
+                cursor.execute(f'''
+                    SELECT {NFT_SELECT} FROM nfts 
                     WHERE user_id = ? AND status = ?
                     ORDER BY created_at DESC
                 ''', (user_id, status))
             else:
-                cursor.execute('''
-                    SELECT * FROM nfts 
+                cursor.execute(f'''
+                    SELECT {NFT_SELECT} FROM nfts 
                     WHERE user_id = ?
                     ORDER BY created_at DESC
                 ''', (user_id,))
             
-            rows = cursor.fetchall()
-            nfts = []
-            for row in rows:
-                nfts.append({
-                    'id': row[0],
-                    'user_id': row[1],
-                    'file_id': row[2],
-                    'file_name': row[3],
-                    'file_path': row[4],
-                    'file_size': row[5],
-                    'file_type': row[6],
-                    'title': row[7],
-                    'description': row[8],
-                    'price': row[9],
-                    'status': row[10],
-                    'views': row[11],
-                    'created_at': row[12],
-                    'sold_at': row[13]
-                })
+            nfts = cursor.fetchall()
+            pending = self.view_counter.pending
+            for nft in nfts:
+                nft.views += pending(nft.id)
             return nfts
     
     def increment_views(self, nft_id):
-        """Увеличение счетчика просмотров"""
+        """Увеличение счетчика просмотров (запись в базу отложена)"""
+        self.view_counter.increment(nft_id)
+    
+    def _write_views(self, deltas):
+        """Пакетная запись накопленных просмотров"""
         with self.get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
+            conn.executemany('''
                 UPDATE nfts 
-                SET views = views + 1 
+                SET views = views + ? 
                 WHERE id = ?
-            ''', (nft_id,))
-            conn.commit()
+            ''', [(amount, nft_id) for nft_id, amount in deltas.items()])
     
     def can_sell_nft(self, user_id):
         """Проверка права на продажу"""
@@ -324,51 +603,148 @@ class Database:
             cursor.execute('DELETE FROM user_states WHERE user_id = ?', (user_id,))
             conn.commit()
     
+    def get_upload_session(self, user_id):
+        """Сессия мастера загрузки пользователя (данные) или None"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT data FROM upload_sessions WHERE user_id = ?', (user_id,))
+            row = cursor.fetchone()
+            return json.loads(row[0]) if row else None
+    
+    def set_upload_sessions(self, sessions):
+        """Пакетная запись сессий мастера: список (user_id, data с session_id)"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.executemany('''
+                INSERT OR REPLACE INTO upload_sessions (user_id, session_id, data, updated_at)
+                VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+            ''', [(user_id, data['session_id'], json.dumps(data)) for user_id, data in sessions])
+            conn.commit()
+    
+    def delete_upload_session(self, user_id, session_id):
+        """Удаление сессии мастера, если у пользователя все еще она"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('DELETE FROM upload_sessions WHERE user_id = ? AND session_id = ?',
+                           (user_id, session_id))
+            conn.commit()
+    
     def create_transfer_request(self, nft_id, from_user_id, transfer_code, expires_at):
         """Создание запроса на передачу"""
         with self.get_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute('''
-                INSERT INTO transfer_requests (nft_id, from_user_id, transfer_code, expires_at)
-                VALUES (?, ?, ?, ?)
-            ''', (nft_id, from_user_id, transfer_code, expires_at))
+            cursor.execute(TRANSFER_INSERT, (nft_id, from_user_id, transfer_code, expires_at))
             conn.commit()
             return cursor.lastrowid
     
+    def issue_transfer_code(self, nft_id, from_user_id, ttl=TRANSFER_CODE_TTL, attempts=5):
+        """Новый код передачи NFT со сроком ttl секунд, возвращает код.
+
+        Код не проверяется заранее: при совпадении UNIQUE-ограничение
+        отклоняет вставку, и она повторяется с другим кодом.
+        """
+        with self.get_connection() as conn:
+            for attempt in range(attempts):
+                code = generate_code()
+                try:
+                    conn.execute('''
+                        INSERT INTO transfer_requests (nft_id, from_user_id, transfer_code, expires_at)
+                        VALUES (?, ?, ?, datetime('now', ?))
+                    ''', (nft_id, from_user_id, code, f'+{int(ttl)} seconds'))
+                    conn.commit()
+                    return code
+                except sqlite3.IntegrityError:
+                    conn.rollback()
+                    if attempt == attempts - 1:
+                        raise
+    
+    def create_transfer_requests(self, transfers):
+        """Пакетное создание запросов на передачу, возвращает их id.
+
+        transfers - список dict с nft_id, from_user_id, transfer_code, expires_at.
+        """
+        params = [
+            (t['nft_id'], t['from_user_id'], t['transfer_code'], t['expires_at'])
+            for t in transfers
+        ]
+        return self._insert_many(TRANSFER_INSERT, params)
+    
     def get_transfer_by_code(self, code):
-        """Получение запроса на передачу по коду"""
+        """Получение запроса на передачу по коду (просроченный - со статусом expired)"""
         with self.get_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute('''
-                SELECT * FROM transfer_requests 
+            cursor.row_factory = Transfer.from_row
+            cursor.execute(f'''
+                SELECT {TRANSFER_SELECT_LIVE} FROM transfer_requests 
                 WHERE transfer_code = ?
             ''', (code,))
-            row = cursor.fetchone()
-            if row:
-                return {
-                    'id': row[0],
-                    'nft_id': row[1],
-                    'from_user_id': row[2],
-                    'to_user_id': row[3],
-                    'transfer_code': row[4],
-                    'status': row[5],
-                    'created_at': row[6],
-                    'expires_at': row[7]
-                }
-            return None
+            return cursor.fetchone()
+    
+    def expire_transfers(self, limit=1000):
+        """Пометка просроченных кодов (не больше limit), возвращает их число"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                UPDATE transfer_requests SET status = 'expired'
+                WHERE id IN (
+                    SELECT id FROM transfer_requests 
+                    WHERE status = 'pending' AND expires_at <= datetime('now')
+                    LIMIT ?
+                )
+            ''', (limit,))
+            conn.commit()
+            return cursor.rowcount
+    
+    def archive_transfers(self, older_than, limit=1000):
+        """Перенос использованных и просроченных кодов старше older_than секунд
+        в transfer_requests_archive, возвращает число строк"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            try:
+                cursor.execute('''
+                    CREATE TEMP TABLE IF NOT EXISTS archive_batch (id INTEGER PRIMARY KEY)
+                ''')
+                cursor.execute('DELETE FROM archive_batch')
+                cursor.execute('''
+                    INSERT INTO archive_batch (id)
+                    SELECT id FROM transfer_requests 
+                    WHERE status IN ('completed', 'expired') AND expires_at < datetime('now', ?)
+                    LIMIT ?
+                ''', (f'-{int(older_than)} seconds', limit))
+                cursor.execute(f'''
+                    INSERT OR REPLACE INTO transfer_requests_archive ({TRANSFER_SELECT})
+                    SELECT {TRANSFER_SELECT} FROM transfer_requests 
+                    WHERE id IN (SELECT id FROM archive_batch)
+                ''')
+                cursor.execute('''
+                    DELETE FROM transfer_requests WHERE id IN (SELECT id FROM archive_batch)
+                ''')
+                count = cursor.rowcount
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            return count
     
     def complete_transfer(self, nft_id, to_user_id, transfer_code=None):
         """Завершение передачи NFT"""
         with self.get_connection() as conn:
             cursor = conn.cursor()
             
-            # Обновляем статус запроса
+            # Код используется один раз и только до истечения срока
             if transfer_code:
                 cursor.execute('''
                     UPDATE transfer_requests 
                     SET status = 'completed', to_user_id = ?
-                    WHERE transfer_code = ?
+                    WHERE transfer_code = ? AND status = 'pending' AND expires_at > datetime('now')
                 ''', (to_user_id, transfer_code))
+                if cursor.rowcount != 1:
+                    conn.rollback()
+                    return False
+            
+            cursor.execute('SELECT user_id, status FROM nfts WHERE id = ?', (nft_id,))
+            from_user_id, status = cursor.fetchone() or (None, None)
             
             # Обновляем владельца NFT
             cursor.execute('''
@@ -378,11 +754,13 @@ class Database:
             ''', (to_user_id, nft_id))
             
             conn.commit()
-            return True
+        if status == 'for_sale':
+            self.events.publish(LISTING_REMOVED, {'nft_id': nft_id})
+        return True
     
-    def check_transfer_code_exists(self, code):
-        """Проверка существования кода"""
-        with self.get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute('SELECT id FROM transfer_requests WHERE transfer_code = ?', (code,))
-            return cursor.fetchone() is not None
\ No newline at end of file
+    def buy_nft(self, nft_id, buyer_id):
+        """Атомарная покупка NFT (см. purchase.purchase_nft)"""
+        result = purchase_nft(self.get_connection(), nft_id, buyer_id)
+        if result['success']:
+            publish_sale(self.events, result)
+        return result
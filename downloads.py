@@ -0,0 +1,332 @@
+# downloads.py
+"""Фоновая загрузка файлов NFT из Telegram.
+
+Проверка очереди против локального фейка файлового эндпоинта Bot API:
+
+    python downloads.py check
+"""
+import argparse
+import asyncio
+import hashlib
+import logging
+import os
+import sys
+import tempfile
+import time
+import uuid
+from collections import deque
+
+import aiohttp
+
+from blob_store import BlobStore
+from config import MAX_FILE_SIZE, DOWNLOAD_WORKERS, DOWNLOAD_CHUNK_SIZE, DOWNLOAD_JOB_TTL, TELEGRAM_API_URL
+
+class FileTooLarge(Exception):
+    pass
+
+class DownloadJob:
+    __slots__ = ('id', 'user_id', 'file_id', 'file_name', 'status', 'downloaded',
+                 'total', 'file_path', 'sha256', 'error')
+
+    def __init__(self, user_id, file_id, file_name, total=None):
+        self.id = uuid.uuid4().hex[:12]
+        self.user_id = user_id
+        self.file_id = file_id
+        self.file_name = file_name
+        self.status = 'queued'  # queued, downloading, done, failed, cancelled
+        self.downloaded = 0
+        self.total = total
+        self.file_path = None
+        self.sha256 = None
+        self.error = None
+
+    def progress(self):
+        """Прогресс загрузки"""
+        return {
+            'status': self.status,
+            'downloaded': self.downloaded,
+            'total': self.total,
+            'file_path': self.file_path,
+            'sha256': self.sha256,
+            'error': self.error
+        }
+
+class DownloadQueue:
+    """Фоновая загрузка файлов из Telegram.
+
+    Файлы качаются воркерами (не больше workers одновременно) потоково,
+    кусками во временный файл, с проверкой размера и подсчетом SHA-256 на
+    лету, а затем переносятся в BlobStore под своим хэшем. Очередь
+    справедливая: пользователи обслуживаются по кругу, и пачка файлов от
+    одного не задерживает остальных.
+
+    get_file_path(file_id) - корутина, возвращающая путь файла в Bot API
+    (обычно через bot.get_file). register(sha256, size) - корутина, которая
+    учитывает файл в хранилище до того, как он ляжет на место под своим
+    хэшем (см. BlobStore.collect_garbage). on_complete(job) вызывается
+    после успешной загрузки.
+
+    Задача живет в памяти до forget(job_id); завершенные и упавшие
+    задачи, которые никто не забрал, вытесняются через job_ttl секунд.
+    forget() для задачи в очереди снимает ее с загрузки.
+    """
+
+    def __init__(self, token, get_file_path, on_complete=None, workers=DOWNLOAD_WORKERS,
+                 store=None, max_size=MAX_FILE_SIZE, api_url=TELEGRAM_API_URL,
+                 chunk_size=DOWNLOAD_CHUNK_SIZE, job_ttl=DOWNLOAD_JOB_TTL, register=None):
+        self.token = token
+        self.get_file_path = get_file_path
+        self.on_complete = on_complete
+        self.register = register
+        self.workers = workers
+        self.store = store or BlobStore()
+        self.max_size = max_size
+        self.api_url = api_url.rstrip('/')
+        self.chunk_size = chunk_size
+        self.job_ttl = job_ttl
+
+        self.jobs = {}  # job_id -> DownloadJob
+        self._by_file = {}  # file_id -> job_id
+        self._finished = deque()  # (время завершения, job_id) по порядку
+        self._pending = {}  # user_id -> deque(DownloadJob)
+        self._ready = None  # очередь user_id по кругу
+        self._tasks = []
+        self._session = None
+
+    def submit(self, user_id, file_id, file_name, file_size=None):
+        """Постановка файла в очередь, возвращает ID задачи"""
+        if file_size and file_size > self.max_size:
+            raise FileTooLarge(f"File is {file_size} bytes, limit is {self.max_size}")
+
+        self._start()
+        self._evict_finished()
+        job = DownloadJob(user_id, file_id, file_name, file_size)
+        self.jobs[job.id] = job
+        self._by_file[file_id] = job.id
+
+        queue = self._pending.setdefault(user_id, deque())
+        queue.append(job)
+        if len(queue) == 1:
+            self._ready.put_nowait(user_id)
+        return job.id
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def result(self, file_id):
+        """Завершенная задача загрузки файла или None"""
+        job = self.jobs.get(self._by_file.get(file_id))
+        return job if job and job.status == 'done' else None
+
+    def forget(self, job_id):
+        """Удаление задачи из памяти (задача в очереди отменяется)"""
+        job = self.jobs.pop(job_id, None)
+        if job is None:
+            return
+        if self._by_file.get(job.file_id) == job_id:
+            del self._by_file[job.file_id]
+
+        if job.status == 'queued':
+            job.status = 'cancelled'
+            queue = self._pending.get(job.user_id)
+            if queue is not None:
+                queue.remove(job)
+                # Пустой круг пользователя убираем; его запись в _ready
+                # воркер пропустит
+                if not queue:
+                    del self._pending[job.user_id]
+
+    def _evict_finished(self):
+        """Вытеснение завершенных задач старше job_ttl"""
+        deadline = time.monotonic() - self.job_ttl
+        while self._finished and self._finished[0][0] < deadline:
+            _, job_id = self._finished.popleft()
+            self.forget(job_id)
+
+    def _start(self):
+        if self._tasks:
+            return
+        self._ready = asyncio.Queue()
+        self._tasks = [asyncio.ensure_future(self._worker()) for _ in range(self.workers)]
+
+    async def close(self):
+        """Остановка воркеров"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def _worker(self):
+        while True:
+            user_id = await self._ready.get()
+            queue = self._pending.get(user_id)
+            if not queue or queue[0].status != 'queued':
+                # Очередь опустела после отмены или ее первый файл уже
+                # качает другой воркер (повторная запись после отмены)
+                continue
+            job = queue[0]
+            try:
+                await self._download(job)
+            finally:
+                queue.popleft()
+                if queue:
+                    # Следующий файл пользователя - в конец круга
+                    self._ready.put_nowait(user_id)
+                elif self._pending.get(user_id) is queue:
+                    del self._pending[user_id]
+            self._finished.append((time.monotonic(), job.id))
+            self._evict_finished()
+
+    async def _download(self, job):
+        job.status = 'downloading'
+        part_path = self.store.temp_path()
+
+        try:
+            remote_path = await self.get_file_path(job.file_id)
+            url = f"{self.api_url}/file/bot{self.token}/{remote_path}"
+
+            if self._session is None:
+                self._session = aiohttp.ClientSession()
+
+            digest = hashlib.sha256()
+            async with self._session.get(url) as response:
+                if response.status != 200:
+                    raise IOError(f"HTTP {response.status}")
+                with open(part_path, 'wb') as f:
+                    async for chunk in response.content.iter_chunked(self.chunk_size):
+                        job.downloaded += len(chunk)
+                        if job.downloaded > self.max_size:
+                            raise FileTooLarge(f"File exceeds {self.max_size} bytes")
+                        digest.update(chunk)
+                        f.write(chunk)
+
+            job.sha256 = digest.hexdigest()
+            if self.register:
+                await self.register(job.sha256, job.downloaded)
+            job.file_path = self.store.commit(part_path, job.sha256)
+            job.status = 'done'
+        except asyncio.CancelledError:
+            self._remove(part_path)
+            raise
+        except Exception as e:
+            self._remove(part_path)
+            job.status = 'failed'
+            job.error = str(e)
+            logging.error(f"Error downloading {job.file_id}: {e}")
+            return
+
+        if self.on_complete:
+            try:
+                await self.on_complete(job)
+            except Exception as e:
+                logging.error(f"Error in download callback for {job.file_id}: {e}")
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+async def _check(tmp):
+    """Прогон очереди против локального фейка файлового эндпоинта Bot API"""
+    from aiohttp import web
+
+    files = {f'photos/{name}.jpg': os.urandom(size) for name, size in
+             (('a1', 300_000), ('a2', 1000), ('b1', 5000), ('c1', 10), ('c2', 20), ('big', 200_000))}
+    served = []
+    gate = asyncio.Event()
+
+    async def serve_file(request):
+        path = request.match_info['path']
+        served.append(path)
+        if path.startswith('photos/a1'):
+            await gate.wait()  # держим единственного воркера
+        return web.Response(body=files[path])
+
+    app = web.Application()
+    app.router.add_get('/file/bot{token}/{path:.+}', serve_file)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+
+    async def get_file_path(file_id):
+        return f'photos/{file_id}.jpg'
+
+    store = BlobStore(os.path.join(tmp, 'blobs'))
+    registered = {}  # хэш -> был ли файл уже на месте при учете
+
+    async def register(sha256, size):
+        registered[sha256] = store.exists(sha256)
+
+    queue = DownloadQueue('123:TEST', get_file_path, workers=1, store=store, max_size=100_000,
+                          api_url=f'http://127.0.0.1:{port}', chunk_size=4096, job_ttl=0.5,
+                          register=register)
+    problems = []
+    try:
+        a1 = queue.submit(1, 'a1', 'a1.jpg')
+        a2 = queue.submit(1, 'a2', 'a2.jpg')
+        b1 = queue.submit(2, 'b1', 'b1.jpg')
+        c1 = queue.submit(3, 'c1', 'c1.jpg')
+        await asyncio.sleep(0.1)
+
+        # Отмена файла в очереди снимает его с загрузки
+        queue.forget(c1)
+        if 3 in queue._pending or queue.get(c1) is not None:
+            problems.append('cancelled job is still pending')
+        c2 = queue.submit(3, 'c2', 'c2.jpg')
+
+        gate.set()
+        for _ in range(100):
+            if all(queue.get(job_id).status in ('done', 'failed') for job_id in (a1, a2, b1, c2)):
+                break
+            await asyncio.sleep(0.05)
+
+        if served != ['photos/a1.jpg', 'photos/b1.jpg', 'photos/c2.jpg', 'photos/a2.jpg']:
+            problems.append(f'served out of round-robin order: {served}')
+        for job_id in (a2, b1, c2):
+            job = queue.get(job_id)
+            content = files[f'photos/{job.file_id}.jpg']
+            with open(job.file_path, 'rb') as f:
+                intact = f.read() == content
+            if job.status != 'done' or job.sha256 != hashlib.sha256(content).hexdigest() or not intact:
+                problems.append(f'{job.file_id} is {job.status} or corrupted')
+            if registered.get(job.sha256) is not False:
+                problems.append(f'{job.file_id} was not registered before it was put in place')
+
+        # a1 больше лимита: поток обрывается, .part не остается
+        job = queue.get(a1)
+        if job.status != 'failed' or 'exceeds' not in (job.error or '') or os.listdir(store.tmp_dir):
+            problems.append(f'oversized stream not aborted cleanly: {job.status}, {os.listdir(store.tmp_dir)}')
+
+        # Незабранные задачи вытесняются через job_ttl
+        await asyncio.sleep(0.6)
+        big = queue.submit(4, 'big', 'big.jpg', file_size=1000)
+        if set(queue.jobs) != {big} or set(queue._by_file) != {'big'}:
+            problems.append(f'{len(queue.jobs) - 1} finished jobs were not evicted')
+    finally:
+        await queue.close()
+        await runner.cleanup()
+    return problems
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Очередь загрузок из Telegram')
+    parser.add_argument('command', choices=['check'])
+    parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        problems = asyncio.run(_check(tmp))
+    for problem in problems:
+        print(f"❌ {problem}")
+    if not problems:
+        print("✅ files intact and registered before commit, round-robin order, oversized stream "
+              "aborted, cancelled job dequeued, finished jobs evicted after ttl")
+    return 0 if not problems else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
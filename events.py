@@ -0,0 +1,252 @@
+# events.py
+import asyncio
+import json
+import logging
+import threading
+import time
+import uuid
+
+from config import (EVENTS_BACKEND, EVENTS_CHANNEL, EVENTS_BUFFER_SIZE, REDIS_URL,
+                    SSE_KEEPALIVE, SSE_RETRY)
+
+# Типы событий маркета
+LISTING_CREATED = 'listing_created'
+LISTING_REMOVED = 'listing_removed'
+PRICE_CHANGED = 'price_changed'
+SOLD = 'sold'
+BALANCE_CHANGED = 'balance_changed'
+# Клиент отстал или переподключился к другому процессу - нужно перечитать данные
+RESET = 'reset'
+
+PING = b': ping\n\n'
+
+def render(event_id, event_type, data):
+    """Событие в формате text/event-stream"""
+    return (f"id: {event_id}\nevent: {event_type}\n"
+            f"data: {json.dumps(data, ensure_ascii=False)}\n\n").encode('utf-8')
+
+class Event:
+    __slots__ = ('seq', 'user_id', 'payload')
+
+    def __init__(self, seq, user_id, payload):
+        self.seq = seq
+        self.user_id = user_id  # None - событие для всех
+        self.payload = payload  # готовые байты, общие для всех соединений
+
+class EventHub:
+    """Pub/sub событий маркета внутри процесса.
+
+    Последние buffer_size событий лежат в общем буфере уже
+    закодированными. Подписчик хранит только номер последнего
+    прочитанного события, поэтому соединение почти не занимает памяти, а
+    публикация не зависит от числа и скорости клиентов: медленный клиент
+    просто отстает и, отстав больше чем на буфер, получает reset вместо
+    пропущенных событий.
+
+    Буфер - неизменяемый кортеж, который публикация заменяет целиком, так
+    что подписчики читают его без блокировок. Ждут они общего
+    threading.Event текущего поколения: публикация будит его и заводит
+    новый, не конкурируя с тысячами проснувшихся потоков за один лок.
+    Корутины (wait_async) ждут asyncio.Event своего event loop - публикация
+    будит каждый loop одним call_soon_threadsafe, сколько бы в нем ни было
+    соединений.
+
+    С broker (см. RedisBroker) публикация идет через него, а в буфер
+    события попадают из подписки - так их видят все процессы.
+    """
+
+    def __init__(self, buffer_size=EVENTS_BUFFER_SIZE, broker=None):
+        # По префиксу Last-Event-ID видно, что клиент пришел из другого процесса
+        self.instance = uuid.uuid4().hex[:8]
+        self.broker = broker
+        self.buffer_size = buffer_size
+        self._buffer = (1, ())  # (номер первого события, события)
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()  # только между публикующими
+        self._loops = {}  # event loop -> asyncio.Event текущего поколения
+        self._listener = None
+
+    def publish(self, event_type, data, user_id=None):
+        """Публикация события (с user_id - только этому пользователю)"""
+        if self.broker is not None:
+            try:
+                self.broker.publish(event_type, data, user_id)
+            except Exception as e:
+                logging.error(f"Error publishing {event_type} event: {e}")
+        else:
+            self._append(event_type, data, user_id)
+
+    def _append(self, event_type, data, user_id=None):
+        with self._lock:
+            first, events = self._buffer
+            seq = first + len(events)
+            event = Event(seq, user_id, render(f"{self.instance}-{seq}", event_type, data))
+            if len(events) >= self.buffer_size:
+                events = events[len(events) - self.buffer_size + 1:]
+            self._buffer = (seq - len(events), events + (event,))
+            wakeup, self._wakeup = self._wakeup, threading.Event()
+            loops = list(self._loops)
+        wakeup.set()
+        for loop in loops:
+            try:
+                loop.call_soon_threadsafe(self._wake_loop, loop)
+            except RuntimeError:
+                # loop закрыт - его соединений больше нет
+                with self._lock:
+                    self._loops.pop(loop, None)
+
+    def _wake_loop(self, loop):
+        wakeup = self._loops.get(loop)
+        if wakeup is not None:
+            self._loops[loop] = asyncio.Event()
+            wakeup.set()
+
+    def head(self):
+        """Номер последнего события"""
+        first, events = self._buffer
+        return first + len(events) - 1
+
+    def resume(self, last_event_id):
+        """Позиция для Last-Event-ID; None - продолжить нельзя"""
+        instance, _, seq = (last_event_id or '').partition('-')
+        if instance != self.instance or not seq.isdigit():
+            return None
+        seq = int(seq)
+        first, events = self._buffer
+        if seq > first + len(events) - 1 or seq < first - 1:
+            return None
+        return seq
+
+    def wait(self, cursor, timeout):
+        """События после cursor (ожидание до timeout секунд).
+
+        Возвращает (события, новый cursor); None вместо списка - клиент
+        отстал больше чем на буфер и cursor перенесен на последнее событие.
+        """
+        # Поколение берется до чтения буфера, чтобы не пропустить публикацию
+        wakeup = self._wakeup
+        if self.head() == cursor:
+            wakeup.wait(timeout)
+        return self._since(cursor)
+
+    async def wait_async(self, cursor, timeout):
+        """То же, что wait, для корутин"""
+        loop = asyncio.get_running_loop()
+        wakeup = self._loops.get(loop)
+        if wakeup is None:
+            with self._lock:
+                wakeup = self._loops[loop] = asyncio.Event()
+        if self.head() == cursor:
+            try:
+                await asyncio.wait_for(wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self._since(cursor)
+
+    def _since(self, cursor):
+        first, events = self._buffer
+        head = first + len(events) - 1
+        if cursor < first - 1:
+            return None, head
+        return events[cursor + 1 - first:], head
+
+    def start(self):
+        """Запуск приема событий из broker"""
+        if self.broker is not None and self._listener is None:
+            self._listener = threading.Thread(target=self._listen, name='event-listener', daemon=True)
+            self._listener.start()
+
+    def _listen(self):
+        while True:
+            try:
+                for event_type, data, user_id in self.broker.listen():
+                    self._append(event_type, data, user_id)
+            except Exception as e:
+                logging.error(f"Event subscription lost: {e}")
+            # Пока подписки не было, события могли потеряться
+            self._append(RESET, {})
+            time.sleep(1)
+
+class RedisBroker:
+    """Доставка событий между процессами через Redis pub/sub"""
+
+    def __init__(self, client=None, url=REDIS_URL, channel=EVENTS_CHANNEL):
+        if client is None:
+            import redis
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self.channel = channel
+
+    def publish(self, event_type, data, user_id=None):
+        self.client.publish(self.channel, json.dumps({'type': event_type, 'data': data, 'user_id': user_id}))
+
+    def listen(self):
+        """События из канала: (тип, данные, user_id)"""
+        pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(self.channel)
+        try:
+            for message in pubsub.listen():
+                event = json.loads(message['data'])
+                yield event['type'], event['data'], event.get('user_id')
+        finally:
+            pubsub.close()
+
+def create_hub(backend=EVENTS_BACKEND):
+    """Хаб событий по настройкам из config.py"""
+    if backend == 'redis':
+        hub = EventHub(broker=RedisBroker())
+        hub.start()
+        return hub
+    return EventHub()
+
+def publish_sale(hub, sale):
+    """События успешной покупки (результат purchase.purchase_nft)"""
+    hub.publish(SOLD, {'nft_id': sale['nft_id'], 'price': sale['amount']})
+    hub.publish(BALANCE_CHANGED, {'delta': -sale['amount'], 'nft_id': sale['nft_id']}, sale['buyer_id'])
+    hub.publish(BALANCE_CHANGED, {'delta': sale['amount'], 'nft_id': sale['nft_id']}, sale['seller_id'])
+
+def _open(hub, last_event_id):
+    """Начало потока: позиция в буфере и стартовые строки"""
+    lines = [f"retry: {SSE_RETRY}\n\n".encode()]
+    cursor = hub.resume(last_event_id)
+    if cursor is None:
+        cursor = hub.head()
+        if last_event_id:
+            # Пропущенные события не восстановить - пусть клиент перечитает данные
+            lines.append(render(f"{hub.instance}-{cursor}", RESET, {}))
+    return cursor, b''.join(lines)
+
+def _chunk(hub, events, cursor, user_id):
+    """Кусок потока по результату hub.wait (b'' - отправлять нечего)"""
+    if events is None:
+        return render(f"{hub.instance}-{cursor}", RESET, {})
+    if not events:
+        return PING
+    return b''.join(
+        event.payload for event in events if event.user_id is None or event.user_id == user_id
+    )
+
+def event_stream(hub, user_id=None, last_event_id=None, keepalive=SSE_KEEPALIVE):
+    """Поток text/event-stream для одного соединения.
+
+    Клиент получает общие события и свои (с его user_id). Генератор
+    блокируется в hub.wait, пока нет событий; записью в сокет управляет
+    WSGI-сервер, так что медленный клиент только отстает в буфере.
+    """
+    cursor, chunk = _open(hub, last_event_id)
+    yield chunk
+    while True:
+        events, cursor = hub.wait(cursor, keepalive)
+        chunk = _chunk(hub, events, cursor, user_id)
+        if chunk:
+            yield chunk
+
+async def async_event_stream(hub, user_id=None, last_event_id=None, keepalive=SSE_KEEPALIVE):
+    """Асинхронный вариант event_stream (см. sse_server.py)"""
+    cursor, chunk = _open(hub, last_event_id)
+    yield chunk
+    while True:
+        events, cursor = await hub.wait_async(cursor, keepalive)
+        chunk = _chunk(hub, events, cursor, user_id)
+        if chunk:
+            yield chunk
@@ -0,0 +1,202 @@
+# export.py
+"""Потоковая выгрузка истории пользователя: его NFT, покупки и продажи.
+
+Строки читаются из базы порциями по EXPORT_CHUNK_SIZE (fetchmany) и сразу
+кодируются в NDJSON или CSV, при необходимости - со сжатием gzip на лету.
+В памяти одновременно только одна порция строк и один кусок ответа,
+поэтому расход памяти не зависит от объема истории. Проверка:
+
+    python export.py memcheck
+    python export.py memcheck --rows 1000000
+"""
+import argparse
+import csv
+import heapq
+import io
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+import zlib
+
+from config import EXPORT_CHUNK_SIZE, EXPORT_BLOCK_SIZE, EXPORT_GZIP_LEVEL
+
+# Общие колонки выгрузки: у NFT и сделок заполнены свои
+EXPORT_FIELDS = (
+    'type', 'id', 'nft_id', 'title', 'file_name', 'description', 'price', 'status', 'views',
+    'role', 'counterparty_id', 'amount_stars', 'amount_rub', 'created_at', 'sold_at'
+)
+
+# Формат -> (Content-Type, расширение файла)
+EXPORT_FORMATS = {
+    'ndjson': ('application/x-ndjson', 'ndjson'),
+    'csv': ('text/csv; charset=utf-8', 'csv'),
+}
+
+# Все запросы идут по индексам в нужном порядке, без сортировки
+NFT_EXPORT_QUERY = '''
+    SELECT 'nft', id, NULL, title, file_name, description, price, status, views,
+           NULL, NULL, NULL, NULL, created_at, sold_at
+    FROM nfts WHERE user_id = ?
+    ORDER BY status, created_at DESC
+'''
+PURCHASES_EXPORT_QUERY = '''
+    SELECT 'transaction', id, nft_id, NULL, NULL, NULL, NULL, status, NULL,
+           'buy', seller_id, amount_stars, amount_rub, created_at, NULL
+    FROM transactions WHERE buyer_id = ?
+    ORDER BY created_at, id
+'''
+SALES_EXPORT_QUERY = '''
+    SELECT 'transaction', id, nft_id, NULL, NULL, NULL, NULL, status, NULL,
+           'sell', buyer_id, amount_stars, amount_rub, created_at, NULL
+    FROM transactions WHERE seller_id = ?
+    ORDER BY created_at, id
+'''
+
+CREATED_AT = EXPORT_FIELDS.index('created_at')
+
+def iter_rows(cursor, chunk_size=EXPORT_CHUNK_SIZE):
+    """Строки курсора, прочитанные порциями по chunk_size"""
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            return
+        yield from rows
+
+def export_rows(conn, user_id, chunk_size=EXPORT_CHUNK_SIZE):
+    """Строки выгрузки (кортежи по EXPORT_FIELDS) из одного снимка базы.
+
+    Сначала NFT пользователя, затем покупки и продажи вперемешку по
+    времени (слияние двух упорядоченных курсоров).
+    """
+    if conn.in_transaction:
+        conn.commit()
+    conn.execute('BEGIN')
+    try:
+        yield from iter_rows(conn.execute(NFT_EXPORT_QUERY, (user_id,)), chunk_size)
+        purchases = iter_rows(conn.execute(PURCHASES_EXPORT_QUERY, (user_id,)), chunk_size)
+        sales = iter_rows(conn.execute(SALES_EXPORT_QUERY, (user_id,)), chunk_size)
+        yield from heapq.merge(purchases, sales, key=lambda row: (row[CREATED_AT] or '', row[1]))
+    finally:
+        conn.rollback()
+
+def ndjson_lines(rows):
+    for row in rows:
+        record = {field: value for field, value in zip(EXPORT_FIELDS, row) if value is not None}
+        yield json.dumps(record, ensure_ascii=False) + '\n'
+
+def csv_lines(rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_FIELDS)
+    for row in rows:
+        writer.writerow(row)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+def encode_blocks(lines, block_size=EXPORT_BLOCK_SIZE):
+    """Строки, склеенные в куски ответа по ~block_size байт"""
+    parts = []
+    size = 0
+    for line in lines:
+        data = line.encode('utf-8')
+        parts.append(data)
+        size += len(data)
+        if size >= block_size:
+            yield b''.join(parts)
+            parts = []
+            size = 0
+    if parts:
+        yield b''.join(parts)
+
+def gzip_blocks(blocks, level=EXPORT_GZIP_LEVEL):
+    """Сжатие потока кусков в gzip на лету"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for block in blocks:
+        data = compressor.compress(block)
+        if data:
+            yield data
+    yield compressor.flush()
+
+def export_stream(conn, user_id, fmt='ndjson', compress=False, chunk_size=EXPORT_CHUNK_SIZE):
+    """Куски ответа выгрузки в формате fmt (см. EXPORT_FORMATS)"""
+    lines = ndjson_lines if fmt == 'ndjson' else csv_lines
+    blocks = encode_blocks(lines(export_rows(conn, user_id, chunk_size)))
+    return gzip_blocks(blocks) if compress else blocks
+
+def _fill(conn, user_id, other_id, rows):
+    """Тестовая история: десятая часть - NFT, остальное - покупки и продажи"""
+    nfts = max(1, rows // 10)
+    conn.executemany(
+        "INSERT INTO nfts (user_id, file_id, file_name, title, price, status) "
+        "VALUES (?, ?, 'file.png', ?, 10, 'owned')",
+        ((user_id, f'f{user_id}_{i}', f'NFT {i}') for i in range(nfts))
+    )
+    conn.executemany(
+        "INSERT INTO transactions (nft_id, buyer_id, seller_id, amount_stars, amount_rub, created_at) "
+        "VALUES (?, ?, ?, 10, 100, datetime('2024-01-01', ? || ' seconds'))",
+        ((i, *((user_id, other_id) if i % 2 else (other_id, user_id)), str(i)) for i in range(rows - nfts))
+    )
+    conn.commit()
+
+def _peak(conn, user_id, fmt, compress):
+    """Пик памяти (tracemalloc), размер и время одной выгрузки"""
+    tracemalloc.start()
+    started = time.perf_counter()
+    size = 0
+    for block in export_stream(conn, user_id, fmt, compress):
+        size += len(block)
+    elapsed = time.perf_counter() - started
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak, size, elapsed
+
+def memcheck(rows, slack=256 * 1024):
+    """Пик памяти выгрузки для истории из 10, rows / 10 и rows строк.
+
+    Пик ограничен одной порцией fetchmany, поэтому при росте истории
+    в 10 раз он не должен вырасти больше чем на slack байт.
+    """
+    from database import Database
+
+    sizes = {1: 10, 2: max(10, rows // 10), 3: rows}
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'export.db')
+        Database(path).close()
+        conn = sqlite3.connect(path)
+        conn.executemany('INSERT INTO users (telegram_id, username) VALUES (?, ?)',
+                         [(user_id, f'user{user_id}') for user_id in (*sizes, 4)])
+        started = time.perf_counter()
+        for user_id, count in sizes.items():
+            _fill(conn, user_id, 4, count)
+        print(f"filled {sum(sizes.values())} rows in {time.perf_counter() - started:.1f}s")
+
+        ok = True
+        for fmt in EXPORT_FORMATS:
+            for compress in (False, True):
+                peaks = {}
+                for user_id, count in sizes.items():
+                    peaks[count], size, elapsed = _peak(conn, user_id, fmt, compress)
+                print(f"{fmt}{'.gz' if compress else ''}: {rows} rows -> {size / 1e6:.1f} MB in "
+                      f"{elapsed:.1f}s (traced); peak " +
+                      ', '.join(f"{peak / 1024:.0f} KB @ {count}" for count, peak in peaks.items()))
+                ok = ok and peaks[rows] - peaks[sizes[2]] <= slack
+        conn.close()
+
+    print(f"{'✅' if ok else '❌'} peak memory flat from {sizes[2]} to {rows} rows (slack {slack // 1024} KB)")
+    return ok
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Выгрузка истории профиля')
+    parser.add_argument('command', choices=['memcheck'])
+    parser.add_argument('--rows', type=int, default=1000000, help='Строк в большой истории')
+    args = parser.parse_args(argv)
+    return 0 if memcheck(args.rows) else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
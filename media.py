@@ -0,0 +1,122 @@
+# media.py
+import os
+
+from aiogram import types
+from aiogram.utils.exceptions import BadRequest
+
+# file_type NFT -> (метод Bot API, параметр с файлом)
+SEND_METHODS = {
+    'photo': ('send_photo', 'photo'),
+    'image': ('send_photo', 'photo'),
+    'video': ('send_video', 'video'),
+    'animation': ('send_animation', 'animation'),
+    'document': ('send_document', 'document'),
+}
+
+# Что можно собрать в альбом (документы с фото и видео не смешиваются)
+GROUP_MEDIA = {
+    'photo': types.InputMediaPhoto,
+    'image': types.InputMediaPhoto,
+    'video': types.InputMediaVideo,
+}
+MEDIA_GROUP_LIMIT = 10
+
+def sent_file_id(message):
+    """file_id файла из отправленного сообщения"""
+    if message.photo:
+        return message.photo[-1].file_id
+    for attr in ('video', 'animation', 'document'):
+        media = getattr(message, attr)
+        if media:
+            return media.file_id
+    return None
+
+def gallery_caption(nft):
+    return f"{nft['title'] or nft['file_name']} — {nft['price']} ⭐️ (#{nft['id']})"
+
+class NFTMedia:
+    """Отправка файлов NFT с кэшем file_id для каждого бота.
+
+    file_id в Telegram действует только для бота, которому он выдан, а
+    nfts.file_id выдан боту-приемнику. Поэтому в первый раз бот
+    отправляет локальную копию файла (или исходный file_id, если копии
+    нет), а file_id из ответа сохраняет в bot_file_ids - дальше файл
+    уходит без повторной загрузки.
+    """
+
+    def __init__(self, bot, db, outbound):
+        self.bot = bot
+        self.db = db  # AsyncDatabase
+        self.outbound = outbound
+
+    async def send(self, chat_id, nft, caption=None, reply_markup=None):
+        """Отправка файла NFT одним сообщением"""
+        method, field = SEND_METHODS.get(nft['file_type'], SEND_METHODS['document'])
+
+        async def send_once(cached):
+            source, from_cache = self._source(nft, cached)
+            message = await self.outbound.send(
+                method, chat_id, caption=caption, reply_markup=reply_markup, **{field: source}
+            )
+            if not from_cache:
+                await self._remember([(nft, message)])
+            return message
+
+        cached = await self.db.get_bot_file_ids(self.bot.id, [nft['file_id']])
+        try:
+            return await send_once(cached)
+        except BadRequest:
+            if not cached:
+                raise
+            # file_id из кэша больше не принимается - загружаем заново
+            await self.db.delete_bot_file_ids(self.bot.id, list(cached))
+            return await send_once({})
+
+    async def send_gallery(self, chat_id, nfts):
+        """Фото и видео из nfts (до 10) одним альбомом, возвращает показанные NFT"""
+        items = [nft for nft in nfts if nft['file_type'] in GROUP_MEDIA][:MEDIA_GROUP_LIMIT]
+        if len(items) < 2:
+            # Альбом - минимум из двух файлов
+            for nft in items:
+                await self.send(chat_id, nft, caption=gallery_caption(nft))
+            return items
+
+        async def send_once(cached):
+            media = types.MediaGroup()
+            fresh = []
+            for nft in items:
+                source, from_cache = self._source(nft, cached)
+                media.attach(GROUP_MEDIA[nft['file_type']](source, caption=gallery_caption(nft)))
+                fresh.append(not from_cache)
+            messages = await self.outbound.send('send_media_group', chat_id, media=media)
+            await self._remember([
+                (nft, message) for nft, message, is_fresh in zip(items, messages, fresh) if is_fresh
+            ])
+
+        cached = await self.db.get_bot_file_ids(self.bot.id, [nft['file_id'] for nft in items])
+        try:
+            await send_once(cached)
+        except BadRequest:
+            if not cached:
+                raise
+            await self.db.delete_bot_file_ids(self.bot.id, list(cached))
+            await send_once({})
+        return items
+
+    def _source(self, nft, cached):
+        """Что отправлять: file_id этого бота, локальный файл или исходный file_id"""
+        file_id = cached.get(nft['file_id'])
+        if file_id:
+            return file_id, True
+        if nft['file_path'] and os.path.exists(nft['file_path']):
+            return types.InputFile(nft['file_path'], filename=nft['file_name']), False
+        return nft['file_id'], False
+
+    async def _remember(self, sent):
+        pairs = []
+        for nft, message in sent:
+            file_id = sent_file_id(message)
+            if file_id:
+                pairs.append((nft['file_id'], file_id))
+        if pairs:
+            await self.db.set_bot_file_ids(self.bot.id, pairs)
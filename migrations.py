@@ -0,0 +1,434 @@
+# migrations.py
+"""Версионированные миграции схемы и проверка планов горячих запросов.
+
+Миграции применяют database.Database и models.init_schema. Проверка
+строит EXPLAIN QUERY PLAN для запросов маркета, инвентаря, статистики и
+уборки кодов передачи и убеждается, что они идут по своим индексам:
+
+    python migrations.py check
+    python migrations.py check --db nft_market.db
+"""
+import argparse
+import logging
+import os
+import sqlite3
+import sys
+import tempfile
+
+from aggregates import rebuild_aggregates, rebuild_user_stats
+from search import PREFIX_LENGTHS, fts_values
+
+def move_upload_sessions(conn):
+    """Шаг миграции 13: сессии мастера загрузки из user_states в свою таблицу
+    (user_states создает только database.Database)"""
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'user_states'").fetchone():
+        conn.execute(
+            "INSERT OR REPLACE INTO upload_sessions (user_id, session_id, data, updated_at) "
+            "SELECT user_id, json_extract(data, '$.session_id'), data, updated_at FROM user_states "
+            "WHERE action = 'upload_wizard' AND json_extract(data, '$.session_id') IS NOT NULL"
+        )
+        conn.execute("DELETE FROM user_states WHERE action = 'upload_wizard'")
+
+def add_column(table, column, definition):
+    """Шаг миграции: ALTER TABLE ADD COLUMN, если колонки еще нет
+    (таблицу могла уже создать db.create_all() по моделям)"""
+    def step(conn):
+        columns = [row[1] for row in conn.execute(f'PRAGMA table_info({table})')]
+        if column not in columns:
+            conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+    return step
+
+# Версионированные миграции схемы. Номер текущей версии хранится в
+# PRAGMA user_version, поэтому каждая миграция применяется ровно один раз.
+# Используется и ботами (database.Database), и сайтом (models / app.py).
+MIGRATIONS = [
+    (1, 'indexes for hot queries', [
+        # Маркет: WHERE status = 'for_sale' ORDER BY created_at DESC
+        'CREATE INDEX IF NOT EXISTS idx_nfts_status_created '
+        'ON nfts (status, created_at DESC, id DESC)',
+        # Инвентарь: WHERE user_id = ? [AND status = ?] ORDER BY created_at DESC
+        'CREATE INDEX IF NOT EXISTS idx_nfts_user_status_created '
+        'ON nfts (user_id, status, created_at DESC)',
+        # Статистика: SUM(amount_stars) по продавцу / покупателю (покрывающие)
+        'CREATE INDEX IF NOT EXISTS idx_transactions_seller_amount '
+        'ON transactions (seller_id, amount_stars)',
+        'CREATE INDEX IF NOT EXISTS idx_transactions_buyer_amount '
+        'ON transactions (buyer_id, amount_stars)',
+        # Поиск просроченных кодов передачи
+        'CREATE INDEX IF NOT EXISTS idx_transfer_requests_status_expires '
+        'ON transfer_requests (status, expires_at)',
+        'ANALYZE',
+    ]),
+    (2, 'maintained counters', [
+        # Счетчики, поддерживаемые триггерами вместо COUNT(*)
+        'CREATE TABLE IF NOT EXISTS counters ('
+        'name TEXT PRIMARY KEY, value INTEGER NOT NULL DEFAULT 0)',
+        "INSERT OR REPLACE INTO counters (name, value) "
+        "SELECT 'active_listings', COUNT(*) FROM nfts WHERE status = 'for_sale'",
+        "CREATE TRIGGER IF NOT EXISTS trg_nfts_listing_insert "
+        "AFTER INSERT ON nfts WHEN NEW.status = 'for_sale' BEGIN "
+        "UPDATE counters SET value = value + 1 WHERE name = 'active_listings'; END",
+        "CREATE TRIGGER IF NOT EXISTS trg_nfts_listing_delete "
+        "AFTER DELETE ON nfts WHEN OLD.status = 'for_sale' BEGIN "
+        "UPDATE counters SET value = value - 1 WHERE name = 'active_listings'; END",
+        "CREATE TRIGGER IF NOT EXISTS trg_nfts_listing_update "
+        "AFTER UPDATE OF status ON nfts "
+        "WHEN IFNULL(OLD.status = 'for_sale', 0) != IFNULL(NEW.status = 'for_sale', 0) BEGIN "
+        "UPDATE counters SET value = value + (CASE WHEN NEW.status = 'for_sale' THEN 1 ELSE -1 END) "
+        "WHERE name = 'active_listings'; END",
+    ]),
+    (3, 'content-addressed blobs', [
+        add_column('nfts', 'content_hash', 'TEXT'),
+        'CREATE INDEX IF NOT EXISTS idx_nfts_content_hash ON nfts (content_hash)',
+        # Файлы в хранилище по SHA-256; ref_count поддерживается триггерами
+        'CREATE TABLE IF NOT EXISTS blobs ('
+        'content_hash TEXT PRIMARY KEY, size INTEGER, '
+        'ref_count INTEGER NOT NULL DEFAULT 0, '
+        'created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)',
+        'CREATE INDEX IF NOT EXISTS idx_blobs_unreferenced '
+        'ON blobs (created_at) WHERE ref_count <= 0',
+        "INSERT OR IGNORE INTO blobs (content_hash, ref_count) "
+        "SELECT content_hash, COUNT(*) FROM nfts WHERE content_hash IS NOT NULL GROUP BY content_hash",
+        "CREATE TRIGGER IF NOT EXISTS trg_nfts_blob_insert "
+        "AFTER INSERT ON nfts WHEN NEW.content_hash IS NOT NULL BEGIN "
+        "INSERT INTO blobs (content_hash, ref_count) VALUES (NEW.content_hash, 1) "
+        "ON CONFLICT (content_hash) DO UPDATE SET ref_count = ref_count + 1; END",
+        "CREATE TRIGGER IF NOT EXISTS trg_nfts_blob_delete "
+        "AFTER DELETE ON nfts WHEN OLD.content_hash IS NOT NULL BEGIN "
+        "UPDATE blobs SET ref_count = ref_count - 1 WHERE content_hash = OLD.content_hash; END",
+        "CREATE TRIGGER IF NOT EXISTS trg_nfts_blob_update "
+        "AFTER UPDATE OF content_hash ON nfts "
+        "WHEN OLD.content_hash IS NOT NEW.content_hash BEGIN "
+        "UPDATE blobs SET ref_count = ref_count - 1 WHERE content_hash = OLD.content_hash; "
+        "INSERT INTO blobs (content_hash, ref_count) SELECT NEW.content_hash, 1 "
+        "WHERE NEW.content_hash IS NOT NULL "
+        "ON CONFLICT (content_hash) DO UPDATE SET ref_count = ref_count + 1; END",
+    ]),
+    (4, 'transfer code archive', [
+        # Использованные и просроченные коды (переносит transfers.TransferReaper)
+        'CREATE TABLE IF NOT EXISTS transfer_requests_archive ('
+        'id INTEGER PRIMARY KEY, nft_id INTEGER, from_user_id INTEGER, to_user_id INTEGER, '
+        'transfer_code TEXT, status TEXT, created_at TIMESTAMP, expires_at TIMESTAMP, '
+        'archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)',
+        'CREATE INDEX IF NOT EXISTS idx_transfer_requests_archive_nft '
+        'ON transfer_requests_archive (nft_id)',
+    ]),
+    (5, 'notification outbox', [
+        # События пишутся в транзакции сделки, доставляет outbox.OutboxDispatcher
+        'CREATE TABLE IF NOT EXISTS outbox ('
+        'id INTEGER PRIMARY KEY AUTOINCREMENT, event_id TEXT NOT NULL UNIQUE, '
+        'topic TEXT NOT NULL, payload TEXT NOT NULL, '
+        "status TEXT NOT NULL DEFAULT 'pending', attempts INTEGER NOT NULL DEFAULT 0, "
+        'next_attempt_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, last_error TEXT, '
+        'created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, sent_at TIMESTAMP)',
+        'CREATE INDEX IF NOT EXISTS idx_outbox_pending '
+        "ON outbox (next_attempt_at) WHERE status = 'pending'",
+        'CREATE INDEX IF NOT EXISTS idx_outbox_sent '
+        "ON outbox (sent_at) WHERE status = 'sent'",
+    ]),
+    (6, 'per-bot file ids', [
+        # file_id действует только для выдавшего его бота: кэш media.NFTMedia
+        'CREATE TABLE IF NOT EXISTS bot_file_ids ('
+        'bot_id INTEGER NOT NULL, source_file_id TEXT NOT NULL, file_id TEXT NOT NULL, '
+        'created_at DATETIME DEFAULT CURRENT_TIMESTAMP, '
+        'PRIMARY KEY (bot_id, source_file_id)) WITHOUT ROWID',
+    ]),
+    (7, 'platform aggregates', [
+        # Итоги для главной страницы в counters, см. aggregates.py
+        rebuild_aggregates,
+        "CREATE TRIGGER IF NOT EXISTS trg_users_total_insert AFTER INSERT ON users BEGIN "
+        "UPDATE counters SET value = value + 1 WHERE name = 'total_users'; END",
+        "CREATE TRIGGER IF NOT EXISTS trg_users_total_delete AFTER DELETE ON users BEGIN "
+        "UPDATE counters SET value = value - 1 WHERE name = 'total_users'; END",
+        "CREATE TRIGGER IF NOT EXISTS trg_nfts_total_insert AFTER INSERT ON nfts BEGIN "
+        "UPDATE counters SET value = value + CASE name WHEN 'total_nfts' THEN 1 "
+        "ELSE IFNULL(NEW.views, 0) END WHERE name IN ('total_nfts', 'total_views'); END",
+        "CREATE TRIGGER IF NOT EXISTS trg_nfts_total_delete AFTER DELETE ON nfts BEGIN "
+        "UPDATE counters SET value = value - CASE name WHEN 'total_nfts' THEN 1 "
+        "ELSE IFNULL(OLD.views, 0) END WHERE name IN ('total_nfts', 'total_views'); END",
+        # Срабатывает на каждую строку пакетной записи просмотров
+        "CREATE TRIGGER IF NOT EXISTS trg_nfts_views_update AFTER UPDATE OF views ON nfts "
+        "WHEN IFNULL(NEW.views, 0) != IFNULL(OLD.views, 0) BEGIN "
+        "UPDATE counters SET value = value + IFNULL(NEW.views, 0) - IFNULL(OLD.views, 0) "
+        "WHERE name = 'total_views'; END",
+        "CREATE TRIGGER IF NOT EXISTS trg_transactions_total_insert AFTER INSERT ON transactions "
+        "WHEN NEW.status = 'completed' BEGIN "
+        "UPDATE counters SET value = value + CASE name WHEN 'total_sales' THEN 1 "
+        "ELSE IFNULL(NEW.amount_stars, 0) END WHERE name IN ('total_sales', 'total_volume'); END",
+        "CREATE TRIGGER IF NOT EXISTS trg_transactions_total_delete AFTER DELETE ON transactions "
+        "WHEN OLD.status = 'completed' BEGIN "
+        "UPDATE counters SET value = value - CASE name WHEN 'total_sales' THEN 1 "
+        "ELSE IFNULL(OLD.amount_stars, 0) END WHERE name IN ('total_sales', 'total_volume'); END",
+        # Смена статуса или суммы: вычитаем старый вклад и добавляем новый
+        "CREATE TRIGGER IF NOT EXISTS trg_transactions_total_update "
+        "AFTER UPDATE OF status, amount_stars ON transactions BEGIN "
+        "UPDATE counters SET value = value "
+        "- (OLD.status IS 'completed') * CASE name WHEN 'total_sales' THEN 1 ELSE IFNULL(OLD.amount_stars, 0) END "
+        "+ (NEW.status IS 'completed') * CASE name WHEN 'total_sales' THEN 1 ELSE IFNULL(NEW.amount_stars, 0) END "
+        "WHERE name IN ('total_sales', 'total_volume'); END",
+        # Популярные лоты: WHERE status = 'for_sale' ORDER BY views DESC LIMIT N
+        'CREATE INDEX IF NOT EXISTS idx_nfts_status_views '
+        'ON nfts (status, views DESC, id DESC)',
+    ]),
+    (8, 'per-user stats', [
+        # Статистика профиля; version меняется при каждом изменении и
+        # служит ETag для /api/profile/stats
+        'CREATE TABLE IF NOT EXISTS user_stats ('
+        'user_id INTEGER PRIMARY KEY, total_nfts INTEGER NOT NULL DEFAULT 0, '
+        'sold_nfts INTEGER NOT NULL DEFAULT 0, earned INTEGER NOT NULL DEFAULT 0, '
+        'spent INTEGER NOT NULL DEFAULT 0, version INTEGER NOT NULL DEFAULT 1)',
+        rebuild_user_stats,
+        # Владение NFT: старому владельцу -1, новому +1 (и то же для проданных)
+        "CREATE TRIGGER IF NOT EXISTS trg_nfts_user_stats_insert AFTER INSERT ON nfts BEGIN "
+        "INSERT INTO user_stats (user_id, total_nfts, sold_nfts) "
+        "SELECT NEW.user_id, 1, NEW.status IS 'sold' WHERE NEW.user_id IS NOT NULL "
+        "ON CONFLICT (user_id) DO UPDATE SET total_nfts = total_nfts + 1, "
+        "sold_nfts = sold_nfts + excluded.sold_nfts, version = version + 1; END",
+        "CREATE TRIGGER IF NOT EXISTS trg_nfts_user_stats_delete AFTER DELETE ON nfts BEGIN "
+        "UPDATE user_stats SET total_nfts = total_nfts - 1, "
+        "sold_nfts = sold_nfts - (OLD.status IS 'sold'), version = version + 1 "
+        "WHERE user_id = OLD.user_id; END",
+        "CREATE TRIGGER IF NOT EXISTS trg_nfts_user_stats_update AFTER UPDATE OF user_id, status ON nfts "
+        "WHEN OLD.user_id IS NOT NEW.user_id OR OLD.status IS NOT NEW.status BEGIN "
+        "UPDATE user_stats SET total_nfts = total_nfts - 1, "
+        "sold_nfts = sold_nfts - (OLD.status IS 'sold'), version = version + 1 "
+        "WHERE user_id = OLD.user_id; "
+        "INSERT INTO user_stats (user_id, total_nfts, sold_nfts) "
+        "SELECT NEW.user_id, 1, NEW.status IS 'sold' WHERE NEW.user_id IS NOT NULL "
+        "ON CONFLICT (user_id) DO UPDATE SET total_nfts = total_nfts + 1, "
+        "sold_nfts = sold_nfts + excluded.sold_nfts, version = version + 1; END",
+        # Заработано продавцом и потрачено покупателем
+        "CREATE TRIGGER IF NOT EXISTS trg_transactions_user_stats_insert AFTER INSERT ON transactions BEGIN "
+        "INSERT INTO user_stats (user_id, earned) "
+        "SELECT NEW.seller_id, IFNULL(NEW.amount_stars, 0) WHERE NEW.seller_id IS NOT NULL "
+        "ON CONFLICT (user_id) DO UPDATE SET earned = earned + excluded.earned, version = version + 1; "
+        "INSERT INTO user_stats (user_id, spent) "
+        "SELECT NEW.buyer_id, IFNULL(NEW.amount_stars, 0) WHERE NEW.buyer_id IS NOT NULL "
+        "ON CONFLICT (user_id) DO UPDATE SET spent = spent + excluded.spent, version = version + 1; END",
+        "CREATE TRIGGER IF NOT EXISTS trg_transactions_user_stats_delete AFTER DELETE ON transactions BEGIN "
+        "UPDATE user_stats SET earned = earned - IFNULL(OLD.amount_stars, 0), version = version + 1 "
+        "WHERE user_id = OLD.seller_id; "
+        "UPDATE user_stats SET spent = spent - IFNULL(OLD.amount_stars, 0), version = version + 1 "
+        "WHERE user_id = OLD.buyer_id; END",
+        "CREATE TRIGGER IF NOT EXISTS trg_transactions_user_stats_update "
+        "AFTER UPDATE OF amount_stars, seller_id, buyer_id ON transactions BEGIN "
+        "UPDATE user_stats SET earned = earned - IFNULL(OLD.amount_stars, 0), version = version + 1 "
+        "WHERE user_id = OLD.seller_id; "
+        "UPDATE user_stats SET spent = spent - IFNULL(OLD.amount_stars, 0), version = version + 1 "
+        "WHERE user_id = OLD.buyer_id; "
+        "INSERT INTO user_stats (user_id, earned) "
+        "SELECT NEW.seller_id, IFNULL(NEW.amount_stars, 0) WHERE NEW.seller_id IS NOT NULL "
+        "ON CONFLICT (user_id) DO UPDATE SET earned = earned + excluded.earned, version = version + 1; "
+        "INSERT INTO user_stats (user_id, spent) "
+        "SELECT NEW.buyer_id, IFNULL(NEW.amount_stars, 0) WHERE NEW.buyer_id IS NOT NULL "
+        "ON CONFLICT (user_id) DO UPDATE SET spent = spent + excluded.spent, version = version + 1; END",
+        # Баланс тоже отдается в статистике - меняем версию
+        "CREATE TRIGGER IF NOT EXISTS trg_users_balance_version AFTER UPDATE OF balance_stars ON users "
+        "WHEN OLD.balance_stars IS NOT NEW.balance_stars BEGIN "
+        "INSERT INTO user_stats (user_id) SELECT NEW.id WHERE true "
+        "ON CONFLICT (user_id) DO UPDATE SET version = version + 1; END",
+    ]),
+    (9, 'transaction history indexes', [
+        # История покупок/продаж по времени для выгрузки профиля (без
+        # сортировки во временном B-дереве). Покрывающие индексы для
+        # SUM(amount_stars) больше не нужны: суммы - в user_stats
+        'CREATE INDEX IF NOT EXISTS idx_transactions_buyer_created '
+        'ON transactions (buyer_id, created_at)',
+        'CREATE INDEX IF NOT EXISTS idx_transactions_seller_created '
+        'ON transactions (seller_id, created_at)',
+        'DROP INDEX IF EXISTS idx_transactions_seller_amount',
+        'DROP INDEX IF EXISTS idx_transactions_buyer_amount',
+    ]),
+    (10, 'listing search', [
+        # Полнотекстовый индекс лотов на продаже (см. search.py). Тексты
+        # не дублируются: content='nfts', в индексе - только слова
+        "CREATE VIRTUAL TABLE IF NOT EXISTS nfts_fts USING fts5("
+        "title, description, file_name, content='nfts', content_rowid='id', "
+        f"tokenize='unicode61 remove_diacritics 2', prefix='{' '.join(map(str, PREFIX_LENGTHS))}')",
+        "INSERT INTO nfts_fts (rowid, title, description, file_name) "
+        f"SELECT id, {fts_values('nfts')} FROM nfts WHERE status = 'for_sale'",
+        # Удаление из external content индекса требует тех же значений, что
+        # были записаны, поэтому OLD проходит то же преобразование
+        "CREATE TRIGGER IF NOT EXISTS trg_nfts_fts_insert AFTER INSERT ON nfts "
+        "WHEN NEW.status = 'for_sale' BEGIN "
+        "INSERT INTO nfts_fts (rowid, title, description, file_name) "
+        f"VALUES (NEW.id, {fts_values('NEW')}); END",
+        "CREATE TRIGGER IF NOT EXISTS trg_nfts_fts_delete AFTER DELETE ON nfts "
+        "WHEN OLD.status = 'for_sale' BEGIN "
+        "INSERT INTO nfts_fts (nfts_fts, rowid, title, description, file_name) "
+        f"VALUES ('delete', OLD.id, {fts_values('OLD')}); END",
+        # Снятие с продажи, выставление и правка текста: старую запись
+        # удаляем, новую добавляем - в одном триггере, чтобы порядок был точно такой
+        "CREATE TRIGGER IF NOT EXISTS trg_nfts_fts_update "
+        "AFTER UPDATE OF title, description, file_name, status ON nfts "
+        "WHEN OLD.status = 'for_sale' OR NEW.status = 'for_sale' BEGIN "
+        "INSERT INTO nfts_fts (nfts_fts, rowid, title, description, file_name) "
+        f"SELECT 'delete', OLD.id, {fts_values('OLD')} WHERE OLD.status = 'for_sale'; "
+        "INSERT INTO nfts_fts (rowid, title, description, file_name) "
+        f"SELECT NEW.id, {fts_values('NEW')} WHERE NEW.status = 'for_sale'; END",
+    ]),
+    (11, 'nft created_at default', [
+        # Таблица, созданная db.create_all(), не имеет DEFAULT у created_at,
+        # и NFT от ботов получали NULL - а keyset-пагинация маркета по
+        # (created_at, id) такие строки теряет
+        "UPDATE nfts SET created_at = CURRENT_TIMESTAMP WHERE created_at IS NULL",
+        "CREATE TRIGGER IF NOT EXISTS trg_nfts_created_at AFTER INSERT ON nfts "
+        "WHEN NEW.created_at IS NULL BEGIN "
+        "UPDATE nfts SET created_at = CURRENT_TIMESTAMP WHERE id = NEW.id; END",
+    ]),
+    (12, 'listing version', [
+        # Версия листингов для кэшей всех процессов (см. cache.ListingCache):
+        # меняется в той же транзакции, что и лот, кто бы его ни записал.
+        # Просмотры версию не меняют - кэш учитывает их через views_mark
+        "INSERT OR IGNORE INTO counters (name, value) VALUES ('listing_version', 0)",
+        "CREATE TRIGGER IF NOT EXISTS trg_nfts_version_insert AFTER INSERT ON nfts BEGIN "
+        "UPDATE counters SET value = value + 1 WHERE name = 'listing_version'; END",
+        "CREATE TRIGGER IF NOT EXISTS trg_nfts_version_delete AFTER DELETE ON nfts BEGIN "
+        "UPDATE counters SET value = value + 1 WHERE name = 'listing_version'; END",
+        "CREATE TRIGGER IF NOT EXISTS trg_nfts_version_update AFTER UPDATE OF "
+        "user_id, file_id, file_name, file_path, file_size, file_type, title, description, "
+        "price, status, content_hash, created_at ON nfts BEGIN "
+        "UPDATE counters SET value = value + 1 WHERE name = 'listing_version'; END",
+        # Имя продавца входит в страницы маркета
+        "CREATE TRIGGER IF NOT EXISTS trg_users_version_update AFTER UPDATE OF username ON users "
+        "WHEN OLD.username IS NOT NEW.username BEGIN "
+        "UPDATE counters SET value = value + 1 WHERE name = 'listing_version'; END",
+    ]),
+    (13, 'upload sessions', [
+        # Мастер загрузки (sessions.PersistentSessionStore) и состояния
+        # main-бота (user_states) - разные диалоги: в одной таблице по
+        # user_id они затирали друг друга
+        'CREATE TABLE IF NOT EXISTS upload_sessions ('
+        'user_id INTEGER PRIMARY KEY, session_id TEXT NOT NULL, data TEXT NOT NULL, '
+        'updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)',
+        move_upload_sessions,
+    ]),
+]
+
+def get_schema_version(conn):
+    """Текущая версия схемы"""
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+def apply_migrations(conn):
+    """Применение всех непримененных миграций к sqlite3-соединению"""
+    if conn.in_transaction:
+        conn.commit()
+
+    current = get_schema_version(conn)
+    for version, name, statements in MIGRATIONS:
+        if version <= current:
+            continue
+
+        logging.info(f"Applying migration {version}: {name}")
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            # Другой процесс мог успеть применить миграцию
+            if get_schema_version(conn) >= version:
+                conn.rollback()
+                continue
+            for statement in statements:
+                if callable(statement):
+                    statement(conn)
+                else:
+                    conn.execute(statement)
+            conn.execute(f'PRAGMA user_version = {int(version)}')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        current = version
+
+    return current
+
+# Горячие запросы: (название, запрос, строка, которая должна быть в плане,
+# сортировка должна идти по индексу)
+PLAN_CHECKS = [
+    ('market page',
+     "SELECT id FROM nfts WHERE status = 'for_sale' ORDER BY created_at DESC, id DESC LIMIT 13",
+     'INDEX idx_nfts_status_created', True),
+    ('market next page',
+     "SELECT id FROM nfts WHERE status = 'for_sale' AND (created_at, id) < (:created_at, :id) "
+     "ORDER BY created_at DESC, id DESC LIMIT 13",
+     'INDEX idx_nfts_status_created', True),
+    ('market previous page',
+     "SELECT id FROM nfts WHERE status = 'for_sale' AND (created_at, id) > (:created_at, :id) "
+     "ORDER BY created_at ASC, id ASC LIMIT 13",
+     'INDEX idx_nfts_status_created', True),
+    ('popular listings',
+     "SELECT id FROM nfts WHERE status = 'for_sale' ORDER BY views DESC, id DESC LIMIT 4",
+     'INDEX idx_nfts_status_views', True),
+    ('inventory by status',
+     'SELECT id FROM nfts WHERE user_id = :user_id AND status = :status ORDER BY created_at DESC',
+     'INDEX idx_nfts_user_status_created', True),
+    # Без статуса порядок по created_at внутри пользователя не индексный
+    ('inventory',
+     'SELECT id FROM nfts WHERE user_id = :user_id ORDER BY created_at DESC',
+     'INDEX idx_nfts_user_status_created', False),
+    ('profile stats',
+     'SELECT s.total_nfts, u.balance_stars FROM users u '
+     'LEFT JOIN user_stats s ON s.user_id = u.id WHERE u.id = :user_id',
+     'SEARCH s USING INTEGER PRIMARY KEY', True),
+    ('sales history',
+     'SELECT id FROM transactions WHERE seller_id = :user_id ORDER BY created_at, id',
+     'INDEX idx_transactions_seller_created', True),
+    ('purchases history',
+     'SELECT id FROM transactions WHERE buyer_id = :user_id ORDER BY created_at, id',
+     'INDEX idx_transactions_buyer_created', True),
+    ('expired transfer codes',
+     "SELECT id FROM transfer_requests WHERE status = 'pending' AND expires_at <= datetime('now') LIMIT 1000",
+     'INDEX idx_transfer_requests_status_expires', True),
+    ('transfer codes to archive',
+     "SELECT id FROM transfer_requests WHERE status IN ('completed', 'expired') "
+     "AND expires_at < datetime('now', '-1 day') LIMIT 1000",
+     'INDEX idx_transfer_requests_status_expires', True),
+]
+
+PLAN_PARAMS = {'created_at': '2024-01-01 00:00:00', 'id': 1, 'user_id': 1, 'status': 'owned'}
+
+def query_plan(conn, query):
+    """Строки EXPLAIN QUERY PLAN запроса"""
+    return [row[3] for row in conn.execute(f'EXPLAIN QUERY PLAN {query}', PLAN_PARAMS)]
+
+def check_plans(conn):
+    """Запросы из PLAN_CHECKS, план которых не тот: {название: план}"""
+    problems = {}
+    for name, query, expected, ordered in PLAN_CHECKS:
+        plan = query_plan(conn, query)
+        uses_index = any(expected in line for line in plan)
+        full_scan = any(line.startswith('SCAN ') for line in plan)
+        sorts = any('TEMP B-TREE' in line for line in plan)
+        if not uses_index or full_scan or (ordered and sorts):
+            problems[name] = plan
+    return problems
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Миграции схемы')
+    parser.add_argument('command', choices=['check'])
+    parser.add_argument('--db', help='Путь к базе (по умолчанию - новая временная)')
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = args.db
+        if path is None:
+            from database import Database
+
+            path = os.path.join(tmp, 'migrations.db')
+            Database(path).close()
+        conn = sqlite3.connect(path)
+        try:
+            version = get_schema_version(conn)
+            problems = check_plans(conn)
+        finally:
+            conn.close()
+
+    for name, plan in problems.items():
+        print(f"❌ {name}: {'; '.join(plan)}")
+    if version != MIGRATIONS[-1][0]:
+        print(f"❌ schema version {version}, latest migration {MIGRATIONS[-1][0]}")
+    ok = not problems and version == MIGRATIONS[-1][0]
+    if ok:
+        print(f"✅ schema version {version}, {len(PLAN_CHECKS)} hot queries use their indexes")
+    return 0 if ok else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,10 +1,13 @@
 # models.py
 from flask_sqlalchemy import SQLAlchemy
+from flask_login import UserMixin
 from datetime import datetime
 
+from migrations import apply_migrations
+
 db = SQLAlchemy()
 
-class User(db.Model):
+class User(UserMixin, db.Model):
     __tablename__ = 'users'
     
     id = db.Column(db.Integer, primary_key=True)
@@ -36,6 +39,7 @@ class NFT(db.Model):
     views = db.Column(db.Integer, default=0)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     sold_at = db.Column(db.DateTime)
+    content_hash = db.Column(db.String(64))  # SHA-256 файла, индекс - в migrations.py
     
     transaction = db.relationship('Transaction', backref='nft', uselist=False)
 
@@ -51,6 +55,12 @@ class Transaction(db.Model):
     status = db.Column(db.String(50), default='completed')
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+class Counter(db.Model):
+    __tablename__ = 'counters'  # поддерживается триггерами, см. migrations.py
+    
+    name = db.Column(db.String(50), primary_key=True)
+    value = db.Column(db.Integer, nullable=False, default=0)
+
 class TransferRequest(db.Model):
     __tablename__ = 'transfer_requests'
     
@@ -61,4 +71,13 @@ class TransferRequest(db.Model):
     transfer_code = db.Column(db.String(100), unique=True)
     status = db.Column(db.String(50), default='pending')  # pending, completed, expired
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    expires_at = db.Column(db.DateTime)
\ No newline at end of file
+    expires_at = db.Column(db.DateTime)
+
+def init_schema():
+    """Создание таблиц и применение миграций (нужен контекст приложения)"""
+    db.create_all()
+    raw_conn = db.engine.raw_connection()
+    try:
+        apply_migrations(raw_conn.dbapi_connection)
+    finally:
+        raw_conn.close()
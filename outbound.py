@@ -0,0 +1,256 @@
+# outbound.py
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+
+from aiogram.utils.exceptions import RetryAfter, NetworkError
+
+from config import (OUTBOUND_GLOBAL_RATE, OUTBOUND_CHAT_RATE, OUTBOUND_GROUP_RATE,
+                    OUTBOUND_RETRIES, OUTBOUND_MAX_BUCKETS)
+
+# Очереди по приоритету: транзакционные уведомления всегда раньше рассылок
+TRANSACTIONAL = 0
+BROADCAST = 1
+
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, не больше capacity"""
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate, capacity, now):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now):
+        """Сколько секунд ждать до следующего токена"""
+        self._refill(now)
+        # Допуск на ошибку округления, иначе ожидание в 1e-17 секунды не сдвигает часы
+        return 0 if self.tokens >= 1 - 1e-9 else (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def is_full(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+class OutboundMessage:
+    __slots__ = ('method', 'chat_id', 'kwargs', 'priority', 'future', 'attempts', 'not_before')
+
+    def __init__(self, method, chat_id, kwargs, priority, future=None):
+        self.method = method
+        self.chat_id = chat_id
+        self.kwargs = kwargs
+        self.priority = priority
+        self.future = future
+        self.attempts = 0
+        self.not_before = 0
+
+class OutboundQueue:
+    """Исходящие сообщения бота в пределах лимитов Telegram.
+
+    Общее ведро ограничивает бота global_rate сообщениями в секунду,
+    ведро на каждый чат - chat_rate (group_rate для групп). Сообщения
+    одного чата уходят по порядку и по одному, чаты внутри приоритета
+    обслуживаются по кругу. На 429 (RetryAfter) отправка приостанавливается
+    на указанное время, сообщение повторяется; сетевые ошибки повторяются
+    с задержкой до retries раз.
+
+    clock и sleep подменяются в outbound_sim.py для прогона в
+    симулированном времени.
+    """
+
+    def __init__(self, bot, global_rate=OUTBOUND_GLOBAL_RATE, chat_rate=OUTBOUND_CHAT_RATE,
+                 group_rate=OUTBOUND_GROUP_RATE, retries=OUTBOUND_RETRIES,
+                 clock=time.monotonic, sleep=asyncio.sleep):
+        self.bot = bot
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.retries = retries
+        self.clock = clock
+        self.sleep = sleep
+
+        self._global = TokenBucket(global_rate, 1, clock())
+        self._buckets = {}  # chat_id -> TokenBucket
+        self._lanes = (OrderedDict(), OrderedDict())  # chat_id -> deque(OutboundMessage)
+        self._inflight = set()  # чаты, сообщение которых сейчас отправляется
+        self._paused_until = 0
+        self._wakeup = None
+        self._task = None
+
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+
+    def enqueue(self, method, chat_id, priority=TRANSACTIONAL, **kwargs):
+        """Постановка вызова bot.<method>(chat_id, **kwargs) в очередь без ожидания"""
+        self._put(OutboundMessage(method, chat_id, kwargs, priority))
+
+    async def send(self, method, chat_id, priority=TRANSACTIONAL, **kwargs):
+        """Отправка через очередь с ожиданием результата (ошибки пробрасываются)"""
+        future = asyncio.get_running_loop().create_future()
+        self._put(OutboundMessage(method, chat_id, kwargs, priority, future))
+        return await future
+
+    def send_message(self, chat_id, text, priority=TRANSACTIONAL, **kwargs):
+        """Текстовое уведомление без ожидания"""
+        self.enqueue('send_message', chat_id, priority, text=text, **kwargs)
+
+    def broadcast(self, chat_ids, text, **kwargs):
+        """Рассылка в фоне с низким приоритетом, возвращает число сообщений"""
+        count = 0
+        for chat_id in chat_ids:
+            self.enqueue('send_message', chat_id, BROADCAST, text=text, **kwargs)
+            count += 1
+        return count
+
+    def pending(self):
+        """Сообщений в очереди"""
+        return sum(len(queue) for lane in self._lanes for queue in lane.values())
+
+    def stats(self):
+        return {
+            'queued': self.pending(),
+            'sent': self.sent,
+            'retried': self.retried,
+            'failed': self.failed
+        }
+
+    def _put(self, message, front=False):
+        self._start()
+        lane = self._lanes[message.priority]
+        queue = lane.get(message.chat_id)
+        if queue is None:
+            queue = lane[message.chat_id] = deque()
+        if front:
+            queue.appendleft(message)
+        else:
+            queue.append(message)
+        self._wakeup.set()
+
+    def _start(self):
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.ensure_future(self._run())
+
+    async def close(self):
+        """Остановка отправки (неотправленные сообщения теряются)"""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            wait = self._dispatch(self.clock())
+            if wait is None:
+                await self._wakeup.wait()
+                continue
+
+            # Спим до появления токена, но просыпаемся раньше на новое сообщение
+            sleeper = asyncio.ensure_future(self.sleep(wait))
+            waker = asyncio.ensure_future(self._wakeup.wait())
+            await asyncio.wait((sleeper, waker), return_when=asyncio.FIRST_COMPLETED)
+            sleeper.cancel()
+            waker.cancel()
+
+    def _dispatch(self, now):
+        """Отправка всех сообщений, на которые есть токены.
+
+        Возвращает, сколько секунд ждать следующей возможности, или None,
+        если ждать нужно нового сообщения или окончания отправки.
+        """
+        if now < self._paused_until:
+            return self._paused_until - now
+
+        while True:
+            global_wait = self._global.wait_time(now)
+            if global_wait > 0:
+                return global_wait if any(self._lanes) else None
+            message, wait = self._next_ready(now)
+            if message is None:
+                return wait
+
+            self._global.take(now)
+            self._chat_bucket(message.chat_id, now).take(now)
+            self._inflight.add(message.chat_id)
+            asyncio.ensure_future(self._deliver(message))
+
+    def _next_ready(self, now):
+        """Первое сообщение, которое можно отправить, и время ожидания иначе"""
+        min_wait = None
+        for lane in self._lanes:
+            for chat_id, queue in lane.items():
+                if chat_id in self._inflight:
+                    continue
+                wait = max(queue[0].not_before - now,
+                           self._chat_bucket(chat_id, now).wait_time(now))
+                if wait <= 0:
+                    message = queue.popleft()
+                    if queue:
+                        lane.move_to_end(chat_id)
+                    else:
+                        del lane[chat_id]
+                    return message, 0
+                if min_wait is None or wait < min_wait:
+                    min_wait = wait
+        return None, min_wait
+
+    def _chat_bucket(self, chat_id, now):
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            if len(self._buckets) >= OUTBOUND_MAX_BUCKETS:
+                self._prune_buckets(now)
+            # Отрицательный chat_id - группа или канал, там лимит ниже
+            rate = self.group_rate if chat_id < 0 else self.chat_rate
+            bucket = self._buckets[chat_id] = TokenBucket(rate, 1, now)
+        return bucket
+
+    def _prune_buckets(self, now):
+        """Удаление полных ведер: для них новое ведро ничем не отличается"""
+        for chat_id in [chat_id for chat_id, bucket in self._buckets.items() if bucket.is_full(now)]:
+            del self._buckets[chat_id]
+
+    async def _deliver(self, message):
+        try:
+            result = await getattr(self.bot, message.method)(message.chat_id, **message.kwargs)
+        except RetryAfter as e:
+            # Флуд-контроль действует на весь бот: ставим на паузу все
+            self.retried += 1
+            self._paused_until = max(self._paused_until, self.clock() + e.timeout)
+            logging.warning(f"Telegram flood control, pausing outbound queue for {e.timeout}s")
+            self._put(message, front=True)
+        except (NetworkError, asyncio.TimeoutError) as e:
+            message.attempts += 1
+            if message.attempts > self.retries:
+                self._fail(message, e)
+            else:
+                self.retried += 1
+                message.not_before = self.clock() + 2 ** message.attempts
+                self._put(message, front=True)
+        except Exception as e:
+            self._fail(message, e)
+        else:
+            self.sent += 1
+            if message.future is not None and not message.future.done():
+                message.future.set_result(result)
+        finally:
+            self._inflight.discard(message.chat_id)
+            self._wakeup.set()
+
+    def _fail(self, message, error):
+        self.failed += 1
+        if message.future is not None:
+            if not message.future.done():
+                message.future.set_exception(error)
+        else:
+            logging.error(f"Error sending {message.method} to {message.chat_id}: {error}")
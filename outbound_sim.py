@@ -0,0 +1,144 @@
+# outbound_sim.py
+"""Прогон OutboundQueue в симулированном времени.
+
+Фейковый бот ведет себя как Telegram: отвечает 429 (RetryAfter), если
+превышен общий лимит или лимит чата. Время не идет по-настоящему, так
+что минуты отправки проверяются за доли секунды:
+
+    python outbound_sim.py
+"""
+import asyncio
+import sys
+
+from aiogram.utils.exceptions import RetryAfter
+
+from config import OUTBOUND_GLOBAL_RATE, OUTBOUND_CHAT_RATE
+from outbound import OutboundQueue, TRANSACTIONAL
+
+EPS = 1e-6
+
+class SimulatedClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    async def sleep(self, seconds):
+        self.now += seconds
+        await asyncio.sleep(0)
+
+class FakeBot:
+    """Бот, который проверяет лимиты и запоминает время каждой отправки"""
+
+    def __init__(self, clock, global_rate=OUTBOUND_GLOBAL_RATE, chat_rate=OUTBOUND_CHAT_RATE,
+                 flood_at=None, flood_timeout=5):
+        self.clock = clock
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.flood_at = flood_at  # номер вызова, на котором искусственно вернуть 429
+        self.flood_timeout = flood_timeout
+        self.calls = 0
+        self.sent = []  # (время, chat_id, text)
+        self.floods = 0
+        self._last_by_chat = {}
+        self._window = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        now = self.clock()
+        self.calls += 1
+        if self.calls == self.flood_at:
+            self.floods += 1
+            raise RetryAfter(self.flood_timeout)
+
+        self._window = [t for t in self._window if t > now - 1 + EPS]
+        last = self._last_by_chat.get(chat_id)
+        if len(self._window) >= self.global_rate or \
+                (last is not None and now - last < 1 / self.chat_rate - EPS):
+            self.floods += 1
+            raise RetryAfter(1)
+
+        self._window.append(now)
+        self._last_by_chat[chat_id] = now
+        self.sent.append((now, chat_id, text))
+        return len(self.sent)
+
+async def run(queue):
+    """Ожидание, пока очередь не опустеет"""
+    while queue.pending() or queue._inflight:
+        await asyncio.sleep(0)
+    await queue.close()
+
+async def scenario_broadcast(messages=900):
+    """Рассылка по разным чатам идет ровно на общем лимите"""
+    clock = SimulatedClock()
+    bot = FakeBot(clock)
+    queue = OutboundQueue(bot, clock=clock, sleep=clock.sleep)
+    queue.broadcast(range(1, messages + 1), 'news')
+    await run(queue)
+
+    duration = bot.sent[-1][0] - bot.sent[0][0]
+    rate = (len(bot.sent) - 1) / duration
+    ok = len(bot.sent) == messages and bot.floods == 0 and rate >= OUTBOUND_GLOBAL_RATE * 0.99
+    return ok, f"{len(bot.sent)} sent in {duration:.2f}s, {rate:.2f} msg/s, {bot.floods} x 429"
+
+async def scenario_single_chat(messages=30):
+    """Сообщения в один чат - не чаще лимита чата и по порядку"""
+    clock = SimulatedClock()
+    bot = FakeBot(clock)
+    queue = OutboundQueue(bot, clock=clock, sleep=clock.sleep)
+    for i in range(messages):
+        queue.send_message(42, str(i))
+    await run(queue)
+
+    duration = bot.sent[-1][0] - bot.sent[0][0]
+    rate = (len(bot.sent) - 1) / duration
+    ordered = [text for _, _, text in bot.sent] == [str(i) for i in range(messages)]
+    ok = ordered and bot.floods == 0 and rate >= OUTBOUND_CHAT_RATE * 0.99
+    return ok, f"{len(bot.sent)} sent in {duration:.2f}s, {rate:.2f} msg/s, ordered={ordered}"
+
+async def scenario_priority(broadcast=600, transactional=60):
+    """Уведомления о сделках обгоняют идущую рассылку"""
+    clock = SimulatedClock()
+    bot = FakeBot(clock)
+    queue = OutboundQueue(bot, clock=clock, sleep=clock.sleep)
+    queue.broadcast(range(1, broadcast + 1), 'news')
+    while len(bot.sent) < 100:
+        await asyncio.sleep(0)
+    started = clock()
+    for chat_id in range(10001, 10001 + transactional):
+        queue.send_message(chat_id, 'sale', TRANSACTIONAL)
+    await run(queue)
+
+    sale_times = [t for t, _, text in bot.sent if text == 'sale']
+    latency = max(sale_times) - started
+    ok = len(sale_times) == transactional and bot.floods == 0 and \
+        latency <= transactional / OUTBOUND_GLOBAL_RATE + 0.1
+    return ok, f"{transactional} transactional delivered within {latency:.2f}s during broadcast"
+
+async def scenario_retry_after(messages=300, flood_timeout=5):
+    """На 429 очередь замолкает на retry_after и ничего не теряет"""
+    clock = SimulatedClock()
+    bot = FakeBot(clock, flood_at=100, flood_timeout=flood_timeout)
+    queue = OutboundQueue(bot, clock=clock, sleep=clock.sleep)
+    queue.broadcast(range(1, messages + 1), 'news')
+    await run(queue)
+
+    times = [t for t, _, _ in bot.sent]
+    gap = max(b - a for a, b in zip(times, times[1:]))
+    delivered = len({chat_id for _, chat_id, _ in bot.sent})
+    ok = delivered == messages and gap >= flood_timeout - EPS and queue.retried == 1
+    return ok, f"{delivered} delivered, pause {gap:.2f}s after 429, {queue.retried} retried"
+
+SCENARIOS = (scenario_broadcast, scenario_single_chat, scenario_priority, scenario_retry_after)
+
+def main():
+    failed = 0
+    for scenario in SCENARIOS:
+        ok, summary = asyncio.run(scenario())
+        failed += not ok
+        print(f"{'✅' if ok else '❌'} {scenario.__name__}: {summary}")
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
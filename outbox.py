@@ -0,0 +1,207 @@
+# outbox.py
+import hashlib
+import hmac
+import json
+import logging
+import sqlite3
+import threading
+import uuid
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from config import (WEBHOOK_URL, OUTBOX_BATCH_SIZE, OUTBOX_INTERVAL, OUTBOX_MAX_ATTEMPTS,
+                    OUTBOX_LEASE, OUTBOX_RETRY_BASE, OUTBOX_RETRY_MAX, OUTBOX_KEEP_SENT,
+                    OUTBOX_SECRET)
+
+# Вставка события в outbox - выполняется в той же транзакции, что и
+# сама продажа/передача, поэтому событие не теряется и не появляется
+# без сделки. Параметры именованные: подходят и для sqlite3, и для
+# db.text() в SQLAlchemy.
+OUTBOX_INSERT = '''
+    INSERT INTO outbox (event_id, topic, payload)
+    VALUES (:event_id, :topic, :payload)
+'''
+
+NOTIFICATIONS_URL = f"{WEBHOOK_URL}/api/notifications"
+SIGNATURE_HEADER = 'X-Outbox-Signature'
+
+def sign(body, secret=OUTBOX_SECRET):
+    """HMAC-SHA256 тела запроса (hex)"""
+    return hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+
+def verify_signature(body, signature, secret=OUTBOX_SECRET):
+    """Подписано ли тело общим секретом (без секрета - никогда)"""
+    if not secret or not signature:
+        return False
+    return hmac.compare_digest(sign(body, secret), signature)
+
+def event_params(topic, payload):
+    """Параметры OUTBOX_INSERT для нового события"""
+    return {
+        'event_id': uuid.uuid4().hex,
+        'topic': topic,
+        'payload': json.dumps(payload)
+    }
+
+class OutboxDispatcher:
+    """Фоновая доставка событий из outbox боту.
+
+    События забираются пачками по batch_size и отправляются одним POST
+    на url через общую keep-alive сессию. event_id каждого события - ключ
+    идемпотентности: при повторной доставке получатель должен его
+    пропустить. Неудачная пачка повторяется с экспоненциальной задержкой,
+    после max_attempts событие помечается как dead. Тело запроса
+    подписывается HMAC с общим секретом (заголовок SIGNATURE_HEADER).
+    """
+
+    def __init__(self, db_path, url=NOTIFICATIONS_URL, batch_size=OUTBOX_BATCH_SIZE,
+                 interval=OUTBOX_INTERVAL, max_attempts=OUTBOX_MAX_ATTEMPTS, timeout=(3.05, 10),
+                 secret=OUTBOX_SECRET):
+        self.db_path = db_path
+        self.url = url
+        self.secret = secret
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_attempts = max_attempts
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        self.session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=4))
+        self.session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=4))
+
+        self._conn = None
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def _connection(self):
+        if self._conn is None:
+            # database импортирует purchase, а тот - этот модуль
+            from database import CONNECTION_PRAGMAS
+            self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            for pragma in CONNECTION_PRAGMAS:
+                self._conn.execute(pragma)
+        return self._conn
+
+    def claim(self):
+        """Забор пачки готовых к отправке событий.
+
+        Забранные события получают аренду (next_attempt_at в будущем),
+        так что после падения процесса они будут отправлены повторно.
+        """
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            rows = conn.execute('''
+                SELECT id, event_id, topic, payload, attempts FROM outbox
+                WHERE status = 'pending' AND next_attempt_at <= datetime('now')
+                ORDER BY next_attempt_at, id
+                LIMIT ?
+            ''', (self.batch_size,)).fetchall()
+            if rows:
+                conn.execute(f'''
+                    UPDATE outbox
+                    SET attempts = attempts + 1, next_attempt_at = datetime('now', '+{OUTBOX_LEASE} seconds')
+                    WHERE id IN ({', '.join('?' * len(rows))})
+                ''', [row[0] for row in rows])
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        return rows
+
+    def dispatch(self):
+        """Отправка одной пачки, возвращает число доставленных событий"""
+        if not self.secret:
+            # Без секрета бот отклонит пачку: события ждут в outbox
+            return 0
+        rows = self.claim()
+        if not rows:
+            return 0
+
+        events = [
+            {'id': event_id, 'topic': topic, 'payload': json.loads(payload)}
+            for _, event_id, topic, payload, _ in rows
+        ]
+        try:
+            body = json.dumps({'events': events}).encode()
+            headers = {'Content-Type': 'application/json', SIGNATURE_HEADER: sign(body, self.secret)}
+            response = self.session.post(self.url, data=body, headers=headers, timeout=self.timeout)
+            response.raise_for_status()
+        except requests.RequestException as e:
+            self._retry(rows, str(e))
+            return 0
+
+        conn = self._connection()
+        conn.execute(f'''
+            UPDATE outbox SET status = 'sent', sent_at = CURRENT_TIMESTAMP, last_error = NULL
+            WHERE id IN ({', '.join('?' * len(rows))})
+        ''', [row[0] for row in rows])
+        conn.commit()
+        return len(rows)
+
+    def _retry(self, rows, error):
+        logging.warning(f"Outbox delivery of {len(rows)} events failed: {error}")
+        conn = self._connection()
+        params = []
+        for row_id, _, _, _, attempts in rows:
+            attempts += 1
+            status = 'dead' if attempts >= self.max_attempts else 'pending'
+            delay = min(OUTBOX_RETRY_BASE * 2 ** (attempts - 1), OUTBOX_RETRY_MAX)
+            params.append((status, f'+{delay} seconds', error, row_id))
+        conn.executemany('''
+            UPDATE outbox SET status = ?, next_attempt_at = datetime('now', ?), last_error = ?
+            WHERE id = ?
+        ''', params)
+        conn.commit()
+
+    def purge(self, limit=1000):
+        """Удаление доставленных событий старше OUTBOX_KEEP_SENT секунд"""
+        conn = self._connection()
+        cursor = conn.execute('''
+            DELETE FROM outbox WHERE id IN (
+                SELECT id FROM outbox
+                WHERE status = 'sent' AND sent_at < datetime('now', ?)
+                LIMIT ?
+            )
+        ''', (f'-{OUTBOX_KEEP_SENT} seconds', limit))
+        conn.commit()
+        return cursor.rowcount
+
+    def drain(self):
+        """Отправка всех готовых пачек подряд"""
+        total = 0
+        while not self._stop_event.is_set():
+            sent = self.dispatch()
+            total += sent
+            if sent < self.batch_size:
+                break
+        return total
+
+    def start(self):
+        """Запуск фоновой доставки"""
+        if self._thread is None:
+            if not self.secret:
+                logging.warning("OUTBOX_SECRET is not set, events stay in outbox until it is")
+            self._stop_event.clear()
+            self._thread = threading.Thread(target=self._run, name='outbox-dispatcher', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Остановка фоновой доставки"""
+        if self._thread is not None:
+            self._stop_event.set()
+            self._thread.join()
+            self._thread = None
+        self.session.close()
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                self.drain()
+                self.purge()
+            except Exception as e:
+                logging.error(f"Error dispatching outbox: {e}")
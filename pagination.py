@@ -0,0 +1,50 @@
+# pagination.py
+import base64
+
+# Курсорная (keyset) пагинация по ключу (created_at, id).
+# Курсор - непрозрачная строка: направление + ключ граничной записи.
+# Достаточно короткий, чтобы поместиться в callback_data (64 байта).
+
+def encode_cursor(direction, created_at, item_id):
+    """Кодирование курсора"""
+    raw = f"{direction}|{created_at}|{item_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    """Декодирование курсора: (direction, created_at, id) или None"""
+    if not cursor:
+        return None
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        direction, created_at, item_id = base64.urlsafe_b64decode(padded).decode().split('|')
+        if direction not in ('next', 'prev'):
+            return None
+        return direction, created_at, int(item_id)
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+def build_page(rows, per_page, direction, has_cursor, key):
+    """Формирование страницы из per_page + 1 выбранных строк.
+
+    key(row) возвращает (created_at, id) строки.
+    """
+    has_more = len(rows) > per_page
+    rows = list(rows[:per_page])
+    if direction == 'prev':
+        # Предыдущая страница выбиралась в обратном порядке
+        rows.reverse()
+        has_prev, has_next = has_more, True
+    else:
+        has_prev, has_next = has_cursor, has_more
+
+    next_cursor = prev_cursor = None
+    if rows and has_next:
+        next_cursor = encode_cursor('next', *key(rows[-1]))
+    if rows and has_prev:
+        prev_cursor = encode_cursor('prev', *key(rows[0]))
+
+    return {
+        'items': rows,
+        'next_cursor': next_cursor,
+        'prev_cursor': prev_cursor
+    }
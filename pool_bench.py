@@ -0,0 +1,87 @@
+# pool_bench.py
+"""Микробенчмарк пула соединений Database: вызовов в секунду.
+
+"До" - новое соединение sqlite3 на каждый вызов, как было до пула;
+"после" - долгоживущее соединение потока с PRAGMA из CONNECTION_PRAGMAS.
+Страница маркета читается мимо кэша листингов, чтобы мерить именно
+работу с базой:
+
+    python pool_bench.py
+    python pool_bench.py --calls 20000
+"""
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+from database import Database
+from pagination import encode_cursor
+
+class PerCallDatabase(Database):
+    """Database без пула: соединение открывается на каждый вызов"""
+
+    def get_connection(self):
+        return sqlite3.connect(self.db_path)
+
+def _fill(path, users, listings, seed=1):
+    rng = random.Random(seed)
+    conn = sqlite3.connect(path)
+    conn.executemany('INSERT INTO users (telegram_id, username) VALUES (?, ?)',
+                     [(1000 + i, f'user{i}') for i in range(users)])
+    conn.executemany(
+        "INSERT INTO nfts (user_id, file_id, file_name, title, price, status, created_at) "
+        "VALUES (?, ?, 'file.png', ?, ?, 'for_sale', datetime('2024-01-01', ? || ' seconds'))",
+        [(rng.randint(1, users), f'f{i}', f'NFT {i}', rng.randint(1, 100), str(i)) for i in range(listings)]
+    )
+    conn.commit()
+    conn.close()
+
+def _rate(call, calls):
+    started = time.perf_counter()
+    for i in range(calls):
+        call(i)
+    return calls / (time.perf_counter() - started)
+
+def measure(db, calls, users):
+    """Вызовов в секунду для обоих методов"""
+    first_page = db._load_active_sales(12, None)
+    cursor = first_page['next_cursor'] or encode_cursor('next', '9999', 0)
+    return {
+        'get_user_by_telegram_id': _rate(lambda i: db.get_user_by_telegram_id(1000 + i % users), calls),
+        'get_active_sales (page 2)': _rate(lambda i: db._load_active_sales(12, cursor), calls),
+    }
+
+def bench(calls, users=200, listings=200):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'pool.db')
+        Database(path).close()
+        _fill(path, users, listings)
+
+        results = {}
+        for name, cls in (('before', PerCallDatabase), ('after', Database)):
+            db = cls(path)
+            try:
+                results[name] = measure(db, calls, users)
+            finally:
+                db.close()
+
+    ok = True
+    print(f"{users} users, {listings} listings, {calls} calls each")
+    for method in results['after']:
+        before, after = results['before'][method], results['after'][method]
+        ok = ok and after > before
+        print(f"{method:27} {before / 1000:6.1f}k -> {after / 1000:6.1f}k calls/s ({after / before:.1f}x)")
+    print(f"{'✅' if ok else '❌'} pooled connections are faster for every method")
+    return ok
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Микробенчмарк пула соединений')
+    parser.add_argument('--calls', type=int, default=5000, help='Вызовов каждого метода')
+    args = parser.parse_args(argv)
+    return 0 if bench(args.calls) else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,96 @@
+# preview_bench.py
+"""Сетка маркета до и после миниатюр: байты и задержка на страницу.
+
+"До" - карточки грузят оригиналы файлов из хранилища; "после" -
+миниатюры PreviewCache: холодная генерация в пуле процессов и теплое
+чтение с диска. К задержке добавляется передача страницы по каналу
+--mbps. Файлы - JPEG с шумом (плохо сжимаются, как фото), хранилище и
+кэш превью - во временной папке:
+
+    python preview_bench.py
+    python preview_bench.py --cards 12 --width 3000 --height 2000
+"""
+import argparse
+import hashlib
+import io
+import os
+import random
+import sys
+import tempfile
+import time
+
+from PIL import Image
+
+from blob_store import BlobStore
+from previews import PreviewCache
+
+def _fill(store, cards, width, height, seed=1):
+    """cards файлов в хранилище, возвращает их хэши"""
+    rng = random.Random(seed)
+    hashes = []
+    for _ in range(cards):
+        image = Image.frombytes('RGB', (width, height), rng.randbytes(width * height * 3))
+        buffer = io.BytesIO()
+        image.save(buffer, 'JPEG', quality=90)
+        content = buffer.getvalue()
+        content_hash = hashlib.sha256(content).hexdigest()
+        path = store.temp_path()
+        with open(path, 'wb') as f:
+            f.write(content)
+        store.commit(path, content_hash)
+        hashes.append(content_hash)
+    return hashes
+
+def _read_all(paths):
+    """Байт и секунд на чтение файлов страницы"""
+    started = time.perf_counter()
+    size = 0
+    for path in paths:
+        with open(path, 'rb') as f:
+            size += len(f.read())
+    return size, time.perf_counter() - started
+
+def bench(cards, width, height, mbps, fmt='webp'):
+    with tempfile.TemporaryDirectory() as tmp:
+        store = BlobStore(os.path.join(tmp, 'blobs'))
+        previews = PreviewCache(os.path.join(tmp, 'previews'), store)
+        try:
+            hashes = _fill(store, cards, width, height)
+            before = _read_all([store.path_for(content_hash) for content_hash in hashes])
+
+            # Холодная страница: все миниатюры считаются параллельно, как
+            # при одновременных запросах карточек браузером
+            started = time.perf_counter()
+            futures = [previews.submit(content_hash, 'thumb', fmt) for content_hash in hashes]
+            rendered = all(future.result() for future in futures)
+            paths = [previews.get(content_hash, 'thumb', fmt) for content_hash in hashes]
+            cold = time.perf_counter() - started
+
+            warm = _read_all([previews.get(content_hash, 'thumb', fmt) for content_hash in hashes])
+        finally:
+            previews.close()
+
+    def transfer(size):
+        return size * 8 / (mbps * 1e6)
+
+    print(f"grid of {cards} cards, {width}x{height} JPEG uploads, {fmt} thumbnails, {mbps} Mbit/s link")
+    print(f"before: originals {before[0] / 1e6:.1f} MB, "
+          f"page {(before[1] + transfer(before[0])) * 1e3:.0f} ms (read {before[1] * 1e3:.1f} ms)")
+    print(f"after:  thumbnails {warm[0] / 1e3:.0f} KB, page cold {(cold + transfer(warm[0])) * 1e3:.0f} ms "
+          f"(generation {cold * 1e3:.0f} ms), warm {(warm[1] + transfer(warm[0])) * 1e3:.0f} ms")
+    ok = rendered and all(paths) and warm[0] < before[0] / 10
+    print(f"{'✅' if ok else '❌'} every thumbnail rendered, grid {before[0] / warm[0]:.0f}x smaller")
+    return ok
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Сетка маркета до и после миниатюр')
+    parser.add_argument('--cards', type=int, default=12)
+    parser.add_argument('--width', type=int, default=3000)
+    parser.add_argument('--height', type=int, default=2000)
+    parser.add_argument('--format', choices=['webp', 'jpeg'], default='webp')
+    parser.add_argument('--mbps', type=float, default=50, help='Скорость канала клиента, Мбит/с')
+    args = parser.parse_args(argv)
+    return 0 if bench(args.cards, args.width, args.height, args.mbps, args.format) else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
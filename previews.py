@@ -0,0 +1,168 @@
+# previews.py
+"""Превью и миниатюры файлов NFT.
+
+Оригиналы бывают до 50 МБ, поэтому в сетке маркета и инвентаря
+показываются только уменьшенные копии. Они считаются в пуле процессов
+(Pillow держит GIL на декодировании), кладутся на диск рядом с
+хранилищем по ключу (хэш содержимого, размер, формат) и больше не
+пересчитываются: файл по хэшу не меняется. Для видео берется кадр
+через ffmpeg, если он установлен.
+"""
+import io
+import logging
+import os
+import shutil
+import subprocess
+import threading
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+from blob_store import BlobStore
+from config import PREVIEW_FOLDER, PREVIEW_SIZES, PREVIEW_WORKERS, PREVIEW_QUALITY
+
+FORMATS = {'webp': 'WEBP', 'jpeg': 'JPEG'}
+MIMETYPES = {'webp': 'image/webp', 'jpeg': 'image/jpeg'}
+SAVE_OPTIONS = {'webp': {'method': 4}, 'jpeg': {'optimize': True, 'progressive': True}}
+
+def render_preview(source_path, dest_path, size, fmt):
+    """Миниатюра файла не больше size x size, возвращает True при успехе.
+
+    Выполняется в отдельном процессе, поэтому функция модульная и
+    принимает только пути.
+    """
+    try:
+        image = Image.open(source_path)
+    except UnidentifiedImageError:
+        image = _video_frame(source_path)
+    except OSError:
+        return False
+    if image is None:
+        return False
+
+    temp_path = f"{dest_path}.{uuid.uuid4().hex[:8]}.part"
+    try:
+        with image:
+            # JPEG сразу декодируется в уменьшенном масштабе
+            image.draft('RGB', (size, size))
+            # Для анимаций - первый кадр
+            image.seek(0)
+            frame = ImageOps.exif_transpose(image)
+            frame.thumbnail((size, size), Image.LANCZOS)
+
+            if fmt == 'jpeg':
+                frame = _flatten(frame)
+            elif frame.mode not in ('RGB', 'RGBA'):
+                frame = frame.convert('RGBA')
+
+            os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+            frame.save(temp_path, FORMATS[fmt], quality=PREVIEW_QUALITY, **SAVE_OPTIONS[fmt])
+            os.replace(temp_path, dest_path)
+    except Exception as e:
+        # Open читает только заголовок: обрезанный или битый файл падает
+        # здесь, на декодировании
+        logging.warning(f"Cannot render preview of {source_path}: {e}")
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        return False
+    return True
+
+def _flatten(image):
+    """RGB на белом фоне (в JPEG нет прозрачности)"""
+    image = image.convert('RGBA')
+    background = Image.new('RGB', image.size, (255, 255, 255))
+    background.paste(image, mask=image.getchannel('A'))
+    return background
+
+def _video_frame(source_path):
+    """Кадр-постер видео через ffmpeg или None"""
+    ffmpeg = shutil.which('ffmpeg')
+    if not ffmpeg:
+        return None
+    # Первая секунда обычно информативнее черного нулевого кадра
+    for offset in ('1', '0'):
+        result = subprocess.run(
+            [ffmpeg, '-v', 'error', '-ss', offset, '-i', source_path,
+             '-frames:v', '1', '-f', 'image2pipe', '-vcodec', 'png', '-'],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, timeout=30
+        )
+        if result.returncode == 0 and result.stdout:
+            return Image.open(io.BytesIO(result.stdout))
+    return None
+
+class PreviewCache:
+    """Дисковый кэш превью с фоновой генерацией.
+
+    get() только проверяет диск, submit() ставит генерацию в пул
+    процессов (одновременные запросы одного превью объединяются).
+    """
+
+    def __init__(self, folder=PREVIEW_FOLDER, store=None, workers=PREVIEW_WORKERS):
+        self.folder = folder
+        self.store = store or BlobStore()
+        self.workers = workers
+        self._executor = None
+        self._pending = {}  # (hash, size, fmt) -> Future
+        self._failed = set()  # файлы, из которых превью не получить
+        self._lock = threading.Lock()
+
+    def path_for(self, content_hash, size, fmt):
+        return os.path.join(self.folder, content_hash[:2], f"{content_hash}_{size}.{fmt}")
+
+    def get(self, content_hash, size, fmt):
+        """Путь к готовому превью или None"""
+        path = self.path_for(content_hash, size, fmt)
+        return path if os.path.exists(path) else None
+
+    def failed(self, content_hash, size, fmt):
+        return (content_hash, size, fmt) in self._failed
+
+    def submit(self, content_hash, size, fmt):
+        """Фоновая генерация превью, возвращает Future (результат - удалось ли)"""
+        key = (content_hash, size, fmt)
+        with self._lock:
+            future = self._pending.get(key)
+            if future is not None:
+                return future
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(self.workers)
+            future = self._executor.submit(
+                render_preview, self.store.path_for(content_hash),
+                self.path_for(content_hash, size, fmt), PREVIEW_SIZES[size], fmt
+            )
+            self._pending[key] = future
+        future.add_done_callback(lambda f: self._done(key, f))
+        return future
+
+    def warm(self, content_hash, fmt='webp'):
+        """Генерация всех размеров для нового файла"""
+        for size in PREVIEW_SIZES:
+            if not self.get(content_hash, size, fmt):
+                self.submit(content_hash, size, fmt)
+
+    def _done(self, key, future):
+        with self._lock:
+            self._pending.pop(key, None)
+            try:
+                ok = future.result()
+            except Exception as e:
+                logging.error(f"Error rendering preview {key}: {e}")
+                ok = False
+            if not ok:
+                self._failed.add(key)
+
+    def delete(self, content_hash):
+        """Удаление всех миниатюр файла (сборка мусора хранилища)"""
+        for size in PREVIEW_SIZES:
+            for fmt in FORMATS:
+                try:
+                    os.remove(self.path_for(content_hash, size, fmt))
+                except FileNotFoundError:
+                    pass
+                self._failed.discard((content_hash, size, fmt))
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
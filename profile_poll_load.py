@@ -0,0 +1,168 @@
+# profile_poll_load.py
+"""Нагрузочный прогон опроса статистики профиля.
+
+Моделирует N открытых вкладок профиля: каждая раз в раунд запрашивает
+/api/profile/stats с If-None-Match, как это делает браузер для
+refreshStats(). Между раундами часть пользователей покупает NFT - через
+/api/buy и, как бот в другом процессе, через Database.buy_nft: следующий
+опрос покупателя и продавца должен получить 200 с новыми цифрами, а
+остальные - 304 (два запроса по ключу: пользователь и версия статистики).
+
+Прогон идет через тестовый клиент приложения на временной базе:
+config.DATABASE_URL подменяется до импорта app, так что ни рабочая база,
+ни ее outbox не затрагиваются.
+
+    python profile_poll_load.py
+    python profile_poll_load.py --profiles 10000 --rounds 3 --purchases 50
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import Counter as Tally
+
+from sqlalchemy import event
+
+import config
+from aggregates import check_user_stats
+from database import Database
+
+URL = '/api/profile/stats'
+
+def session_cookie(app, user_id):
+    """Подписанная сессия Flask-Login для пользователя"""
+    serializer = app.session_interface.get_signing_serializer(app)
+    return f"{app.config['SESSION_COOKIE_NAME']}={serializer.dumps({'_user_id': str(user_id), '_fresh': True})}"
+
+def create_profiles(db, count, sellers, seed=1):
+    """Пользователи прогона; у sellers из них по NFT на продаже"""
+    rng = random.Random(seed)
+    conn = db.engine.raw_connection()
+    try:
+        raw = conn.dbapi_connection
+        raw.executemany(
+            'INSERT INTO users (telegram_id, username, balance_stars) VALUES (?, ?, ?)',
+            [(i, f'load_{i}', 1000) for i in range(1, count + 1)]
+        )
+        user_ids = [row[0] for row in raw.execute('SELECT id FROM users ORDER BY id')]
+        raw.executemany('''
+            INSERT INTO nfts (user_id, file_id, file_name, price, status, views)
+            VALUES (?, ?, 'load.jpg', ?, 'for_sale', 0)
+        ''', [(user_id, f'load_{user_id}', rng.randint(1, 100)) for user_id in user_ids[:sellers]])
+        raw.commit()
+    finally:
+        conn.close()
+    return user_ids
+
+def run(app, db, bot_db, profiles, rounds, purchases, seed=1):
+    from models import init_schema
+
+    rng = random.Random(seed)
+    with app.app_context():
+        init_schema()
+        sellers = purchases * rounds
+        user_ids = create_profiles(db, profiles, sellers, seed)
+
+    queries = [0]
+
+    def count_query(*args):
+        queries[0] += 1
+
+    client = app.test_client(use_cookies=False)
+    cookies = {user_id: session_cookie(app, user_id) for user_id in user_ids}
+    etags = {}
+    statuses = Tally()
+    wrong = 0
+    try:
+        with app.app_context():
+            event.listen(db.engine, 'before_cursor_execute', count_query)
+        listed = list(user_ids[:sellers])
+        total_time = 0.0
+        total_polls = 0
+        for round_no in range(rounds):
+            # Покупки между опросами: у покупателя и продавца статистика
+            # меняется; каждая вторая - из "бота", мимо процесса сайта
+            changed = set()
+            if round_no:
+                for i in range(purchases):
+                    seller = listed.pop()
+                    buyer = rng.choice(user_ids[sellers:])
+                    with app.app_context():
+                        nft_id = db.session.execute(
+                            db.text('SELECT id FROM nfts WHERE user_id = :u'), {'u': seller}
+                        ).scalar()
+                    if i % 2:
+                        bought = bot_db.buy_nft(nft_id, buyer)['success']
+                    else:
+                        response = client.post(f'/api/buy/{nft_id}', headers={'Cookie': cookies[buyer]})
+                        bought = response.status_code == 200
+                    if bought:
+                        changed.update((buyer, seller))
+
+            queries[0] = 0
+            round_statuses = Tally()
+            started = time.perf_counter()
+            for user_id in user_ids:
+                headers = {'Cookie': cookies[user_id]}
+                if user_id in etags:
+                    headers['If-None-Match'] = etags[user_id]
+                response = client.get(URL, headers=headers)
+                round_statuses[response.status_code] += 1
+                if response.status_code == 200:
+                    etags[user_id] = response.headers['ETag']
+                # Изменившийся профиль обязан получить новые данные, остальные - 304
+                expected = 200 if round_no == 0 or user_id in changed else 304
+                wrong += response.status_code != expected
+            elapsed = time.perf_counter() - started
+            total_time += elapsed
+            total_polls += len(user_ids)
+            statuses.update(round_statuses)
+            print(f"round {round_no + 1}: {dict(round_statuses)}, {queries[0]} DB queries "
+                  f"({queries[0] / len(user_ids):.3f}/poll), {len(user_ids) / elapsed:.0f} polls/s")
+
+        with app.app_context():
+            raw = db.engine.raw_connection()
+            try:
+                mismatched = check_user_stats(raw.dbapi_connection)
+            finally:
+                raw.close()
+    finally:
+        with app.app_context():
+            event.remove(db.engine, 'before_cursor_execute', count_query)
+
+    ok = wrong == 0 and not mismatched
+    print(f"{total_polls} polls in {total_time:.2f}s, {dict(statuses)}; the old endpoint ran "
+          f"5 queries per poll ({total_polls * 5} in total) and sent the body every time")
+    print(f"{'✅' if ok else '❌'} unexpected statuses: {wrong}, user_stats mismatches: {len(mismatched)}")
+    return ok
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Нагрузочный прогон опроса статистики профиля')
+    parser.add_argument('--profiles', type=int, default=10000, help='Открытых профилей')
+    parser.add_argument('--rounds', type=int, default=3, help='Раундов опроса (по 30 с в браузере)')
+    parser.add_argument('--purchases', type=int, default=50, help='Покупок между раундами')
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'profile_poll.db')
+        bot_db = Database(path)
+        # app берет базу из config при импорте
+        config.DATABASE_URL = f'sqlite:///{path}'
+        import app as web
+
+        # Уведомления о тестовых покупках боту не отправляются
+        web.outbox_dispatcher.stop()
+        try:
+            ok = run(web.app, web.db, bot_db, args.profiles, args.rounds, args.purchases)
+        finally:
+            bot_db.close()
+            web.view_counter.stop()
+            web.preview_cache.close()
+            with web.app.app_context():
+                web.db.engine.dispose()
+    return 0 if ok else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
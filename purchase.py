@@ -0,0 +1,117 @@
+# purchase.py
+import logging
+import random
+import sqlite3
+import time
+from datetime import datetime
+
+from config import STARS_TO_RUB
+from outbox import OUTBOX_INSERT, event_params
+
+# Сколько раз повторять покупку, если база занята другим писателем
+PURCHASE_RETRIES = 5
+RETRY_BASE_DELAY = 0.02  # секунды, удваивается с каждой попыткой
+
+def is_busy_error(error):
+    """База заблокирована другим писателем (SQLITE_BUSY / SQLITE_LOCKED)"""
+    message = str(error).lower()
+    return 'locked' in message or 'busy' in message
+
+def purchase_nft(conn, nft_id, buyer_id, retries=PURCHASE_RETRIES):
+    """Атомарная покупка NFT на sqlite3-соединении.
+
+    Все проверки и изменения выполняются одной транзакцией BEGIN IMMEDIATE:
+    списание только при достаточном балансе, смена владельца только если
+    NFT все еще продается, зачисление продавцу и запись транзакции.
+    При SQLITE_BUSY транзакция повторяется с экспоненциальной задержкой.
+    """
+    for attempt in range(retries + 1):
+        try:
+            return _purchase_once(conn, nft_id, buyer_id)
+        except sqlite3.OperationalError as e:
+            if conn.in_transaction:
+                conn.rollback()
+            if not is_busy_error(e) or attempt == retries:
+                raise
+            delay = RETRY_BASE_DELAY * (2 ** attempt)
+            logging.warning(f"Purchase of NFT {nft_id} busy, retry in {delay:.2f}s")
+            time.sleep(delay * (1 + random.random()))
+
+def _purchase_once(conn, nft_id, buyer_id):
+    if conn.in_transaction:
+        conn.commit()
+
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        row = conn.execute(
+            'SELECT user_id, price, status FROM nfts WHERE id = ?', (nft_id,)
+        ).fetchone()
+        if not row:
+            conn.rollback()
+            return {'success': False, 'error': 'NFT not found'}
+
+        seller_id, price, status = row
+        if status != 'for_sale':
+            conn.rollback()
+            return {'success': False, 'error': 'NFT not for sale'}
+        if seller_id == buyer_id:
+            conn.rollback()
+            return {'success': False, 'error': 'Cannot buy your own NFT'}
+
+        # Списываем только при достаточном балансе
+        cursor = conn.execute('''
+            UPDATE users
+            SET balance_stars = balance_stars - ?
+            WHERE id = ? AND balance_stars >= ?
+        ''', (price, buyer_id, price))
+        if cursor.rowcount != 1:
+            conn.rollback()
+            return {'success': False, 'error': 'Insufficient balance'}
+
+        now = datetime.utcnow().isoformat(' ')
+
+        # Меняем владельца, только если NFT все еще продается
+        cursor = conn.execute('''
+            UPDATE nfts
+            SET status = 'sold', user_id = ?, sold_at = ?
+            WHERE id = ? AND status = 'for_sale' AND user_id = ?
+        ''', (buyer_id, now, nft_id, seller_id))
+        if cursor.rowcount != 1:
+            conn.rollback()
+            return {'success': False, 'error': 'NFT not for sale'}
+
+        conn.execute('''
+            UPDATE users
+            SET balance_stars = balance_stars + ?
+            WHERE id = ?
+        ''', (price, seller_id))
+
+        cursor = conn.execute('''
+            INSERT INTO transactions
+            (nft_id, buyer_id, seller_id, amount_stars, amount_rub, status, created_at)
+            VALUES (?, ?, ?, ?, ?, 'completed', ?)
+        ''', (nft_id, buyer_id, seller_id, price, price * STARS_TO_RUB, now))
+        transaction_id = cursor.lastrowid
+
+        # Уведомление о продаже - в той же транзакции
+        conn.execute(OUTBOX_INSERT, event_params('sale', {
+            'transaction_id': transaction_id,
+            'nft_id': nft_id,
+            'buyer_id': buyer_id,
+            'seller_id': seller_id,
+            'amount': price
+        }))
+
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+    return {
+        'success': True,
+        'transaction_id': transaction_id,
+        'nft_id': nft_id,
+        'buyer_id': buyer_id,
+        'seller_id': seller_id,
+        'amount': price
+    }
@@ -0,0 +1,128 @@
+# purchase_stress.py
+"""Стресс-прогон покупок: потоки наперегонки покупают один NFT.
+
+Каждый раунд - новый лот и N покупателей с достаточным балансом, которые
+стартуют одновременно (threading.Barrier) и вызывают Database.buy_nft,
+каждый на своем соединении из пула. Проверяется, что победитель ровно
+один, сумма балансов не изменилась, записана одна транзакция и NFT
+принадлежит победителю. Затем потоки покупают разные лоты - замеряется
+число покупок в секунду:
+
+    python purchase_stress.py
+    python purchase_stress.py --threads 32 --rounds 50 --listings 4000
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+from database import Database
+
+PRICE = 10
+
+def _race(db, path, seller_id, buyers):
+    """Один раунд: все покупатели одновременно покупают один новый лот"""
+    nft_id = db.add_nft({'user_id': seller_id, 'file_id': 'race', 'file_name': 'race.png',
+                         'price': PRICE, 'status': 'for_sale'})
+    conn = sqlite3.connect(path)
+    balance_before = conn.execute('SELECT SUM(balance_stars) FROM users').fetchone()[0]
+
+    barrier = threading.Barrier(len(buyers))
+    results = {}
+
+    def buy(buyer_id):
+        barrier.wait()
+        results[buyer_id] = db.buy_nft(nft_id, buyer_id)
+
+    threads = [threading.Thread(target=buy, args=(buyer_id,)) for buyer_id in buyers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    winners = [buyer_id for buyer_id, result in results.items() if result['success']]
+    balance_after = conn.execute('SELECT SUM(balance_stars) FROM users').fetchone()[0]
+    sales = conn.execute('SELECT buyer_id FROM transactions WHERE nft_id = ?', (nft_id,)).fetchall()
+    owner, status = conn.execute('SELECT user_id, status FROM nfts WHERE id = ?', (nft_id,)).fetchone()
+    conn.close()
+
+    problems = []
+    if len(winners) != 1:
+        problems.append(f"{len(winners)} winners")
+    if balance_after != balance_before:
+        problems.append(f"balances {balance_before} -> {balance_after}")
+    if [row[0] for row in sales] != winners:
+        problems.append(f"transactions {sales}")
+    if winners and (owner, status) != (winners[0], 'sold'):
+        problems.append(f"owner {owner} ({status})")
+    return problems
+
+def _throughput(db, path, seller_id, buyers, listings):
+    """Покупки разных лотов в len(buyers) потоков: (успешных, секунд)"""
+    ids = db.add_nfts([
+        {'user_id': seller_id, 'file_id': f'l{i}', 'file_name': f'{i}.png', 'price': PRICE, 'status': 'for_sale'}
+        for i in range(listings)
+    ])
+    chunks = [ids[i::len(buyers)] for i in range(len(buyers))]
+    barrier = threading.Barrier(len(buyers) + 1)
+    succeeded = []
+
+    def buy_all(buyer_id, nft_ids):
+        barrier.wait()
+        succeeded.append(sum(db.buy_nft(nft_id, buyer_id)['success'] for nft_id in nft_ids))
+
+    threads = [threading.Thread(target=buy_all, args=args) for args in zip(buyers, chunks)]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    started = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    return sum(succeeded), time.perf_counter() - started
+
+def stress(threads, rounds, listings):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'purchase.db')
+        db = Database(path)
+        try:
+            ids = db.add_users([{'telegram_id': i, 'username': f'user{i}'} for i in range(threads + 1)])
+            seller_id, buyers = ids[0], ids[1:]
+            with db.get_connection() as conn:
+                conn.execute('UPDATE users SET balance_stars = ? WHERE id != ?',
+                             (PRICE * (rounds + listings), seller_id))
+
+            failed = {}
+            for i in range(rounds):
+                problems = _race(db, path, seller_id, buyers)
+                if problems:
+                    failed[i] = problems
+            total_before = sum(db.get_user_balance(user_id) for user_id in ids)
+            bought, elapsed = _throughput(db, path, seller_id, buyers, listings)
+            total_after = sum(db.get_user_balance(user_id) for user_id in ids)
+        finally:
+            db.close()
+
+    for i, problems in failed.items():
+        print(f"❌ round {i}: {', '.join(problems)}")
+    print(f"race: {rounds} rounds x {threads} threads on one NFT, "
+          f"{rounds - len(failed)} with exactly one winner and conserved balances")
+    print(f"throughput: {bought}/{listings} distinct listings in {elapsed:.2f}s "
+          f"with {threads} threads = {bought / elapsed:.0f} purchases/s")
+    ok = not failed and bought == listings and total_before == total_after
+    print(f"{'✅' if ok else '❌'} one winner per race, every distinct purchase succeeded, "
+          f"balances conserved: {total_before == total_after}")
+    return ok
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Стресс-прогон покупок')
+    parser.add_argument('--threads', type=int, default=32)
+    parser.add_argument('--rounds', type=int, default=20, help='Раундов гонки за один NFT')
+    parser.add_argument('--listings', type=int, default=4000, help='Лотов для замера покупок в секунду')
+    args = parser.parse_args(argv)
+    return 0 if stress(args.threads, args.rounds, args.listings) else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
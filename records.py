@@ -0,0 +1,95 @@
+# records.py
+
+# Компактные записи для строк из database.Database.
+# Вместо dict на каждую строку - объект со __slots__, который создается
+# прямо в row_factory курсора. Доступ и по атрибуту (nft.title), и по
+# ключу (nft['title']), как раньше со словарями. В dict строка
+# превращается только там, где нужен JSON (to_dict).
+
+USER_COLUMNS = (
+    'id', 'telegram_id', 'username', 'balance_stars', 'balance_rub', 'is_admin', 'created_at'
+)
+
+NFT_COLUMNS = (
+    'id', 'user_id', 'file_id', 'file_name', 'file_path', 'file_size', 'file_type',
+    'title', 'description', 'price', 'status', 'views', 'created_at', 'sold_at',
+    'content_hash'
+)
+
+TRANSFER_COLUMNS = (
+    'id', 'nft_id', 'from_user_id', 'to_user_id', 'transfer_code', 'status', 'created_at', 'expires_at'
+)
+
+TRANSACTION_COLUMNS = (
+    'id', 'nft_id', 'buyer_id', 'seller_id', 'amount_stars', 'amount_rub', 'status', 'created_at'
+)
+
+def select_list(columns, alias=None):
+    """Явный список колонок для SELECT вместо *"""
+    if alias:
+        return ', '.join(f'{alias}.{column}' for column in columns)
+    return ', '.join(columns)
+
+class Record:
+    __slots__ = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # Генерируем __init__ с присваиванием каждого слота напрямую
+        # (как dataclasses): заметно быстрее цикла с setattr на каждую строку
+        params = ', '.join(f'{name}=None' for name in cls.__slots__)
+        body = '\n'.join(f'    self.{name} = {name}' for name in cls.__slots__) or '    pass'
+        namespace = {}
+        exec(f'def __init__(self, {params}):\n{body}', namespace)
+        cls.__init__ = namespace['__init__']
+
+    @classmethod
+    def from_row(cls, cursor, row):
+        """row_factory для sqlite3"""
+        return cls(*row)
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def __setitem__(self, key, value):
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in self.__slots__
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def keys(self):
+        return self.__slots__
+
+    def copy(self):
+        """Поверхностная копия (например, для объектов из кэша)"""
+        return type(self)(*[getattr(self, name) for name in self.__slots__])
+
+    def to_dict(self):
+        """Преобразование в dict (для JSON)"""
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __eq__(self, other):
+        if type(other) is not type(self):
+            return NotImplemented
+        return all(getattr(self, name) == getattr(other, name) for name in self.__slots__)
+
+    def __repr__(self):
+        return f"{type(self).__name__}(id={getattr(self, 'id', None)!r})"
+
+class User(Record):
+    __slots__ = USER_COLUMNS
+
+class NFT(Record):
+    __slots__ = NFT_COLUMNS + ('seller_username',)
+
+class Transfer(Record):
+    __slots__ = TRANSFER_COLUMNS
+
+class Transaction(Record):
+    __slots__ = TRANSACTION_COLUMNS
@@ -0,0 +1,394 @@
+# search.py
+"""Полнотекстовый поиск лотов по названию, описанию и имени файла.
+
+Индекс - FTS5-таблица nfts_fts (см. миграцию 10), в ней только лоты на
+продаже; триггеры держат ее в соответствии с nfts.
+
+Результаты упорядочены по новизне, а не по релевантности: совпадения
+идут окнами по SEARCH_CANDIDATES, от новых к старым, и переставляются
+только внутри своего окна - выше те, где все слова есть в названии,
+среди них - с более коротким (точнее совпадающим) названием, дальше -
+более новые. Лучшее совпадение из следующего окна всегда ниже худшего из
+текущего. Листание доходит до самых старых совпадений. bm25 перед
+ранжированием проходит весь список документов каждого слова, и запрос из
+частого слова на миллионе лотов занимал бы десятки миллисекунд, а так
+время страницы зависит от ее номера, но не от объема.
+
+Если в запросе есть слово, которое встречается почти в каждом лоте, а
+общих совпадений мало, FTS5 прошел бы весь его список документов. Такое
+слово проверяется по тексту лотов, найденных по остальным (более редким)
+словам, - см. plan_search. Проверка:
+
+    python search.py bench
+    python search.py bench --rows 1000000
+"""
+import argparse
+import functools
+import json
+import math
+import os
+import random
+import re
+import sqlite3
+import sys
+import tempfile
+import time
+import unicodedata
+
+from config import SEARCH_CANDIDATES, SEARCH_MAX_TERMS, SEARCH_PER_PAGE, SEARCH_SAMPLE, SEARCH_TEXT_CHECK
+from records import NFT_COLUMNS, select_list
+
+# Слова так же, как их делит токенизатор unicode61 (подчеркивание - разделитель)
+WORD_RE = re.compile(r'[^\W_]+')
+
+# Длины префиксов, для которых в индексе есть отдельные списки (prefix= в
+# миграции 10; менять только новой миграцией). Префикс другой длины FTS5
+# собирает из списков всех подходящих слов целиком, до LIMIT, - на частых
+# словах это десятки миллисекунд
+PREFIX_LENGTHS = (2, 3, 4, 5, 6, 7, 8)
+
+# remove_diacritics в unicode61 не трогает кириллицу: ё приводим к е сами
+# и в индексе (триггеры миграции 10), и в запросе
+FTS_COLUMNS = ('title', 'description', 'file_name')
+
+def fts_values(alias):
+    """Значения колонок индекса для строки alias (NEW, OLD или таблицы) в SQL"""
+    return ', '.join(f"replace(replace({alias}.{column}, 'ё', 'е'), 'Ё', 'Е')" for column in FTS_COLUMNS)
+
+# Кандидаты - окна страницы: совпадения с :window_start по порядку от
+# новых (rowid = nfts.id растет со временем). Страница захватывает не
+# больше двух окон; кандидаты старше первых :candidates - следующее окно.
+# Индекс ищет по :driver, слова :checked (если есть) проверяются по
+# тексту найденных лотов (has_words, см. plan_search). Совпадения в
+# названии - все в диапазоне rowid кандидатов и среди них самих, поэтому
+# этот проход ограничен и диапазоном, и LIMIT; если совпадения редкие и
+# диапазон длинный, названия кандидатов проверяются по тексту
+# (:titles_by_text). Текст берется прямо из nfts: через колонки
+# external content FTS5 это заметно дороже. m материализуется, чтобы FTS5
+# не спрашивался на каждое обращение к ней
+SEARCH_QUERY = f'''
+    WITH m AS MATERIALIZED (
+        SELECT rowid AS id FROM nfts_fts
+        WHERE nfts_fts MATCH :driver
+          AND (:checked IS NULL OR (
+              SELECT has_words(:checked, title, description, file_name) FROM nfts WHERE id = nfts_fts.rowid
+          ))
+        ORDER BY rowid DESC LIMIT :window OFFSET :window_start
+    ),
+    in_title AS (
+        SELECT rowid FROM nfts_fts
+        WHERE nfts_fts MATCH :title_query
+          AND rowid BETWEEN (SELECT MIN(id) FROM m) AND (SELECT MAX(id) FROM m)
+        LIMIT :window
+    )
+    SELECT {select_list(NFT_COLUMNS, 'n')}, u.username AS seller_username
+    FROM m
+    JOIN nfts n ON n.id = m.id
+    LEFT JOIN users u ON u.id = n.user_id
+    ORDER BY m.id < (SELECT MIN(id) FROM (SELECT id FROM m ORDER BY id DESC LIMIT :candidates)),
+             CASE WHEN :titles_by_text THEN NOT has_words(:query, n.title) ELSE m.id NOT IN in_title END,
+             length(n.title), n.id DESC
+    LIMIT :limit OFFSET :offset
+'''
+
+# Доля лотов с каждым словом запроса (по :sample его новейшим
+# совпадениям - это не дальше пары страниц индекса от конца списка).
+# Если совпадений меньше :sample, список пройден целиком
+TERM_SAMPLE_QUERY = '''
+    WITH newest AS (SELECT coalesce(MAX(id), 1) AS id FROM nfts)
+    SELECT (
+        SELECT CASE WHEN count(*) < :sample THEN count(*) * 1.0 / (SELECT id FROM newest)
+                    ELSE count(*) * 1.0 / ((SELECT id FROM newest) - MIN(rowid) + 1) END
+        FROM (SELECT rowid FROM nfts_fts WHERE nfts_fts MATCH value
+              ORDER BY rowid DESC LIMIT :sample)
+    )
+    FROM json_each(:terms)
+    ORDER BY key
+'''
+
+def query_words(text):
+    """Слова запроса (не больше SEARCH_MAX_TERMS)"""
+    return WORD_RE.findall((text or '').replace('ё', 'е').replace('Ё', 'Е'))[:SEARCH_MAX_TERMS]
+
+def match_query(text):
+    """Выражение MATCH из пользовательского текста или None.
+
+    Слова берутся в кавычки, поэтому синтаксис FTS5 в запросе не
+    работает и не вызывает ошибок. Каждое слово ищется как префикс: так
+    находятся другие формы слова ("сапог" - "сапогах") и результаты
+    появляются по мере набора. Слово длиннее PREFIX_LENGTHS обрезается:
+    совпадения чуть шире, зато запрос идет по индексу префиксов.
+    """
+    words = query_words(text)
+    if not words:
+        return None
+    return ' '.join(
+        f'"{word[:PREFIX_LENGTHS[-1]]}"*' if len(word) >= PREFIX_LENGTHS[0] else f'"{word}"'
+        for word in words
+    )
+
+def sample_params(query):
+    """Параметры TERM_SAMPLE_QUERY; None - оценивать нечего (одно слово)"""
+    terms = query.split()
+    if len(terms) < 2:
+        return None
+    return {'terms': json.dumps(terms), 'sample': SEARCH_SAMPLE}
+
+def plan_search(query, densities, ratio=SEARCH_TEXT_CHECK):
+    """Что искать по индексу, а что по тексту: (driver, checked, titles_by_text).
+
+    densities - доли лотов с каждым словом (TERM_SAMPLE_QUERY), без них
+    (одно слово) все идет через индекс. Пересекая списки документов, FTS5
+    проходит каждый из них на всем отрезке rowid, где набирается окно
+    кандидатов: чем реже общие совпадения, тем длиннее отрезок, а у слова,
+    которое есть почти везде, это почти весь его список. Проверка по тексту
+    (has_words) дороже шага по списку примерно в ratio раз, зато делается
+    только для уже найденных лотов. Поэтому:
+
+    - частые слова по одному, начиная с самого частого, уходят из индекса в
+      проверку по тексту (checked), пока слово чаще оставшихся вместе
+      (произведение долей) больше чем в ratio раз; хотя бы одно слово
+      остается в индексе;
+    - совпадения в названии проверяются по тексту кандидатов, если проход
+      {title} по спискам всех слов длиннее окна больше чем в ratio раз.
+    """
+    terms = query.split()
+    if not densities or len(densities) != len(terms):
+        return query, None, False
+    driver = sorted(zip(densities, terms))
+    checked = []
+    while len(driver) > 1:
+        density, term = driver[-1]
+        if density <= math.prod(other for other, _ in driver[:-1]) * ratio:
+            break
+        checked.append(driver.pop()[1])
+    # Доля лотов со всеми словами - как если бы слова были независимы
+    titles_by_text = sum(densities) > math.prod(densities) * ratio
+    if not checked:
+        return query, None, titles_by_text
+    # Слова - в порядке запроса
+    return (' '.join(term for term in terms if term not in checked),
+            ' '.join(term for term in terms if term in checked),
+            titles_by_text)
+
+def search_params(query, per_page, offset, densities=None, candidates=SEARCH_CANDIDATES):
+    """Параметры SEARCH_QUERY; лишняя строка показывает, есть ли следующая страница.
+
+    Берутся только окна, в которые попадает страница (обычно одно;
+    per_page не больше candidates, так что не больше двух). densities -
+    результат TERM_SAMPLE_QUERY для запроса из нескольких слов.
+    """
+    window_start = offset // candidates * candidates
+    window_end = -(-(offset + per_page + 1) // candidates) * candidates
+    driver, checked, titles_by_text = plan_search(query, densities)
+    return {
+        'query': query,
+        'driver': driver,
+        'checked': checked,
+        'titles_by_text': titles_by_text,
+        'title_query': f'{{title}} : ({query})',
+        'candidates': candidates,
+        'window': window_end - window_start,
+        'window_start': window_start,
+        'limit': per_page + 1,
+        'offset': offset - window_start,
+    }
+
+# Приведение текста к виду, в котором unicode61 (remove_diacritics 2)
+# сравнивает слова: регистр, ё, диакритика латиницы
+LATIN_MARKED_RE = re.compile('[\u00c0-\u024f\u1e00-\u1eff]')
+LATIN_DIACRITICS_RE = re.compile('(?<=[A-Za-z])[\u0300-\u036f]+')
+
+def _fold(text):
+    return text.lower().replace('ё', 'е')
+
+def _strip_diacritics(text):
+    if not LATIN_MARKED_RE.search(text):
+        return text
+    return unicodedata.normalize('NFC', LATIN_DIACRITICS_RE.sub('', unicodedata.normalize('NFD', text)))
+
+@functools.lru_cache(maxsize=1024)
+def _parse_terms(query):
+    """[(слово, префикс ли)] из выражения match_query"""
+    return [(_strip_diacritics(_fold(term.strip('"*'))), term.endswith('*')) for term in query.split()]
+
+def _has_word(text, word, prefix):
+    start = text.find(word)
+    while start >= 0:
+        end = start + len(word)
+        # Граница слова - как у токенизатора: все, что не буква и не цифра
+        if (start == 0 or not text[start - 1].isalnum()) and \
+                (prefix or end == len(text) or not text[end].isalnum()):
+            return True
+        start = text.find(word, start + 1)
+    return False
+
+def has_words(query, *texts):
+    """Есть ли в текстах все слова выражения match_query (1/0, для SQL).
+
+    Слова сравниваются так же, как в индексе; диакритика снимается, только
+    если без этого слово не нашлось (на ней тратится больше всего времени).
+    """
+    text = _fold(' '.join(t for t in texts if t))
+    stripped = None
+    for word, prefix in _parse_terms(query):
+        if _has_word(text, word, prefix):
+            continue
+        if stripped is None:
+            stripped = _strip_diacritics(text)
+        if stripped is text or not _has_word(stripped, word, prefix):
+            return 0
+    return 1
+
+def register_functions(conn):
+    """Функции SQLite для SEARCH_QUERY (на каждом новом соединении)"""
+    conn.create_function('has_words', -1, has_words, deterministic=True)
+
+def build_search_page(rows, per_page, offset):
+    """Страница поиска: {'items', 'next_offset'} (None - страниц больше нет)"""
+    return {
+        'items': rows[:per_page],
+        'next_offset': offset + per_page if len(rows) > per_page else None
+    }
+
+SYLLABLES = (
+    ('ka', 'ri', 'mo', 'zen', 'lu', 'pix', 'nor', 'ta', 'vel', 'dra', 'si', 'kor'),
+    ('ко', 'ша', 'ми', 'ра', 'лун', 'дже', 'ти', 'вол', 'на', 'стр', 'ел', 'бо'),
+)
+
+def _vocabulary(rng, size):
+    """Случайные слова; порядок в списке - частотность (первое - самое частое)"""
+    words = set()
+    while len(words) < size:
+        syllables = rng.choice(SYLLABLES)
+        words.add(''.join(rng.choice(syllables) for _ in range(rng.randint(2, 4))))
+    words = sorted(words)
+    rng.shuffle(words)
+    return words
+
+def _fill(conn, rows, vocabulary, rng, batch=10000):
+    """Лоты на продаже со словами по закону Ципфа (частые и редкие слова)"""
+    weights = [1 / (rank + 1) for rank in range(len(vocabulary))]
+    cum_weights = []
+    total = 0
+    for weight in weights:
+        total += weight
+        cum_weights.append(total)
+
+    def words(k):
+        return ' '.join(rng.choices(vocabulary, cum_weights=cum_weights, k=k))
+
+    conn.executemany('INSERT INTO users (telegram_id, username) VALUES (?, ?)',
+                     [(i, f'seller{i}') for i in range(1, 1001)])
+    for start in range(0, rows, batch):
+        conn.executemany(
+            "INSERT INTO nfts (user_id, file_id, file_name, title, description, price, status) "
+            "VALUES (?, ?, ?, ?, ?, ?, 'for_sale')",
+            [(rng.randint(1, 1000), f'f{i}', f'{words(1)}_{i}.png', words(rng.randint(2, 4)),
+              words(rng.randint(5, 15)), rng.randint(1, 1000))
+             for i in range(start, min(rows, start + batch))]
+        )
+        conn.commit()
+
+def _all_pages(db, query, per_page):
+    """id всех результатов при листании до конца"""
+    ids = []
+    offset = 0
+    while offset is not None:
+        page = db._load_search(query, per_page, offset)
+        ids.extend(nft.id for nft in page['items'])
+        offset = page['next_offset']
+    return ids
+
+def bench(rows, repeat=200, limit_ms=5.0, seed=1):
+    """Время search_nfts на rows лотах для запросов разной частотности.
+
+    Первый запрос каждой страницы не учитывается: он читает страницы
+    свежезаполненной базы с диска. Для каждого запроса проверяется p99
+    первых трех страниц; страница за первым окном кандидатов дороже (FTS5
+    проходит все совпадения до нее) - ее время показывается без проверки.
+    Отдельно проверяется, что листание доходит до каждого совпадения - и
+    по индексу, и с проверкой частого слова по тексту.
+    """
+    from database import Database
+
+    rng = random.Random(seed)
+    vocabulary = _vocabulary(rng, 20000)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'search.db')
+        db = Database(path)
+        conn = sqlite3.connect(path)
+        started = time.perf_counter()
+        _fill(conn, rows, vocabulary, rng)
+        conn.close()
+        print(f"filled {rows} listings (indexed by triggers) in {time.perf_counter() - started:.1f}s, "
+              f"db {os.path.getsize(path) / 1e6:.0f} MB")
+
+        common, medium, rare = vocabulary[0], vocabulary[100], vocabulary[2000]
+        queries = {
+            'common word': common,
+            'medium word': medium,
+            'rare word': rare,
+            'two words': f'{common} {medium}',
+            'two, one rare': f'{medium} {rare}',
+            'prefix (2 chars)': medium[:2],
+            'prefix (4 chars)': medium[:4],
+            'no match': 'qqqzzz',
+            # Редкое сочетание с почти повсеместным словом: частое слово
+            # проверяется по тексту (plan_search)
+            'three words': f'{common} {medium} {rare}',
+        }
+        # Первая и следующие страницы, как при листании
+        offsets = (0, SEARCH_PER_PAGE, 2 * SEARCH_PER_PAGE)
+        deep_offset = SEARCH_CANDIDATES + SEARCH_PER_PAGE
+        ok = True
+        for name, text in queries.items():
+            query = match_query(text)
+            for offset in (*offsets, deep_offset):
+                db._load_search(query, SEARCH_PER_PAGE, offset)
+            timings, deep = [], []
+            for i in range(repeat):
+                for offset, samples in ((offsets[i % len(offsets)], timings), (deep_offset, deep)):
+                    t = time.perf_counter()
+                    page = db._load_search(query, SEARCH_PER_PAGE, offset)
+                    samples.append(time.perf_counter() - t)
+                    if samples is timings:
+                        results = len(page['items'])
+            timings.sort()
+            deep.sort()
+            p50, p99 = timings[len(timings) // 2] * 1e3, timings[int(len(timings) * 0.99)] * 1e3
+            ok = ok and p99 <= limit_ms
+            print(f"{name:17} {text!r:36} {results:2} results: "
+                  f"p50 {p50:.2f} ms, p99 {p99:.2f} ms; "
+                  f"offset {deep_offset}: p50 {deep[len(deep) // 2] * 1e3:.2f} ms")
+
+        for text in (rare, queries['three words']):
+            query = match_query(text)
+            with db.get_connection() as conn:
+                matches = {row[0] for row in conn.execute('SELECT rowid FROM nfts_fts WHERE nfts_fts MATCH ?', (query,))}
+                params = sample_params(query)
+                densities = params and [row[0] for row in conn.execute(TERM_SAMPLE_QUERY, params)]
+            paged = _all_pages(db, query, SEARCH_PER_PAGE)
+            reached = len(paged) == len(set(paged)) and set(paged) == matches
+            ok = ok and reached
+            checked = plan_search(query, densities)[1]
+            print(f"paging {text!r}: {len(set(paged))} of {len(matches)} matches reached "
+                  f"({len(matches) // SEARCH_CANDIDATES + 1} windows of {SEARCH_CANDIDATES}, "
+                  f"{'checked by text: ' + checked if checked else 'index only'}), "
+                  f"{len(paged) - len(set(paged))} repeated")
+        db.close()
+
+    print(f"{'✅' if ok else '❌'} p99 under {limit_ms} ms on {rows} listings for every query, "
+          f"paging reaches every match")
+    return ok
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Поиск лотов')
+    parser.add_argument('command', choices=['bench'])
+    parser.add_argument('--rows', type=int, default=1000000, help='Лотов в индексе')
+    parser.add_argument('--limit-ms', type=float, default=5.0, help='Допустимый p99 запроса')
+    args = parser.parse_args(argv)
+    return 0 if bench(args.rows, limit_ms=args.limit_ms) else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
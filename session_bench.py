@@ -0,0 +1,77 @@
+# session_bench.py
+"""Стоимость одного сообщения при большом числе сессий загрузки.
+
+На каждое текстовое сообщение бот-приемщик вызывает фильтр
+is_waiting_for_input и затем find_user_session. "До" - словарь сессий
+с линейным поиском по user_id, как было до SessionStore; "после" -
+SessionStore с индексом по пользователю. Сообщения приходят от
+случайных пользователей, половина из них без активной сессии:
+
+    python session_bench.py
+    python session_bench.py --sessions 1000 100000 --messages 2000
+"""
+import argparse
+import random
+import sys
+import time
+import uuid
+
+from sessions import SessionStore
+
+class ScanSessions:
+    """Сессии в словаре session_id -> session, поиск перебором"""
+
+    def __init__(self):
+        self._sessions = {}
+
+    def create(self, user_id, data):
+        session_id = str(uuid.uuid4())[:8]
+        self._sessions[session_id] = dict(data, user_id=user_id)
+        return session_id
+
+    def find_by_user(self, user_id):
+        for session_id, session in self._sessions.items():
+            if session['user_id'] == user_id:
+                return session_id
+        return None
+
+def handle_message(store, user_id):
+    """Путь сообщения: фильтр хендлера и поиск сессии"""
+    if store.find_by_user(user_id) is None:
+        return None
+    return store.find_by_user(user_id)
+
+def per_message(store, sessions, messages, seed=1):
+    """Секунд на одно сообщение"""
+    for user_id in range(sessions):
+        store.create(user_id, {'file_info': {}, 'step': 'waiting_title'})
+    rng = random.Random(seed)
+    users = [rng.randrange(sessions * 2) for _ in range(messages)]
+
+    started = time.perf_counter()
+    for user_id in users:
+        handle_message(store, user_id)
+    return (time.perf_counter() - started) / messages
+
+def bench(counts, messages):
+    ok = True
+    print(f"{messages} messages, half of them from users without a session")
+    for sessions in counts:
+        # Перебор на 100k сессий медленный: ему хватит меньшей выборки
+        before = per_message(ScanSessions(), sessions, max(10, messages * 1000 // sessions))
+        after = per_message(SessionStore(max_size=sessions), sessions, messages)
+        ok = ok and after < before
+        print(f"{sessions:7} sessions: {before * 1e6:9.1f} us -> {after * 1e6:5.2f} us per message "
+              f"({before / after:.0f}x)")
+    print(f"{'✅' if ok else '❌'} indexed session lookup is faster at every size")
+    return ok
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Стоимость сообщения при большом числе сессий')
+    parser.add_argument('--sessions', type=int, nargs='+', default=[1000, 100000])
+    parser.add_argument('--messages', type=int, default=20000, help='Сообщений для SessionStore')
+    args = parser.parse_args(argv)
+    return 0 if bench(args.sessions, args.messages) else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,187 @@
+# sessions.py
+import time
+import uuid
+from collections import OrderedDict
+
+from config import SESSION_TTL, MAX_SESSIONS, SESSION_CACHE_TTL
+
+class SessionStore:
+    """Сессии загрузки NFT с индексами по session_id и user_id.
+
+    Поиск по пользователю - O(1). Сессии упорядочены по последнему
+    обращению, поэтому просроченные (idle TTL) вытесняются с начала
+    очереди за амортизированное O(1), а при превышении max_size
+    удаляются самые давние.
+    """
+
+    def __init__(self, ttl=SESSION_TTL, max_size=MAX_SESSIONS):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._sessions = OrderedDict()  # session_id -> [session, last_seen]
+        self._by_user = {}  # user_id -> session_id
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def __contains__(self, session_id):
+        return self.get(session_id) is not None
+
+    def create(self, user_id, data):
+        """Новая сессия пользователя (предыдущая сессия заменяется)"""
+        self._evict_expired()
+
+        return self.put(str(uuid.uuid4())[:8], user_id, data)
+
+    def put(self, session_id, user_id, data):
+        """Сохранение сессии с известным ID"""
+        old_session_id = self._by_user.get(user_id)
+        if old_session_id and old_session_id != session_id:
+            self.delete(old_session_id)
+
+        session = dict(data, user_id=user_id)
+        self._sessions[session_id] = [session, time.monotonic()]
+        self._sessions.move_to_end(session_id)
+        self._by_user[user_id] = session_id
+
+        while len(self._sessions) > self.max_size:
+            oldest_id = next(iter(self._sessions))
+            self.delete(oldest_id)
+
+        return session_id
+
+    def get(self, session_id):
+        """Сессия по ID (обращение продлевает TTL)"""
+        entry = self._sessions.get(session_id)
+        if entry is None:
+            return None
+        now = time.monotonic()
+        if now - entry[1] > self.ttl:
+            self.delete(session_id)
+            return None
+        entry[1] = now
+        self._sessions.move_to_end(session_id)
+        return entry[0]
+
+    def find_by_user(self, user_id):
+        """ID активной сессии пользователя или None"""
+        session_id = self._by_user.get(user_id)
+        if session_id is None or self.get(session_id) is None:
+            return None
+        return session_id
+
+    def delete(self, session_id):
+        """Удаление сессии"""
+        entry = self._sessions.pop(session_id, None)
+        if entry is not None:
+            user_id = entry[0]['user_id']
+            if self._by_user.get(user_id) == session_id:
+                del self._by_user[user_id]
+
+    def _evict_expired(self):
+        deadline = time.monotonic() - self.ttl
+        while self._sessions:
+            session_id, (_, last_seen) = next(iter(self._sessions.items()))
+            if last_seen >= deadline:
+                break
+            self.delete(session_id)
+
+class PersistentSessionStore:
+    """Сессии мастера загрузки в таблице upload_sessions.
+
+    Состояние переживает перезапуск и доступно всем процессам бота.
+    Перед базой стоит SessionStore: сессия, прочитанная или записанная
+    не раньше cache_ttl секунд назад, берется из памяти. Так же недолго
+    помнится, что сессии у пользователя нет: фильтр хендлера проверяет
+    каждое сообщение, и без этого каждое сообщение без сессии читало бы
+    базу. Изменения помечаются через save() и пишутся одной пачкой в
+    flush() - обычно в конце хендлера, так что несколько правок дают одну
+    запись.
+    """
+
+    def __init__(self, db, ttl=SESSION_TTL, max_size=MAX_SESSIONS, cache_ttl=SESSION_CACHE_TTL):
+        self.db = db  # AsyncDatabase
+        self.ttl = ttl
+        self.cache_ttl = cache_ttl
+        self.max_size = max_size
+        self._front = SessionStore(ttl, max_size)
+        self._absent = OrderedDict()  # user_id -> когда в базе не нашлось сессии
+        self._dirty = {}  # user_id -> session_id
+
+    def create(self, user_id, data):
+        """Новая сессия пользователя (запишется при flush)"""
+        self._absent.pop(user_id, None)
+        session_id = self._front.create(user_id, data)
+        self.save(session_id)
+        return session_id
+
+    def get(self, session_id):
+        """Сессия из кэша (после find_by_user)"""
+        return self._front.get(session_id)
+
+    def save(self, session_id):
+        """Пометка сессии как измененной"""
+        session = self._front.get(session_id)
+        if session is not None:
+            session['touched_at'] = time.time()
+            session['cached_at'] = time.monotonic()
+            self._dirty[session['user_id']] = session_id
+
+    async def find_by_user(self, user_id):
+        """ID активной сессии пользователя или None"""
+        session_id = self._front.find_by_user(user_id)
+        if session_id is not None:
+            session = self._front.get(session_id)
+            if user_id in self._dirty or time.monotonic() - session['cached_at'] < self.cache_ttl:
+                return session_id
+        else:
+            absent_since = self._absent.get(user_id)
+            if absent_since is not None and time.monotonic() - absent_since < self.cache_ttl:
+                return None
+
+        # Сессию мог изменить другой процесс или она пережила перезапуск
+        data = await self.db.get_upload_session(user_id)
+        if data is not None and time.time() - data.get('touched_at', 0) > self.ttl:
+            await self.db.delete_upload_session(user_id, data['session_id'])
+            data = None
+        if data is None:
+            if session_id is not None:
+                self._front.delete(session_id)
+            self._remember_absent(user_id)
+            return None
+
+        self._absent.pop(user_id, None)
+        data['cached_at'] = time.monotonic()
+        return self._front.put(data['session_id'], user_id, data)
+
+    def _remember_absent(self, user_id):
+        self._absent[user_id] = time.monotonic()
+        self._absent.move_to_end(user_id)
+        while len(self._absent) > self.max_size:
+            self._absent.popitem(last=False)
+
+    async def delete(self, session_id, user_id):
+        """Удаление сессии (в том числе из базы)"""
+        self._front.delete(session_id)
+        if self._dirty.get(user_id) == session_id:
+            del self._dirty[user_id]
+
+        # Удаляется только эта сессия: более новую старая кнопка отмены не трогает
+        await self.db.delete_upload_session(user_id, session_id)
+
+    async def flush(self):
+        """Запись измененных сессий в базу одной пачкой"""
+        if not self._dirty:
+            return
+        dirty, self._dirty = self._dirty, {}
+
+        sessions = []
+        for user_id, session_id in dirty.items():
+            session = self._front.get(session_id)
+            if session is None:
+                continue
+            data = {key: value for key, value in session.items() if key != 'cached_at'}
+            data['session_id'] = session_id
+            sessions.append((user_id, data))
+
+        if sessions:
+            await self.db.set_upload_sessions(sessions)
@@ -0,0 +1,147 @@
+# sse_bench.py
+"""Нагрузочный прогон live-событий: 5k одновременных подписчиков.
+
+Каждый подписчик - корутина, которая читает events.async_event_stream, как
+это делает sse_server.py для открытого соединения /api/events; продажи
+публикуются из отдельного потока, как из сайта. Часть подписчиков
+медленные (долго "пишут в сокет") - они должны отстать и получить reset,
+не задерживая публикацию и остальных.
+
+Проверяется, что быстрые подписчики получили все общие события и только
+свои события о балансе; замеряются задержка доставки, время публикации и
+память на соединение:
+
+    python sse_bench.py
+    python sse_bench.py --subscribers 5000 --sales 200 --rate 50
+"""
+import argparse
+import asyncio
+import random
+import re
+import sys
+import threading
+import time
+import tracemalloc
+
+from events import EventHub, async_event_stream, publish_sale
+
+EVENT_RE = re.compile(rb'id: \w+-(\d+)\nevent: (\w+)\n')
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0.0
+
+class Subscriber:
+    def __init__(self, hub, user_id, published, stop, slow=0.0):
+        self.stream = async_event_stream(hub, user_id, keepalive=0.5)
+        self.user_id = user_id
+        self.published = published  # seq -> время публикации
+        self.stop = stop
+        self.slow = slow
+        self.counts = {}
+        self.latencies = []
+
+    async def run(self):
+        async for chunk in self.stream:
+            now = time.perf_counter()
+            first = True
+            for seq, event_type in EVENT_RE.findall(chunk):
+                event_type = event_type.decode()
+                self.counts[event_type] = self.counts.get(event_type, 0) + 1
+                if first and event_type != 'reset':
+                    # Задержка первого (самого старого) события в куске
+                    self.latencies.append(now - self.published[int(seq)])
+                    first = False
+            if self.stop.is_set():
+                return
+            if self.slow:
+                await asyncio.sleep(self.slow)  # медленный клиент: запись в сокет ждет
+
+def publish_sales(hub, subscribers, sales, rate, rng, publish_times, expected_private):
+    """Продажи: общее событие sold и по balance_changed покупателю и продавцу"""
+    started = time.perf_counter()
+    for i in range(sales):
+        buyer, seller = rng.sample(range(subscribers), 2)
+        sale = {'nft_id': i, 'amount': 10, 'buyer_id': buyer, 'seller_id': seller}
+        t = time.perf_counter()
+        publish_sale(hub, sale)
+        publish_times.append(time.perf_counter() - t)
+        for user_id in (buyer, seller):
+            expected_private[user_id] = expected_private.get(user_id, 0) + 1
+        time.sleep(max(0.0, started + (i + 1) / rate - time.perf_counter()))
+    return time.perf_counter() - started
+
+async def run(subscribers, sales, rate, slow_share, buffer_size, seed=1):
+    rng = random.Random(seed)
+    hub = EventHub(buffer_size=buffer_size)
+    published = {}
+    stop = threading.Event()
+
+    # Запись времени публикации по номеру события
+    append = hub._append
+
+    def timed_append(event_type, data, user_id=None):
+        # Публикует один поток - следующий номер известен заранее
+        published[hub.head() + 1] = time.perf_counter()
+        append(event_type, data, user_id)
+
+    hub._append = timed_append
+
+    tracemalloc.start()
+    before_traced = tracemalloc.get_traced_memory()[0]
+    slow_count = int(subscribers * slow_share)
+    clients = [
+        Subscriber(hub, user_id, published, stop, slow=1.0 if user_id < slow_count else 0.0)
+        for user_id in range(subscribers)
+    ]
+    tasks = [asyncio.ensure_future(client.run()) for client in clients]
+    await asyncio.sleep(1)
+    per_connection = (tracemalloc.get_traced_memory()[0] - before_traced) / subscribers
+    tracemalloc.stop()
+
+    expected_private = {}
+    publish_times = []
+    publishing = await asyncio.get_running_loop().run_in_executor(
+        None, publish_sales, hub, subscribers, sales, rate, rng, publish_times, expected_private
+    )
+
+    await asyncio.sleep(2)  # быстрые подписчики дочитывают
+    stop.set()
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+    fast = clients[slow_count:]
+    complete = sum(1 for c in fast if c.counts.get('sold', 0) == sales)
+    private_ok = all(
+        c.counts.get('balance_changed', 0) == expected_private.get(c.user_id, 0) for c in fast
+    )
+    slow_reset = sum(1 for c in clients[:slow_count] if c.counts.get('reset', 0))
+    latencies = [latency for c in fast for latency in c.latencies]
+    delivered = sum(sum(c.counts.values()) for c in clients)
+
+    ok = complete == len(fast) and private_ok and (not slow_count or slow_reset == slow_count)
+    print(f"{subscribers} subscribers ({slow_count} slow), {sales} sales = {sales * 3} events "
+          f"in {publishing:.1f}s, {delivered} events delivered")
+    print(f"memory per connection: {per_connection / 1024:.1f} KB traced")
+    print(f"publish: p50 {percentile(publish_times, 0.5) * 1e3:.2f} ms, "
+          f"p99 {percentile(publish_times, 0.99) * 1e3:.2f} ms per sale")
+    print(f"delivery latency: p50 {percentile(latencies, 0.5) * 1e3:.1f} ms, "
+          f"p99 {percentile(latencies, 0.99) * 1e3:.1f} ms")
+    print(f"{'✅' if ok else '❌'} fast subscribers with every sale: {complete}/{len(fast)}, "
+          f"only own balance events: {private_ok}, slow subscribers reset: {slow_reset}/{slow_count}")
+    return ok
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Нагрузочный прогон live-событий')
+    parser.add_argument('--subscribers', type=int, default=5000)
+    parser.add_argument('--sales', type=int, default=200)
+    parser.add_argument('--rate', type=float, default=50, help='Продаж в секунду')
+    parser.add_argument('--slow', type=float, default=0.02, help='Доля медленных подписчиков')
+    parser.add_argument('--buffer', type=int, default=100, help='Размер буфера событий')
+    args = parser.parse_args(argv)
+    ok = asyncio.run(run(args.subscribers, args.sales, args.rate, args.slow, args.buffer))
+    return 0 if ok else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
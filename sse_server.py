@@ -0,0 +1,76 @@
+# sse_server.py
+"""Сервер live-событий (/api/events) на aiohttp.
+
+Каждое соединение сайта через Flask держит поток WSGI-сервера, а здесь -
+только корутину, поэтому один процесс держит тысячи открытых вкладок.
+Запись в сокет ждет, пока клиент прочитает предыдущее: медленный клиент
+отстает в буфере хаба и получает reset, остальных он не задерживает.
+
+События приходят из сайта и ботов через Redis (EVENTS_BACKEND = "redis"),
+а nginx проксирует на этот сервер location /api/events:
+
+    python sse_server.py
+"""
+import logging
+
+from aiohttp import web
+from flask import Flask
+
+from config import SECRET_KEY, EVENTS_BACKEND, SSE_HOST, SSE_PORT
+from events import create_hub, async_event_stream
+
+# Сессии сайта подписаны ключом Flask - проверяем их тем же сериализатором
+_session_app = Flask(__name__)
+_session_app.secret_key = SECRET_KEY
+SESSION_COOKIE = _session_app.config['SESSION_COOKIE_NAME']
+SESSION_MAX_AGE = int(_session_app.permanent_session_lifetime.total_seconds())
+
+def session_user(cookie):
+    """ID пользователя из cookie сессии Flask-Login (None - не вошел)"""
+    if not cookie:
+        return None
+    serializer = _session_app.session_interface.get_signing_serializer(_session_app)
+    try:
+        user_id = serializer.loads(cookie, max_age=SESSION_MAX_AGE).get('_user_id')
+    except Exception:
+        return None
+    return int(user_id) if user_id is not None else None
+
+def create_app(hub):
+    """aiohttp-приложение с потоком событий хаба на /api/events"""
+
+    async def handle_events(request):
+        response = web.StreamResponse(headers={
+            'Content-Type': 'text/event-stream',
+            'Cache-Control': 'no-cache',
+            # Отключает буферизацию ответа в nginx
+            'X-Accel-Buffering': 'no',
+        })
+        await response.prepare(request)
+        stream = async_event_stream(
+            hub,
+            session_user(request.cookies.get(SESSION_COOKIE)),
+            request.headers.get('Last-Event-ID')
+        )
+        try:
+            async for chunk in stream:
+                await response.write(chunk)
+        except ConnectionResetError:
+            pass
+        finally:
+            await stream.aclose()
+        return response
+
+    app = web.Application()
+    app['hub'] = hub
+    app.router.add_get('/api/events', handle_events)
+    return app
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    if EVENTS_BACKEND != 'redis':
+        logging.warning("EVENTS_BACKEND is not redis: events from the site and bots will not reach this server")
+    web.run_app(create_app(create_hub()), host=SSE_HOST, port=SSE_PORT)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+# transfers.py
+import logging
+import secrets
+import string
+import threading
+
+from config import TRANSFER_CODE_LENGTH, TRANSFER_REAP_INTERVAL, TRANSFER_ARCHIVE_AFTER, TRANSFER_REAP_BATCH
+
+CODE_ALPHABET = string.ascii_uppercase + string.digits
+
+def generate_code(length=TRANSFER_CODE_LENGTH):
+    """Случайный код передачи.
+
+    Уникальность не проверяется заранее: ее гарантирует UNIQUE на
+    transfer_code, а при редком совпадении вставка повторяется с новым
+    кодом (см. Database.issue_transfer_code).
+    """
+    return ''.join(secrets.choice(CODE_ALPHABET) for _ in range(length))
+
+class TransferReaper:
+    """Фоновая уборка кодов передачи.
+
+    Раз в interval секунд помечает просроченные pending-коды как expired
+    и переносит завершенные и просроченные коды старше archive_after
+    секунд в transfer_requests_archive. Все идет пачками по batch_size
+    строк, чтобы не держать блокировку записи долго.
+    """
+
+    def __init__(self, db, interval=TRANSFER_REAP_INTERVAL, archive_after=TRANSFER_ARCHIVE_AFTER,
+                 batch_size=TRANSFER_REAP_BATCH):
+        self.db = db  # Database
+        self.interval = interval
+        self.archive_after = archive_after
+        self.batch_size = batch_size
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def reap(self):
+        """Один проход уборки, возвращает (просрочено, заархивировано)"""
+        expired = self._drain(lambda: self.db.expire_transfers(self.batch_size))
+        archived = self._drain(lambda: self.db.archive_transfers(self.archive_after, self.batch_size))
+        if expired or archived:
+            logging.info(f"Transfer codes: {expired} expired, {archived} archived")
+        return expired, archived
+
+    def _drain(self, step):
+        total = 0
+        while not self._stop_event.is_set():
+            count = step()
+            total += count
+            if count < self.batch_size:
+                break
+        return total
+
+    def start(self):
+        """Запуск фоновой уборки"""
+        if self._thread is None:
+            self._stop_event.clear()
+            self._thread = threading.Thread(target=self._run, name='transfer-reaper', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Остановка фоновой уборки"""
+        if self._thread is not None:
+            self._stop_event.set()
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                self.reap()
+            except Exception as e:
+                logging.error(f"Error reaping transfer codes: {e}")
@@ -0,0 +1,124 @@
+# view_counter.py
+import logging
+import threading
+import time
+
+from config import CACHE_TTL
+
+# Интервал сброса накопленных просмотров в базу (секунды)
+FLUSH_INTERVAL = 5
+SHARDS = 16
+
+class ViewCounter:
+    """Буфер просмотров NFT с отложенной записью (write-behind).
+
+    Инкременты копятся в памяти по шардам и периодически одной транзакцией
+    записываются через flush_fn(deltas), где deltas - {nft_id: прирост}.
+
+    Записи в кэше листингов хранят просмотры на момент чтения из базы
+    (snapshot), поэтому запись просмотров кэш не сбрасывает: приросты,
+    записанные за последние history секунд (не меньше TTL кэша), хранятся
+    здесь, и since() добавляет к снимку все, что было после него.
+    """
+
+    def __init__(self, flush_fn, interval=FLUSH_INTERVAL, shards=SHARDS, history=CACHE_TTL):
+        self.flush_fn = flush_fn
+        self.interval = interval
+        self.history = history
+        self._shards = [({}, threading.Lock()) for _ in range(shards)]
+        # Прирост, который сейчас записывается в базу
+        self._inflight = {}
+        # Записанные приросты: ((время записи, deltas), ...) - кортеж
+        # заменяется целиком, чтобы since() читал его без блокировки
+        self._written = ()
+        self._flush_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def _shard(self, nft_id):
+        return self._shards[hash(nft_id) % len(self._shards)]
+
+    def increment(self, nft_id, amount=1):
+        """Учет просмотра без обращения к базе"""
+        counts, lock = self._shard(nft_id)
+        with lock:
+            counts[nft_id] = counts.get(nft_id, 0) + amount
+
+    def pending(self, nft_id):
+        """Просмотры, еще не записанные в базу"""
+        counts, lock = self._shard(nft_id)
+        with lock:
+            value = counts.get(nft_id, 0)
+        return value + self._inflight.get(nft_id, 0)
+
+    def snapshot(self):
+        """Метка для просмотров, прочитанных из базы сейчас (см. since).
+
+        Берется прямо перед запросом; время - по часам, а не monotonic,
+        потому что запись из Redis мог прочитать другой процесс.
+        """
+        return time.time()
+
+    def since(self, nft_id, mark=None):
+        """Просмотры, которых нет в снимке mark: еще не записанные в базу
+        и записанные этим процессом после снимка (без mark - только первые)"""
+        value = self.pending(nft_id)
+        if mark is not None:
+            for written_at, deltas in self._written:
+                if written_at > mark:
+                    value += deltas.get(nft_id, 0)
+        return value
+
+    def flush(self):
+        """Запись накопленных просмотров в базу"""
+        with self._flush_lock:
+            deltas = {}
+            for counts, lock in self._shards:
+                with lock:
+                    if not counts:
+                        continue
+                    swapped = counts.copy()
+                    counts.clear()
+                for nft_id, amount in swapped.items():
+                    deltas[nft_id] = deltas.get(nft_id, 0) + amount
+
+            if not deltas:
+                return 0
+
+            self._inflight = deltas
+            try:
+                self.flush_fn(deltas)
+            except Exception as e:
+                logging.error(f"Error flushing views: {e}")
+                self._inflight = {}
+                # Возвращаем прирост в буфер, чтобы не потерять просмотры
+                for nft_id, amount in deltas.items():
+                    self.increment(nft_id, amount)
+                return 0
+            # Время после коммита: снимок, сделанный раньше, этих
+            # просмотров не содержит
+            written_at = time.time()
+            self._written = tuple(
+                entry for entry in self._written if entry[0] > written_at - self.history
+            ) + ((written_at, deltas),)
+            self._inflight = {}
+            return len(deltas)
+
+    def start(self):
+        """Запуск фонового сброса"""
+        if self._thread is None:
+            self._stop_event.clear()
+            self._thread = threading.Thread(target=self._run, name='view-counter', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Остановка фонового сброса с финальной записью"""
+        if self._thread is not None:
+            self._stop_event.set()
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            self.flush()
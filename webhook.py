@@ -0,0 +1,178 @@
+# webhook.py
+import asyncio
+import logging
+from collections import OrderedDict, deque
+
+from aiohttp import web
+from aiogram import Bot, Dispatcher, types
+
+from config import WEBHOOK_URL, WEBHOOK_HOST, WEBHOOK_SECRET, WEBHOOK_WORKERS, WEBHOOK_MAX_PENDING, WEBHOOK_DEDUP_SIZE, WEBHOOK_DRAIN_TIMEOUT
+
+# Поля апдейта, у которых есть отправитель (from) или чат
+UPDATE_FIELDS = (
+    'message', 'edited_message', 'callback_query', 'inline_query', 'chosen_inline_result',
+    'shipping_query', 'pre_checkout_query', 'my_chat_member', 'chat_member', 'chat_join_request',
+    'channel_post', 'edited_channel_post', 'poll_answer'
+)
+
+def update_key(data):
+    """Ключ очередности апдейта: ID пользователя (или чата)"""
+    for field in UPDATE_FIELDS:
+        obj = data.get(field)
+        if obj:
+            user = obj.get('from') or obj.get('user')
+            if user:
+                return user['id']
+            chat = obj.get('chat') or (obj.get('message') or {}).get('chat')
+            if chat:
+                return chat['id']
+            break
+    # Апдейты без пользователя друг от друга не зависят
+    return ('update', data.get('update_id'))
+
+class RecentIds:
+    """Последние max_size увиденных ID (для отбрасывания повторов)"""
+
+    def __init__(self, max_size=WEBHOOK_DEDUP_SIZE):
+        self.max_size = max_size
+        self._ids = OrderedDict()
+
+    def __contains__(self, item_id):
+        return item_id in self._ids
+
+    def add(self, item_id):
+        self._ids[item_id] = None
+        if len(self._ids) > self.max_size:
+            self._ids.popitem(last=False)
+
+class UpdateDispatcher:
+    """Обработка апдейтов пулом из workers корутин.
+
+    Апдейты одного пользователя обрабатываются строго по очереди, разных
+    пользователей - параллельно; пользователи обслуживаются по кругу.
+    Повторы по update_id отбрасываются. Если в очереди уже max_pending
+    апдейтов, новый не принимается (Telegram повторит его позже).
+
+    Принятый апдейт Telegram уже считает доставленным, поэтому при
+    остановке очередь дорабатывается (до drain_timeout секунд), а новые
+    апдейты получают отказ и придут повторно после перезапуска.
+    """
+
+    def __init__(self, dp, workers=WEBHOOK_WORKERS, max_pending=WEBHOOK_MAX_PENDING,
+                 dedup_size=WEBHOOK_DEDUP_SIZE, drain_timeout=WEBHOOK_DRAIN_TIMEOUT):
+        self.dp = dp
+        self.workers = workers
+        self.max_pending = max_pending
+        self.drain_timeout = drain_timeout
+        self._seen = RecentIds(dedup_size)
+        self._pending = {}  # key -> deque(апдейтов), пока ключ в работе
+        self._ready = None  # очередь ключей по кругу
+        self._idle = None  # выставлен, когда очередь пуста
+        self._closing = False
+        self._tasks = []
+        self.queued = 0
+        self.processed = 0
+        self.duplicates = 0
+
+    def submit(self, data):
+        """Постановка апдейта в очередь; False - очередь переполнена или идет остановка"""
+        update_id = data.get('update_id')
+        if update_id in self._seen:
+            self.duplicates += 1
+            return True
+        if self.queued >= self.max_pending or self._closing:
+            return False
+
+        self._start()
+        self._seen.add(update_id)
+        key = update_key(data)
+        queue = self._pending.get(key)
+        if queue is None:
+            queue = self._pending[key] = deque()
+            self._ready.put_nowait(key)
+        queue.append(data)
+        self.queued += 1
+        self._idle.clear()
+        return True
+
+    def _start(self):
+        if self._tasks:
+            return
+        self._ready = asyncio.Queue()
+        self._idle = asyncio.Event()
+        self._tasks = [asyncio.ensure_future(self._worker()) for _ in range(self.workers)]
+
+    async def close(self):
+        """Остановка: прием закрывается, принятые апдейты дорабатываются"""
+        self._closing = True
+        if self._tasks:
+            try:
+                await asyncio.wait_for(self._idle.wait(), self.drain_timeout)
+            except asyncio.TimeoutError:
+                logging.error(f"{self.queued} accepted updates dropped: not processed "
+                              f"within {self.drain_timeout}s of shutdown")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _worker(self):
+        Dispatcher.set_current(self.dp)
+        Bot.set_current(self.dp.bot)
+        while True:
+            key = await self._ready.get()
+            queue = self._pending[key]
+            try:
+                await self.dp.process_update(types.Update(**queue[0]))
+            except Exception as e:
+                logging.error(f"Error processing update {queue[0].get('update_id')}: {e}")
+            finally:
+                queue.popleft()
+                self.queued -= 1
+                self.processed += 1
+                if queue:
+                    # Следующий апдейт пользователя - в конец круга
+                    self._ready.put_nowait(key)
+                else:
+                    del self._pending[key]
+                if not self.queued:
+                    self._idle.set()
+
+def create_app(dispatcher, path, routes=None, secret=WEBHOOK_SECRET):
+    """aiohttp-приложение с вебхуком на path и дополнительными маршрутами"""
+
+    async def handle_webhook(request):
+        if secret and request.headers.get('X-Telegram-Bot-Api-Secret-Token') != secret:
+            return web.Response(status=403)
+        try:
+            data = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+        # Отвечаем сразу, обработка идет в фоне
+        if not dispatcher.submit(data):
+            return web.Response(status=503)
+        return web.Response(text='ok')
+
+    app = web.Application()
+    app['dispatcher'] = dispatcher
+    app.router.add_post(path, handle_webhook)
+    if routes is not None:
+        app.router.add_routes(routes)
+    app.on_cleanup.append(lambda app: dispatcher.close())
+    return app
+
+def run_webhook(dp, path, port, routes=None, on_cleanup=()):
+    """Регистрация вебхука в Telegram и запуск сервера"""
+    app = create_app(UpdateDispatcher(dp), path, routes)
+
+    async def on_startup(app):
+        await dp.bot.set_webhook(f"{WEBHOOK_URL}{path}", secret_token=WEBHOOK_SECRET)
+
+    async def close_bot(app):
+        session = await dp.bot.get_session()
+        await session.close()
+
+    app.on_startup.append(on_startup)
+    app.on_cleanup.extend(on_cleanup)
+    app.on_cleanup.append(close_bot)
+    web.run_app(app, host=WEBHOOK_HOST, port=port)
@@ -0,0 +1,150 @@
+# webhook_load.py
+"""Нагрузочный прогон вебхука: повтор 10k апдейтов.
+
+Апдейты читаются из JSONL (по одному апдейту Telegram в строке) или
+генерируются: сообщения и нажатия кнопок от нескольких сотен
+пользователей с долей повторов update_id. Они отправляются на
+настоящий aiohttp-сервер из webhook.py параллельными запросами, как это
+делает Telegram, а хендлер имитирует работу с базой/API задержкой.
+
+Проверяется, что каждый апдейт обработан ровно один раз и апдейты
+одного пользователя обработаны в порядке приема:
+
+    python webhook_load.py
+    python webhook_load.py recorded_updates.jsonl --connections 40
+"""
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+from collections import defaultdict
+
+import aiohttp
+from aiohttp import web
+from aiogram import Bot, Dispatcher, types
+
+from webhook import UpdateDispatcher, create_app, update_key
+
+PATH = '/webhook'
+
+def generate_updates(count, users=500, duplicates=0.02, seed=1):
+    """Синтетическая запись апдейтов (часть update_id повторяется)"""
+    rng = random.Random(seed)
+    updates = []
+    for update_id in range(1, count + 1):
+        user = {'id': rng.randint(1, users), 'is_bot': False, 'first_name': 'User'}
+        chat = {'id': user['id'], 'type': 'private'}
+        if rng.random() < 0.7:
+            updates.append({'update_id': update_id, 'message': {
+                'message_id': update_id, 'from': user, 'chat': chat, 'date': 0, 'text': f'msg {update_id}'
+            }})
+        else:
+            updates.append({'update_id': update_id, 'callback_query': {
+                'id': str(update_id), 'from': user, 'chat_instance': '1', 'data': f'view_{update_id}',
+                'message': {'message_id': 1, 'chat': chat, 'date': 0}
+            }})
+        if rng.random() < duplicates:
+            updates.append(updates[rng.randrange(len(updates))])
+    return updates
+
+def read_updates(path):
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+async def replay(updates, connections, workers, delay):
+    bot = Bot(token='123456:TEST_TOKEN_FOR_LOAD_REPLAY_ONLY_000')
+    dp = Dispatcher(bot)
+    processed = defaultdict(list)  # key -> update_id в порядке обработки
+
+    async def handle(update_id, key):
+        await asyncio.sleep(delay)  # работа хендлера: база, Bot API
+        processed[key].append(update_id)
+
+    @dp.message_handler()
+    async def on_message(message: types.Message):
+        await handle(message.message_id, message.from_user.id)
+
+    @dp.callback_query_handler()
+    async def on_callback(callback_query: types.CallbackQuery):
+        await handle(int(callback_query.id), callback_query.from_user.id)
+
+    dispatcher = UpdateDispatcher(dp, workers=workers)
+    accepted = defaultdict(list)  # key -> update_id в порядке приема
+    submit = dispatcher.submit
+
+    def recording_submit(data):
+        duplicate = data.get('update_id') in dispatcher._seen
+        ok = submit(data)
+        if ok and not duplicate:
+            accepted[update_key(data)].append(data['update_id'])
+        return ok
+
+    dispatcher.submit = recording_submit
+
+    runner = web.AppRunner(create_app(dispatcher, PATH))
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    url = f'http://127.0.0.1:{port}{PATH}'
+
+    latencies = []
+    statuses = defaultdict(int)
+    queue = asyncio.Queue()
+    for update in updates:
+        queue.put_nowait(update)
+
+    async def client(session):
+        while not queue.empty():
+            update = queue.get_nowait()
+            started = time.perf_counter()
+            async with session.post(url, json=update) as response:
+                await response.read()
+                statuses[response.status] += 1
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    connector = aiohttp.TCPConnector(limit=connections)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        await asyncio.gather(*(client(session) for _ in range(connections)))
+    acked = time.perf_counter() - started
+    # Остановка сразу после подтверждений: принятые апдейты дорабатываются
+    await runner.cleanup()
+    elapsed = time.perf_counter() - started
+
+    await (await bot.get_session()).close()
+
+    unique = len({update['update_id'] for update in updates})
+    handled = sum(len(ids) for ids in processed.values())
+    ordered = all(processed[key] == ids for key, ids in accepted.items())
+    ok = handled == unique and ordered and statuses.get(200) == len(updates)
+
+    print(f"updates: {len(updates)} sent, {unique} unique, {dispatcher.duplicates} duplicates dropped")
+    print(f"ack latency: p50 {percentile(latencies, 0.5) * 1000:.1f} ms, "
+          f"p99 {percentile(latencies, 0.99) * 1000:.1f} ms, statuses {dict(statuses)}")
+    print(f"all acked in {acked:.2f}s, processed in {elapsed:.2f}s "
+          f"({handled / elapsed:.0f} updates/s with {delay * 1000:.0f} ms handlers, {workers} workers)")
+    print(f"{'✅' if ok else '❌'} handled once: {handled == unique}, per-user order kept: {ordered}")
+    return ok
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Нагрузочный прогон вебхука')
+    parser.add_argument('path', nargs='?', help='JSONL с записанными апдейтами')
+    parser.add_argument('--count', type=int, default=10000)
+    parser.add_argument('--connections', type=int, default=40, help='Параллельных запросов (max_connections)')
+    parser.add_argument('--workers', type=int, default=32)
+    parser.add_argument('--delay', type=float, default=0.02, help='Время работы хендлера, секунды')
+    args = parser.parse_args(argv)
+
+    updates = read_updates(args.path) if args.path else generate_updates(args.count)
+    ok = asyncio.run(replay(updates, args.connections, args.workers, args.delay))
+    return 0 if ok else 1
+
+if __name__ == '__main__':
+    sys.exit(main())